@@ -0,0 +1,107 @@
+# SPDX-License-Identifier: GPL-2.0+
+
+"""
+Generates a synthetic set of waivers resembling production data, and loads
+it into the database.
+
+Subjects are a mix of Koji builds, Bodhi updates and composes, each waived
+for a handful of testcases, and many subject/testcase pairs are waived more
+than once so that most waivers are obsolete.
+"""
+
+import datetime
+import random
+
+from waiverdb.backfill import rebuild_latest_waivers
+from waiverdb.models import Waiver
+from waiverdb.models.base import hash_subject
+
+PACKAGES = ['bash', 'coreutils', 'gcc', 'glibc', 'gzip', 'kernel', 'openssl', 'python',
+            'python3', 'rpm', 'systemd', 'vim']
+RELEASES = ['fc26', 'fc27', 'fc28', 'el7']
+KOJI_TESTCASES = ['dist.abicheck', 'dist.rpmdeplint', 'dist.rpmlint', 'dist.upgradepath',
+                  'dist.depcheck']
+COMPOSE_TESTCASES = ['compose.install_default', 'compose.install_no_user',
+                     'compose.base_selinux', 'compose.desktop_browser']
+USERS = ['alice', 'bob', 'carol', 'dave', 'erin']
+PROXIES = ['bodhi', 'greenwave']
+
+
+def make_subject(rng, index):
+    """
+    Returns a subject and the testcases which may be waived for it.
+    """
+    kind = rng.random()
+    if kind < 0.1:
+        day = datetime.date(2017, 1, 1) + datetime.timedelta(days=index % 700)
+        compose = 'Fedora-%d-%s.n.%d' % (rng.choice([26, 27, 28]), day.strftime('%Y%m%d'),
+                                         index % 5)
+        return {'productmd.compose.id': compose}, COMPOSE_TESTCASES
+    nvr = '%s-%d.%d-%d.%s' % (rng.choice(PACKAGES), index // 1000, index % 1000,
+                              rng.randint(1, 30), rng.choice(RELEASES))
+    if kind < 0.6:
+        return {'type': 'koji_build', 'item': nvr}, KOJI_TESTCASES
+    return {'type': 'bodhi_update', 'item': 'FEDORA-2018-%010x' % index}, KOJI_TESTCASES
+
+
+def generate_waivers(count, max_revisions=4, seed=0):
+    """
+    Yields the column values of ``count`` waivers, in the order they were
+    created. Each subject/testcase pair is waived between one and
+    ``max_revisions`` times.
+    """
+    rng = random.Random(seed)
+    timestamp = datetime.datetime(2017, 1, 1)
+    generated = 0
+    index = 0
+    while generated < count:
+        subject, testcases = make_subject(rng, index)
+        index += 1
+        for testcase in rng.sample(testcases, rng.randint(1, len(testcases))):
+            for revision in range(rng.randint(1, max_revisions)):
+                if generated == count:
+                    return
+                timestamp += datetime.timedelta(seconds=rng.randint(1, 120))
+                proxied_by = rng.choice(PROXIES) if rng.random() < 0.3 else None
+                yield {
+                    'subject': subject,
+                    'subject_hash': hash_subject(subject),
+                    'testcase': testcase,
+                    'username': rng.choice(USERS),
+                    'proxied_by': proxied_by,
+                    'product_version': 'fedora-%s' % rng.choice([26, 27, 28]),
+                    'waived': revision % 2 == 0,
+                    'comment': 'Synthetic waiver %d' % generated,
+                    'timestamp': timestamp,
+                }
+                generated += 1
+
+
+def load_waivers(connection, waivers, chunk_size=10000, progress=None):
+    """
+    Inserts the given waivers ``chunk_size`` rows per statement, then
+    rebuilds the waiver_latest table for them.
+    """
+    table = Waiver.__table__
+    chunk = []
+    loaded = 0
+    for waiver in waivers:
+        chunk.append(waiver)
+        if len(chunk) == chunk_size:
+            with connection.begin():
+                connection.execute(table.insert(), chunk)
+            loaded += len(chunk)
+            chunk = []
+            if progress is not None:
+                progress(loaded)
+    if chunk:
+        with connection.begin():
+            connection.execute(table.insert(), chunk)
+        loaded += len(chunk)
+        if progress is not None:
+            progress(loaded)
+    rebuild_latest_waivers(connection)
+    with connection.begin():
+        connection.execute('ANALYZE waiver')
+        connection.execute('ANALYZE waiver_latest')
+    return loaded
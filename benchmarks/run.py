@@ -0,0 +1,151 @@
+# SPDX-License-Identifier: GPL-2.0+
+
+"""
+Times the main API paths against the database configured for Waiverdb
+(through WAIVERDB_CONFIG, as for the application itself), and saves the
+timings as JSON so that runs can be compared.
+
+Usage: PYTHONPATH=. python benchmarks/run.py --seed 2000000 --output before.json
+       PYTHONPATH=. python benchmarks/run.py --output after.json --baseline before.json
+
+The database must already have the Waiverdb schema. Only use a database
+you can throw away: --seed adds waivers, and the POST benchmark creates
+some too.
+"""
+
+import datetime
+import json
+import platform
+import subprocess
+import time
+
+import click
+
+from waiverdb.app import create_app
+from waiverdb.models import db, Waiver
+
+from dataset import generate_waivers, load_waivers
+
+
+def time_request(client, repeat, method, url, **kwargs):
+    """
+    Makes the request ``repeat`` times (after one warm-up request) and
+    returns summary statistics of the durations, in milliseconds.
+    """
+    response = client.open(url, method=method, **kwargs)
+    assert response.status_code < 300, (url, response.status_code, response.data)
+    durations = []
+    for _ in range(repeat):
+        start = time.time()
+        response = client.open(url, method=method, **kwargs)
+        durations.append((time.time() - start) * 1000)
+        assert response.status_code < 300, (url, response.status_code, response.data)
+    durations.sort()
+    return {
+        'min': durations[0],
+        'median': durations[len(durations) // 2],
+        'p95': durations[min(len(durations) - 1, int(len(durations) * 0.95))],
+        'mean': sum(durations) / len(durations),
+        'repeat': repeat,
+    }
+
+
+def sample_results(count):
+    """
+    Returns ``count`` random subject/testcase pairs from the database.
+    """
+    rows = db.session.query(Waiver.subject, Waiver.testcase)\
+        .order_by(db.func.random()).limit(count).all()
+    return [{'subject': subject, 'testcase': testcase} for subject, testcase in rows]
+
+
+def cases():
+    """
+    Yields the name, method, URL and request arguments of each benchmark.
+    """
+    sample = sample_results(1000)
+    subject = next((r['subject'] for r in sample if 'item' in r['subject']), sample[0]['subject'])
+    latest = db.session.query(db.func.max(Waiver.id)).scalar()
+    yield 'list', 'GET', '/api/v1.0/waivers/', {}
+    yield 'list deep page', 'GET', '/api/v1.0/waivers/?page=1000', {}
+    yield 'list by cursor', 'GET', '/api/v1.0/waivers/?cursor=', {}
+    yield 'list include_obsolete', 'GET', '/api/v1.0/waivers/?include_obsolete=1', {}
+    yield 'list by product_version', 'GET', '/api/v1.0/waivers/?product_version=fedora-27', {}
+    yield 'list by username', 'GET', '/api/v1.0/waivers/?username=alice', {}
+    yield 'list by proxied_by', 'GET', '/api/v1.0/waivers/?proxied_by=bodhi', {}
+    yield 'list by since', 'GET', '/api/v1.0/waivers/?since=2017-06-01T00:00:00.000000', {}
+    yield 'list by results', 'GET', '/api/v1.0/waivers/?results=%s' % json.dumps(sample[:1]), {}
+    yield 'list by subject_contains', 'GET', '/api/v1.0/waivers/?subject_contains=%s' % \
+        json.dumps({'item': subject.get('item')}), {}
+    for count in [10, 100, 1000]:
+        for obsolete in [False, True]:
+            name = '+by-subjects-and-testcases %d%s' % (
+                count, ' include_obsolete' if obsolete else '')
+            body = {'results': sample[:count], 'include_obsolete': obsolete}
+            yield name, 'POST', '/api/v1.0/waivers/+by-subjects-and-testcases', {
+                'data': json.dumps(body), 'content_type': 'application/json'}
+    yield 'get one', 'GET', '/api/v1.0/waivers/%d' % latest, {}
+    yield 'create', 'POST', '/api/v1.0/waivers/', {
+        'data': json.dumps({'subject': subject, 'testcase': 'dist.rpmdeplint',
+                            'product_version': 'fedora-27', 'waived': True,
+                            'comment': 'Benchmark'}),
+        'content_type': 'application/json',
+        'headers': {'Authorization': 'Basic YmVuY2htYXJrOg=='}}  # "benchmark:"
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.command()
+@click.option('--seed', 'seed_count', default=0, show_default=True,
+              help='Number of synthetic waivers to add to the database first.')
+@click.option('--repeat', default=20, show_default=True,
+              help='Number of timed requests per benchmark.')
+@click.option('--output', type=click.Path(), required=True,
+              help='File to save the timings to, as JSON.')
+@click.option('--baseline', type=click.File('r'),
+              help='Timings from an earlier run to compare against.')
+@click.option('--only', multiple=True,
+              help='Only run benchmarks whose name starts with this (repeatable).')
+def main(seed_count, repeat, output, baseline, only):
+    app = create_app()
+    # Measure the application itself, not the authentication backend.
+    app.config['AUTH_METHOD'] = 'dummy'
+    with app.app_context():
+        if seed_count:
+            with db.engine.connect() as connection:
+                load_waivers(connection, generate_waivers(seed_count),
+                             progress=lambda n: click.echo('Loaded %d waivers' % n))
+        report = {
+            'started': datetime.datetime.utcnow().isoformat(),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'postgres': '.'.join(str(part) for part in db.engine.dialect.server_version_info),
+            'waivers': db.session.query(db.func.count(Waiver.id)).scalar(),
+            'timings': {},
+        }
+        client = app.test_client()
+        for name, method, url, kwargs in cases():
+            if only and not any(name.startswith(prefix) for prefix in only):
+                continue
+            timing = time_request(client, repeat, method, url, **kwargs)
+            report['timings'][name] = timing
+            click.echo('%-50s median %9.2f ms  p95 %9.2f ms'
+                       % (name, timing['median'], timing['p95']))
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    if baseline:
+        previous = json.load(baseline)['timings']
+        click.echo('\nChange in median against the baseline:')
+        for name, timing in sorted(report['timings'].items()):
+            if name in previous:
+                click.echo('%-50s %+7.1f%%' % (
+                    name, (timing['median'] / previous[name]['median'] - 1) * 100))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+# SPDX-License-Identifier: GPL-2.0+
+
+"""
+Compares the cost of serializing waivers to JSON with Flask-RESTful's
+marshal() against :func:`waiverdb.fields.serialize_waiver`.
+
+Usage: PYTHONPATH=. python benchmarks/serializer.py [number of waivers]
+"""
+
+import datetime
+import json
+import sys
+import timeit
+
+from flask_restful import marshal
+from waiverdb.fields import waiver_fields, serialize_waiver
+from waiverdb.models import Waiver
+from waiverdb.utils import json_encoder
+
+
+def make_waivers(count):
+    waivers = []
+    for i in range(count):
+        waiver = Waiver({'type': 'koji_build', 'item': 'glibc-2.26-%d.fc27' % i},
+                        'dist.rpmdeplint', 'someone', 'fedora-27', waived=True,
+                        comment='It is fine')
+        waiver.id = i + 1
+        waiver.timestamp = datetime.datetime.utcnow()
+        waivers.append(waiver)
+    return waivers
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    waivers = make_waivers(count)
+    candidates = [
+        ('marshal + json', lambda: json.dumps({'data': marshal(waivers, waiver_fields)})),
+        ('serialize_waiver + %s' % json_encoder.__name__,
+         lambda: json_encoder.dumps({'data': [serialize_waiver(w) for w in waivers]})),
+    ]
+    assert candidates[0][1]() == candidates[1][1](), 'serializers disagree'
+    for name, func in candidates:
+        best = min(timeit.repeat(func, number=1, repeat=5))
+        print('%-40s %8.1f ms  %8.2f us/waiver' % (name, best * 1000, best * 1e6 / count))
+
+
+if __name__ == '__main__':
+    main()
@@ -36,6 +36,10 @@ setup(name='waiverdb',
       license='GPLv2+',
       packages=find_packages(exclude=['tests']),
       include_package_data=True,
+      extras_require={
+          # For serving with gunicorn's gevent workers, see waiverdb.wsgi_gevent.
+          'gevent': ['gevent', 'psycogreen'],
+      },
       entry_points={
           'console_scripts': ['waiverdb-cli=waiverdb.cli:cli',
                               'waiverdb=waiverdb.manage:cli'],
@@ -3,9 +3,14 @@
 import json
 from .utils import create_waiver
 import datetime
+import pytest
 from requests import ConnectionError, HTTPError
 from mock import patch, Mock
 from waiverdb import __version__
+from waiverdb.api_v1 import get_resultsdb_result
+from waiverdb.cache import LRUCache
+from waiverdb.models.waivers import advance_generation
+from waiverdb.utils import CircuitBreaker
 
 
 @patch('waiverdb.auth.get_user', return_value=('foo', {}))
@@ -29,6 +34,85 @@ def test_create_waiver(mocked_get_user, client, session):
     assert res_data['comment'] == 'it broke'
 
 
+@patch('waiverdb.auth.get_user', return_value=('foo', {}))
+def test_create_multiple_waivers(mocked_get_user, client, session):
+    data = [{
+        'subject': {'subject.test': 'subject'},
+        'testcase': 'testcase%d' % i,
+        'product_version': 'fool-1',
+        'waived': True,
+        'comment': 'it broke',
+    } for i in range(3)]
+    r = client.post('/api/v1.0/waivers/', data=json.dumps(data),
+                    content_type='application/json')
+    res_data = json.loads(r.get_data(as_text=True))
+    assert r.status_code == 201
+    assert mocked_get_user.call_count == 1
+    assert [w['testcase'] for w in res_data] == ['testcase0', 'testcase1', 'testcase2']
+    assert all(w['username'] == 'foo' for w in res_data)
+    r = client.get('/api/v1.0/waivers/')
+    assert len(json.loads(r.get_data(as_text=True))['data']) == 3
+
+
+@patch('waiverdb.auth.get_user', return_value=('foo', {}))
+def test_create_multiple_waivers_is_all_or_nothing(mocked_get_user, client, session):
+    data = [{
+        'subject': {'subject.test': 'subject'},
+        'testcase': 'testcase1',
+        'product_version': 'fool-1',
+        'waived': True,
+    }, {
+        'subject': {'subject.test': 'subject'},
+        'product_version': 'fool-1',
+        'waived': True,
+    }]
+    r = client.post('/api/v1.0/waivers/', data=json.dumps(data),
+                    content_type='application/json')
+    res_data = json.loads(r.get_data(as_text=True))
+    assert r.status_code == 400
+    assert res_data['message'] == 'Either result_id or subject/testcase are required arguments.'
+    r = client.get('/api/v1.0/waivers/')
+    assert json.loads(r.get_data(as_text=True))['data'] == []
+
+
+@patch('waiverdb.api_v1.get_resultsdb_result')
+@patch('waiverdb.auth.get_user', return_value=('foo', {}))
+def test_create_multiple_waivers_by_result_id(mocked_get_user, mocked_resultsdb, client,
+                                              session):
+    mocked_resultsdb.side_effect = lambda result_id: {
+        'data': {'type': ['koji_build'], 'item': ['build-%d' % result_id]},
+        'testcase': {'name': 'sometest'},
+    }
+    data = [{'result_id': result_id, 'product_version': 'fool-1', 'waived': True}
+            for result_id in [1, 2, 1]]
+    r = client.post('/api/v1.0/waivers/', data=json.dumps(data),
+                    content_type='application/json')
+    res_data = json.loads(r.get_data(as_text=True))
+    assert r.status_code == 201
+    assert [w['subject']['item'] for w in res_data] == ['build-1', 'build-2', 'build-1']
+    # Each distinct result is looked up once.
+    assert sorted(call[0][0] for call in mocked_resultsdb.call_args_list) == [1, 2]
+
+
+@patch('waiverdb.api_v1.get_resultsdb_result')
+@patch('waiverdb.auth.get_user', return_value=('foo', {}))
+def test_create_multiple_waivers_with_unknown_result_id(mocked_get_user, mocked_resultsdb,
+                                                        client, session):
+    def lookup(result_id):
+        if result_id == 2:
+            raise HTTPError(response=Mock(status_code=404))
+        return {'data': {'type': ['koji_build'], 'item': ['build-%d' % result_id]},
+                'testcase': {'name': 'sometest'}}
+    mocked_resultsdb.side_effect = lookup
+    data = [{'result_id': result_id, 'product_version': 'fool-1', 'waived': True}
+            for result_id in [1, 2]]
+    r = client.post('/api/v1.0/waivers/', data=json.dumps(data),
+                    content_type='application/json')
+    res_data = json.loads(r.get_data(as_text=True))
+    assert r.status_code == 400
+    assert res_data['message'] == 'Result id not found in Resultsdb'
+
+
 @patch('waiverdb.api_v1.get_resultsdb_result')
 @patch('waiverdb.auth.get_user', return_value=('foo', {}))
 def test_create_waiver_legacy(mocked_get_user, mocked_resultsdb, client, session):
@@ -103,6 +187,55 @@ def test_create_waiver_with_unknown_result_id(mocked_get_user, mocked_resultsdb,
     assert res_data['message'].startswith('Failed looking up result in Resultsdb:')
 
 
+@patch('waiverdb.api_v1.requests_session')
+def test_resultsdb_results_are_cached(mocked_session, app, monkeypatch):
+    monkeypatch.setattr(app, 'resultsdb_cache', LRUCache(10, 60))
+    mocked_session.request.return_value = Mock(status_code=200, json=lambda: {'id': 123})
+    assert get_resultsdb_result(123) == {'id': 123}
+    assert get_resultsdb_result(123) == {'id': 123}
+    assert mocked_session.request.call_count == 1
+
+
+@patch('waiverdb.api_v1.time.sleep')
+@patch('waiverdb.api_v1.requests_session')
+def test_resultsdb_requests_are_retried(mocked_session, mocked_sleep, app, monkeypatch):
+    monkeypatch.setattr(app, 'resultsdb_cache', LRUCache(10, 60))
+    mocked_session.request.side_effect = [
+        ConnectionError('Connection refused'),
+        Mock(status_code=200, json=lambda: {'id': 456}),
+    ]
+    assert get_resultsdb_result(456) == {'id': 456}
+    assert mocked_session.request.call_count == 2
+    mocked_sleep.assert_called_once_with(app.config['RESULTSDB_RETRY_BACKOFF'])
+
+
+@patch('waiverdb.api_v1.time.sleep')
+@patch('waiverdb.api_v1.requests_session')
+@patch('waiverdb.auth.get_user', return_value=('foo', {}))
+def test_resultsdb_circuit_breaker_fails_fast(mocked_get_user, mocked_session, mocked_sleep,
+                                              app, client, monkeypatch):
+    monkeypatch.setattr(app, 'resultsdb_cache', LRUCache(10, 60))
+    monkeypatch.setattr(app, 'resultsdb_breaker', CircuitBreaker(1, 30))
+    mocked_session.request.side_effect = ConnectionError('Connection refused')
+    data = {
+        'result_id': 123,
+        'product_version': 'fool-1',
+        'waived': True,
+    }
+    r = client.post('/api/v1.0/waivers/', data=json.dumps(data),
+                    content_type='application/json')
+    assert r.status_code == 503
+    calls = mocked_session.request.call_count
+    assert calls == app.config['RESULTSDB_RETRIES'] + 1
+    r = client.post('/api/v1.0/waivers/', data=json.dumps(data),
+                    content_type='application/json')
+    res_data = json.loads(r.get_data(as_text=True))
+    assert r.status_code == 503
+    assert 'Not looking up result in Resultsdb' in res_data['message']
+    assert 'Circuit is open' in res_data['message']
+    assert mocked_session.request.call_count == calls
+
+
 @patch('waiverdb.auth.get_user', return_value=('foo', {}))
 def test_create_waiver_with_no_testcase(mocked_get_user, client):
     data = {
@@ -229,6 +362,133 @@ def test_pagination_waivers(client, session):
     assert '/waivers/?page=3' in res_data['last']
 
 
+def test_pagination_waivers_without_count(client, session, app, monkeypatch):
+    monkeypatch.setitem(app.config, 'PAGINATION_COUNT', 'none')
+    for i in range(0, 30):
+        create_waiver(session, subject={"subject%d" % i: "%d" % i},
+                      testcase="case %d" % i, username='foo %d' % i,
+                      product_version='foo-%d' % i, comment='bla bla bla')
+    r = client.get('/api/v1.0/waivers/?page=2')
+    res_data = json.loads(r.get_data(as_text=True))
+    assert r.status_code == 200
+    assert len(res_data['data']) == 10
+    assert '/waivers/?page=1' in res_data['prev']
+    assert '/waivers/?page=3' in res_data['next']
+    assert res_data['last'] is None
+    r = client.get('/api/v1.0/waivers/?page=3')
+    res_data = json.loads(r.get_data(as_text=True))
+    assert len(res_data['data']) == 10
+    assert res_data['next'] is None
+    r = client.get('/api/v1.0/waivers/?page=4')
+    res_data = json.loads(r.get_data(as_text=True))
+    assert res_data['data'] == []
+
+
+def test_pagination_waivers_with_estimated_count(client, session, app, monkeypatch):
+    monkeypatch.setitem(app.config, 'PAGINATION_COUNT', 'estimate')
+    for i in range(0, 30):
+        create_waiver(session, subject={"subject%d" % i: "%d" % i},
+                      testcase="case %d" % i, username='foo %d' % i,
+                      product_version='foo-%d' % i, comment='bla bla bla')
+    r = client.get('/api/v1.0/waivers/?page=2')
+    res_data = json.loads(r.get_data(as_text=True))
+    assert r.status_code == 200
+    assert len(res_data['data']) == 10
+    assert '/waivers/?page=3' in res_data['next']
+    assert res_data['last'] is not None
+    assert res_data['last_is_estimate'] is True
+    r = client.get('/api/v1.0/waivers/?page=3')
+    res_data = json.loads(r.get_data(as_text=True))
+    assert '/waivers/?page=3' in res_data['last']
+    assert res_data['last_is_estimate'] is False
+
+
+@pytest.mark.parametrize('mode', ['exact', 'estimate', 'none'])
+def test_pagination_waivers_with_zero_limit(client, session, app, monkeypatch, mode):
+    monkeypatch.setitem(app.config, 'PAGINATION_COUNT', mode)
+    create_waiver(session, subject={'subject.test': 'subject'},
+                  testcase='testcase', username='foo', product_version='foo-1')
+    r = client.get('/api/v1.0/waivers/?limit=0')
+    res_data = json.loads(r.get_data(as_text=True))
+    assert r.status_code == 400
+    assert 'Must be a positive integer' in res_data['message']['limit']
+
+
+def test_cursor_pagination_waivers(client, session):
+    for i in range(0, 25):
+        create_waiver(session, subject={"subject%d" % i: "%d" % i},
+                      testcase="case %d" % i, username='foo %d' % i,
+                      product_version='foo-%d' % i, comment='bla bla bla')
+    r = client.get('/api/v1.0/waivers/?cursor=')
+    res_data = json.loads(r.get_data(as_text=True))
+    assert r.status_code == 200
+    assert len(res_data['data']) == 10
+    assert res_data['prev'] is None
+    assert res_data['last'] is None
+    assert 'cursor=' in res_data['next']
+    seen = [w['id'] for w in res_data['data']]
+    while res_data['next']:
+        r = client.get(res_data['next'])
+        assert r.status_code == 200
+        res_data = json.loads(r.get_data(as_text=True))
+        seen.extend(w['id'] for w in res_data['data'])
+    assert len(seen) == 25
+    assert len(set(seen)) == 25
+
+
+def test_cursor_pagination_with_malformed_cursor(client, session):
+    r = client.get('/api/v1.0/waivers/?cursor=bogus')
+    res_data = json.loads(r.get_data(as_text=True))
+    assert r.status_code == 400
+    assert res_data['message'] == "'cursor' parameter is not valid"
+
+
+@pytest.mark.parametrize('limit', ['0', '-1', 'ten'])
+def test_cursor_pagination_with_invalid_limit(client, session, limit):
+    create_waiver(session, subject={'subject.test': 'subject'},
+                  testcase='testcase', username='foo', product_version='foo-1')
+    r = client.get('/api/v1.0/waivers/?cursor=&limit=%s' % limit)
+    res_data = json.loads(r.get_data(as_text=True))
+    assert r.status_code == 400
+    assert 'Must be a positive integer' in res_data['message']['limit']
+
+
+def test_get_waivers_conditional_request(client, session):
+    create_waiver(session, subject={'subject.test': 'subject'},
+                  testcase='testcase1', username='foo',
+                  product_version='foo-1')
+    r = client.get('/api/v1.0/waivers/')
+    assert r.status_code == 200
+    etag = r.headers['ETag']
+    r = client.get('/api/v1.0/waivers/', headers={'If-None-Match': etag})
+    assert r.status_code == 304
+    assert r.headers['ETag'] == etag
+    # A different filter is a different response.
+    r = client.get('/api/v1.0/waivers/?username=foo', headers={'If-None-Match': etag})
+    assert r.status_code == 200
+    assert r.headers['ETag'] != etag
+    # So is the same filter after a new waiver is created.
+    create_waiver(session, subject={'subject.test': 'subject'},
+                  testcase='testcase2', username='foo',
+                  product_version='foo-1')
+    r = client.get('/api/v1.0/waivers/', headers={'If-None-Match': etag})
+    assert r.status_code == 200
+    assert len(json.loads(r.get_data(as_text=True))['data']) == 2
+
+
+def test_get_waivers_conditional_request_after_rewrite(client, session):
+    create_waiver(session, subject={'subject.test': 'subject'},
+                  testcase='testcase1', username='foo',
+                  product_version='foo-1')
+    r = client.get('/api/v1.0/waivers/')
+    etag = r.headers['ETag']
+    # Backfilling subjects rewrites waivers in place, without creating any.
+    advance_generation(session.connection())
+    r = client.get('/api/v1.0/waivers/', headers={'If-None-Match': etag})
+    assert r.status_code == 200
+    assert r.headers['ETag'] != etag
+
+
 def test_obsolete_waivers_are_excluded_by_default(client, session):
     create_waiver(session, subject={'subject.test': 'subject'},
                   testcase='testcase1', username='foo',
@@ -333,6 +593,42 @@ def test_filtering_waivers_by_product_version(client, session):
     assert res_data['data'][0]['product_version'] == 'release-1'
 
 
+def test_filtering_waivers_by_subject_contains(client, session):
+    create_waiver(session, subject={'type': 'koji_build', 'item': 'gzip-1.9-1.fc28'},
+                  testcase='testcase1', username='foo', product_version='foo-1')
+    create_waiver(session, subject={'type': 'bodhi_update', 'item': 'gzip-1.9-1.fc28'},
+                  testcase='testcase2', username='foo', product_version='foo-1')
+    create_waiver(session, subject={'type': 'koji_build', 'item': 'bash-4.4-1.fc28'},
+                  testcase='testcase1', username='foo', product_version='foo-1')
+    param = json.dumps({'item': 'gzip-1.9-1.fc28'})
+    r = client.get('/api/v1.0/waivers/?subject_contains=%s' % param)
+    res_data = json.loads(r.get_data(as_text=True))
+    assert r.status_code == 200
+    assert len(res_data['data']) == 2
+    assert all(w['subject']['item'] == 'gzip-1.9-1.fc28' for w in res_data['data'])
+
+
+def test_filtering_waivers_by_malformed_subject_contains(client, session):
+    r = client.get('/api/v1.0/waivers/?subject_contains=["item"]')
+    res_data = json.loads(r.get_data(as_text=True))
+    assert r.status_code == 400
+    assert res_data['message'] == "'subject_contains' parameter should be a JSON object"
+
+
+def test_get_waivers_by_subject_contains_with_post(client, session):
+    create_waiver(session, subject={'type': 'koji_build', 'item': 'gzip-1.9-1.fc28'},
+                  testcase='testcase1', username='foo', product_version='foo-1')
+    create_waiver(session, subject={'type': 'koji_build', 'item': 'bash-4.4-1.fc28'},
+                  testcase='testcase1', username='foo', product_version='foo-1')
+    data = {'subject_contains': {'item': 'bash-4.4-1.fc28'}}
+    r = client.post('/api/v1.0/waivers/+by-subjects-and-testcases', data=json.dumps(data),
+                    content_type='application/json')
+    res_data = json.loads(r.get_data(as_text=True))
+    assert r.status_code == 200
+    assert len(res_data['data']) == 1
+    assert res_data['data'][0]['subject'] == {'type': 'koji_build', 'item': 'bash-4.4-1.fc28'}
+
+
 def test_filtering_waivers_by_username(client, session):
     create_waiver(session, subject={'subject.test1': 'subject1'},
                   testcase='testcase1', username='foo', product_version='foo-1')
@@ -445,6 +741,57 @@ def test_get_waivers_with_post_request(client, session):
     assert all(w['product_version'].startswith('foo-') for w in res_data['data'])
 
 
+def test_get_waivers_with_streaming_post_request(app, client, session, monkeypatch):
+    monkeypatch.setitem(app.config, 'STREAM_LOOKUP_RESPONSES', True)
+    results = []
+    for i in range(1, 51):
+        results.append({'subject': {'subject%d' % i: '%d' % i},
+                        'testcase': 'case %d' % i})
+        create_waiver(session, subject={"subject%d" % i: "%d" % i},
+                      testcase="case %d" % i, username='foo %d' % i,
+                      product_version='foo-%d' % i, comment='bla bla bla')
+    data = {
+        'results': results
+    }
+    r = client.post('/api/v1.0/waivers/+by-subjects-and-testcases', data=json.dumps(data),
+                    content_type='application/json')
+    assert r.status_code == 200
+    assert r.is_streamed
+    res_data = json.loads(r.get_data(as_text=True))
+    assert len(res_data['data']) == 50
+    subjects = [{'subject%d' % i: '%d' % i} for i in reversed(range(1, 51))]
+    assert [w['subject'] for w in res_data['data']] == subjects
+
+
+def test_get_waivers_with_post_request_cached(app, client, session, monkeypatch):
+    monkeypatch.setattr(app, 'results_cache', LRUCache(100, 60))
+    create_waiver(session, subject={'subject.test': 'subject'},
+                  testcase='testcase1', username='foo', product_version='foo-1')
+    data = {
+        'results': [
+            {'subject': {'subject.test': 'subject'}, 'testcase': 'testcase1'},
+            {'subject': {'subject.test': 'subject'}},
+        ]
+    }
+    r = client.post('/api/v1.0/waivers/+by-subjects-and-testcases', data=json.dumps(data),
+                    content_type='application/json')
+    assert r.status_code == 200
+    assert len(json.loads(r.get_data(as_text=True))['data']) == 1
+    assert app.results_cache.misses == 2
+    r = client.post('/api/v1.0/waivers/+by-subjects-and-testcases', data=json.dumps(data),
+                    content_type='application/json')
+    assert len(json.loads(r.get_data(as_text=True))['data']) == 1
+    assert app.results_cache.hits == 2
+    # A new waiver invalidates the cached lookups.
+    create_waiver(session, subject={'subject.test': 'subject'},
+                  testcase='testcase2', username='foo', product_version='foo-1')
+    r = client.post('/api/v1.0/waivers/+by-subjects-and-testcases', data=json.dumps(data),
+                    content_type='application/json')
+    res_data = json.loads(r.get_data(as_text=True))
+    assert [w['testcase'] for w in res_data['data']] == ['testcase2', 'testcase1']
+    assert app.results_cache.hits == 2
+
+
 def test_get_waivers_with_post_malformed_since(client, session):
     create_waiver(session, subject={'subject.test1': 'subject1'},
                   testcase='testcase1', username='foo', product_version='foo-1')
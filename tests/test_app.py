@@ -13,12 +13,16 @@ class DisabledMessagingConfig(config.Config):
     MESSAGE_BUS_PUBLISH = False
     AUTH_METHOD = None
     SQLALCHEMY_TRACK_MODIFICATIONS = True
+    METRICS = False
+    SLOW_QUERY_THRESHOLD = None
 
 
 class EnabledMessagedConfig(config.Config):
     MESSAGE_BUS_PUBLISH = True
     AUTH_METHOD = None
     SQLALCHEMY_TRACK_MODIFICATIONS = True
+    METRICS = False
+    SLOW_QUERY_THRESHOLD = None
 
 
 @mock.patch('waiverdb.app.event.listen')
@@ -32,3 +36,46 @@ def test_enabled_messaging_should_register_events(mock_listen):
     app.create_app(EnabledMessagedConfig)
     mock_listen.assert_called_once_with(
         SignallingSession, 'after_commit', app.publish_new_waiver)
+
+
+class EnabledResultsCacheConfig(config.Config):
+    MESSAGE_BUS_PUBLISH = False
+    AUTH_METHOD = None
+    SQLALCHEMY_TRACK_MODIFICATIONS = True
+    METRICS = False
+    SLOW_QUERY_THRESHOLD = None
+    RESULTS_CACHE_SIZE = 100
+
+
+@mock.patch('waiverdb.app.event.listen')
+def test_enabled_results_cache_should_register_events(mock_listen):
+    test_app = app.create_app(EnabledResultsCacheConfig)
+    assert test_app.results_cache.maxsize == 100
+    mock_listen.assert_called_once_with(
+        SignallingSession, 'after_commit', app.invalidate_results_cache)
+
+
+class EnabledQueryStatsConfig(DisabledMessagingConfig):
+    QUERY_STATS_HEADER = True
+
+
+@mock.patch('waiverdb.app.register_query_instrumentation')
+def test_query_instrumentation_is_only_registered_when_used(mock_register):
+    app.create_app(DisabledMessagingConfig)
+    assert 0 == mock_register.call_count
+    test_app = app.create_app(EnabledQueryStatsConfig)
+    mock_register.assert_called_once_with(test_app)
+
+
+class ReplicaMetricsConfig(DisabledMessagingConfig):
+    METRICS = True
+    REPLICA_DATABASE_URIS = ['postgresql+psycopg2:///waiverdb_replica']
+
+
+@mock.patch('waiverdb.app.init_metrics')
+def test_metrics_instrument_the_replica_pools(mock_init_metrics):
+    test_app = app.create_app(ReplicaMetricsConfig)
+    engines = mock_init_metrics.call_args[0][1]
+    assert sorted(engines) == ['primary', 'replica0']
+    assert engines['replica0'] is app.db.get_engine(test_app, bind='replica0')
+    assert engines['replica0'] is not engines['primary']
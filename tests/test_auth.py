@@ -5,12 +5,30 @@ import pytest
 import gssapi
 import mock
 import json
+import time
 from werkzeug.exceptions import Unauthorized
 import waiverdb.auth
+from waiverdb.cache import LRUCache
 import flask_oidc
 
 
-@pytest.mark.usefixtures('enable_kerberos')
+class FakeGSSError(gssapi.exceptions.GSSError):
+    def __init__(self, *args):  # pylint: disable=W0231
+        Exception.__init__(self, 'Key version number for principal in key table is incorrect')
+
+    def gen_msg(self):
+        return str(self)
+
+
+@pytest.fixture
+def acceptor_credentials(monkeypatch):
+    monkeypatch.setattr(waiverdb.auth, '_acceptor_credentials', {})
+    credentials = mock.Mock()
+    monkeypatch.setattr(gssapi, 'Credentials', mock.Mock(return_value=credentials))
+    return credentials
+
+
+@pytest.mark.usefixtures('enable_kerberos', 'acceptor_credentials')
 class TestGSSAPIAuthentication(object):
     def test_unauthorized(self, client, monkeypatch):
         monkeypatch.setenv('KRB5_KTNAME', '/etc/foo.keytab')
@@ -41,6 +59,97 @@ class TestGSSAPIAuthentication(object):
         res_data = json.loads(r.data.decode('utf-8'))
         assert res_data['username'] == 'foo'
 
+    @mock.patch.multiple("gssapi.SecurityContext", complete=True,
+                         __init__=mock.Mock(return_value=None),
+                         step=mock.Mock(return_value=b"STOKEN"),
+                         initiator_name="foo@EXAMPLE.ORG")
+    def test_session_cookie_skips_negotiation(self, app, client, monkeypatch):
+        monkeypatch.setenv('KRB5_KTNAME', '/etc/foo.keytab')
+        monkeypatch.setitem(app.config, 'KERBEROS_SESSION_LIFETIME', 300)
+        data = {
+            'subject': {'subject.test': 'subject'},
+            'testcase': 'testcase1',
+            'product_version': 'fool-1',
+            'waived': True,
+            'comment': 'it broke',
+        }
+        headers = {'Authorization':
+                   'Negotiate %s' % b64encode("CTOKEN").decode()}
+        r = client.post('/api/v1.0/waivers/', data=json.dumps(data),
+                        content_type='application/json', headers=headers)
+        assert r.status_code == 201
+        assert 'waiverdb_session=' in r.headers.get('Set-Cookie')
+        assert 'SameSite=Strict' in r.headers.get('Set-Cookie')
+        gssapi.SecurityContext.step.reset_mock()
+        # The test client sends the cookie back, so no Authorization is needed.
+        r = client.post('/api/v1.0/waivers/', data=json.dumps(data),
+                        content_type='application/json')
+        assert r.status_code == 201
+        res_data = json.loads(r.data.decode('utf-8'))
+        assert res_data['username'] == 'foo'
+        assert not gssapi.SecurityContext.step.called
+
+    @mock.patch.multiple("gssapi.SecurityContext", complete=True,
+                         __init__=mock.Mock(return_value=None),
+                         step=mock.Mock(return_value=b"STOKEN"),
+                         initiator_name="foo@EXAMPLE.ORG")
+    def test_acceptor_credentials_are_cached(self, app, client, monkeypatch,
+                                             acceptor_credentials):
+        monkeypatch.setenv('KRB5_KTNAME', '/etc/foo.keytab')
+        monkeypatch.setitem(app.config, 'KERBEROS_HTTP_HOST', 'waiverdb.example.com')
+        data = {
+            'subject': {'subject.test': 'subject'},
+            'testcase': 'testcase1',
+            'product_version': 'fool-1',
+            'waived': True,
+        }
+        headers = {'Authorization':
+                   'Negotiate %s' % b64encode("CTOKEN").decode()}
+        for _ in range(2):
+            r = client.post('/api/v1.0/waivers/', data=json.dumps(data),
+                            content_type='application/json', headers=headers)
+            assert r.status_code == 201
+        gssapi.Credentials.assert_called_once_with(name=mock.ANY, usage='accept')
+        assert str(gssapi.Credentials.call_args[1]['name']) == 'HTTP@waiverdb.example.com'
+        gssapi.SecurityContext.__init__.assert_called_with(creds=acceptor_credentials,
+                                                           usage='accept')
+
+    def test_default_acceptor_credentials_without_configured_host(self, acceptor_credentials):
+        assert waiverdb.auth.get_acceptor_credentials() is acceptor_credentials
+        gssapi.Credentials.assert_called_once_with(usage='accept')
+
+    @mock.patch('waiverdb.auth.time.time')
+    def test_acceptor_credentials_are_acquired_again_after_ttl(self, mock_time):
+        mock_time.return_value = 1000
+        waiverdb.auth.get_acceptor_credentials()
+        mock_time.return_value = 1000 + waiverdb.auth.ACCEPTOR_CREDENTIALS_TTL
+        waiverdb.auth.get_acceptor_credentials()
+        assert gssapi.Credentials.call_count == 1
+        mock_time.return_value = 1001 + waiverdb.auth.ACCEPTOR_CREDENTIALS_TTL
+        waiverdb.auth.get_acceptor_credentials()
+        assert gssapi.Credentials.call_count == 2
+
+    @mock.patch.multiple("gssapi.SecurityContext",
+                         __init__=mock.Mock(return_value=None),
+                         step=mock.Mock(side_effect=FakeGSSError))
+    def test_acceptor_credentials_are_acquired_again_after_failure(self, client, monkeypatch):
+        monkeypatch.setenv('KRB5_KTNAME', '/etc/foo.keytab')
+        headers = {'Authorization':
+                   'Negotiate %s' % b64encode("CTOKEN").decode()}
+        for _ in range(2):
+            r = client.post('/api/v1.0/waivers/', content_type='application/json',
+                            headers=headers)
+            assert r.status_code == 403
+        assert gssapi.Credentials.call_count == 2
+
+    def test_tampered_session_cookie_is_rejected(self, app, client, monkeypatch):
+        monkeypatch.setenv('KRB5_KTNAME', '/etc/foo.keytab')
+        monkeypatch.setitem(app.config, 'KERBEROS_SESSION_LIFETIME', 300)
+        client.set_cookie('localhost', 'waiverdb_session', 'eyJ1c2VyIjoiZm9vIn0.bogus.sig')
+        r = client.post('/api/v1.0/waivers/', content_type='application/json')
+        assert r.status_code == 401
+        assert r.headers.get('www-authenticate') == 'Negotiate'
+
 
 class TestOIDCAuthentication(object):
 
@@ -62,6 +171,7 @@ class TestOIDCAuthentication(object):
         request.headers.__getitem__.side_effect = headers.__getitem__
         request.headers.__setitem__.side_effect = headers.__setitem__
         request.headers.__contains__.side_effect = headers.__contains__
+        request.headers.get.side_effect = headers.get
         with pytest.raises(Unauthorized) as excinfo:
             waiverdb.auth.get_user(request)
         assert 'Token required but invalid' in excinfo.value.get_description()
@@ -78,9 +188,47 @@ class TestOIDCAuthentication(object):
         request.headers.__getitem__.side_effect = headers.__getitem__
         request.headers.__setitem__.side_effect = headers.__setitem__
         request.headers.__contains__.side_effect = headers.__contains__
+        request.headers.get.side_effect = headers.get
         user, header = waiverdb.auth.get_user(request)
         assert user == name
 
+    @mock.patch.object(flask_oidc.OpenIDConnect, '_get_token_info')
+    def test_get_user_caches_validated_token(self, mocked_get_token, app, session,
+                                             monkeypatch):
+        monkeypatch.setattr(app, 'oidc_token_cache', LRUCache(10, 60))
+        name = 'Son Goku'
+        mocked_get_token.return_value = {'active': True, 'username': name,
+                                         'scope': 'openid waiverdb_scope',
+                                         'exp': time.time() + 3600}
+        headers = {'Authorization': 'Bearer cached'}
+        request = mock.MagicMock()
+        request.headers.return_value = mock.MagicMock(spec_set=dict)
+        request.headers.__getitem__.side_effect = headers.__getitem__
+        request.headers.__setitem__.side_effect = headers.__setitem__
+        request.headers.__contains__.side_effect = headers.__contains__
+        request.headers.get.side_effect = headers.get
+        for _ in range(3):
+            user, header = waiverdb.auth.get_user(request)
+            assert user == name
+        assert mocked_get_token.call_count == 1
+
+    @mock.patch.object(flask_oidc.OpenIDConnect, '_get_token_info')
+    def test_get_user_does_not_cache_expired_token(self, mocked_get_token, app, session,
+                                                   monkeypatch):
+        monkeypatch.setattr(app, 'oidc_token_cache', LRUCache(10, 60))
+        mocked_get_token.return_value = {'active': True, 'username': 'Son Goku',
+                                         'scope': 'openid waiverdb_scope',
+                                         'exp': time.time() - 1}
+        headers = {'Authorization': 'Bearer expiring'}
+        request = mock.MagicMock()
+        request.headers.return_value = mock.MagicMock(spec_set=dict)
+        request.headers.__getitem__.side_effect = headers.__getitem__
+        request.headers.__setitem__.side_effect = headers.__setitem__
+        request.headers.__contains__.side_effect = headers.__contains__
+        request.headers.get.side_effect = headers.get
+        waiverdb.auth.get_user(request)
+        assert len(app.oidc_token_cache) == 0
+
 
 @pytest.mark.usefixtures('enable_ssl')
 class TestSSLAuthentication(object):
@@ -0,0 +1,113 @@
+# SPDX-License-Identifier: GPL-2.0+
+
+"""This module contains tests for :mod:`waiverdb.backfill`."""
+from __future__ import unicode_literals
+
+import mock
+import pytest
+
+from waiverdb.backfill import (backfill_subjects, rebuild_latest_waivers,
+                               refresh_latest_waivers)
+from waiverdb.models import Waiver, LatestWaiver, WaiverGeneration
+from waiverdb.models.base import hash_subject
+from .utils import create_waiver
+
+
+def fake_result(result_id):
+    return {
+        'id': result_id,
+        'data': {'type': ['koji_build'], 'item': ['build-%d' % result_id]},
+        'testcase': {'name': 'testcase-%d' % result_id},
+    }
+
+
+@mock.patch('waiverdb.backfill.get_resultsdb_result', side_effect=fake_result)
+def test_backfill_subjects_in_chunks(mocked_resultsdb, session):
+    waivers = []
+    for i in range(5):
+        waiver = create_waiver(session, subject={'placeholder': 'x'}, testcase='placeholder',
+                               username='foo', product_version='foo-1')
+        waiver.result_id = 100 + i
+        waivers.append(waiver)
+    session.flush()
+    progress = mock.Mock()
+    generation = WaiverGeneration.current(session)
+    last_id = backfill_subjects(session.connection(), chunk_size=2, workers=2,
+                                progress=progress)
+    assert last_id == waivers[-1].id
+    assert progress.call_count == 3
+    # Each chunk rewrites waivers, so cached responses must be invalidated.
+    assert WaiverGeneration.current(session) == generation + 3
+    assert mocked_resultsdb.call_count == 5
+    session.expire_all()
+    for i, waiver in enumerate(waivers):
+        waiver = Waiver.query.get(waiver.id)
+        assert waiver.subject == {'type': 'koji_build', 'item': 'build-%d' % (100 + i)}
+        assert waiver.testcase == 'testcase-%d' % (100 + i)
+
+
+@mock.patch('waiverdb.backfill.get_resultsdb_result', side_effect=fake_result)
+def test_backfill_subjects_resumes_after_start_id(mocked_resultsdb, session):
+    waivers = []
+    for i in range(3):
+        waiver = create_waiver(session, subject={'placeholder': 'x'}, testcase='placeholder',
+                               username='foo', product_version='foo-1')
+        waiver.result_id = 100 + i
+        waivers.append(waiver)
+    session.flush()
+    backfill_subjects(session.connection(), start_id=waivers[0].id)
+    assert [c[0][0] for c in mocked_resultsdb.call_args_list] == [101, 102]
+
+
+@mock.patch('waiverdb.backfill.get_resultsdb_result',
+            side_effect=lambda result_id: {'id': result_id, 'data': {'type': ['compose']},
+                                           'testcase': {'name': 'testcase'}})
+def test_backfill_subjects_fails_for_unsupported_results(mocked_resultsdb, session):
+    waiver = create_waiver(session, subject={'placeholder': 'x'}, testcase='placeholder',
+                           username='foo', product_version='foo-1')
+    waiver.result_id = 100
+    session.flush()
+    with pytest.raises(RuntimeError) as excinfo:
+        backfill_subjects(session.connection())
+    assert 'Unable to determine subject for result id 100' in str(excinfo.value)
+
+
+def test_refresh_latest_waivers_adds_missing_and_stale_rows(session):
+    recorded = create_waiver(session, subject={'type': 'koji_build', 'item': 'build-1'},
+                             testcase='testcase', username='foo', product_version='foo-1')
+    stale = create_waiver(session, subject={'type': 'koji_build', 'item': 'build-2'},
+                          testcase='testcase', username='foo', product_version='foo-1')
+    newer = create_waiver(session, subject={'type': 'koji_build', 'item': 'build-2'},
+                          testcase='testcase', username='foo', product_version='foo-1')
+    missing = create_waiver(session, subject={'type': 'koji_build', 'item': 'build-3'},
+                            testcase='testcase', username='foo', product_version='foo-1')
+    # As if the last two waivers were created by a release without waiver_latest.
+    session.execute(LatestWaiver.__table__.update()
+                    .where(LatestWaiver.waiver_id == newer.id)
+                    .values(waiver_id=stale.id, waiver_timestamp=stale.timestamp))
+    session.execute(LatestWaiver.__table__.delete().where(LatestWaiver.waiver_id == missing.id))
+    assert refresh_latest_waivers(session.connection()) == 2
+    assert refresh_latest_waivers(session.connection()) == 0
+    latest = LatestWaiver.query.order_by(LatestWaiver.waiver_id).all()
+    assert [row.waiver_id for row in latest] == [recorded.id, newer.id, missing.id]
+    assert [row.waiver_timestamp for row in latest] == \
+        [recorded.timestamp, newer.timestamp, missing.timestamp]
+
+
+def test_rebuild_latest_waivers_after_subjects_change(session):
+    first = create_waiver(session, subject={'placeholder': 'x'}, testcase='placeholder',
+                          username='foo', product_version='foo-1')
+    second = create_waiver(session, subject={'placeholder': 'x'}, testcase='placeholder',
+                           username='foo', product_version='foo-1')
+    # As backfill_subjects does, behind the back of the ORM.
+    session.execute(Waiver.__table__.update()
+                    .where(Waiver.id == second.id)
+                    .values(subject={'type': 'koji_build', 'item': 'build-1'},
+                            subject_hash=hash_subject({'type': 'koji_build', 'item': 'build-1'}),
+                            testcase='testcase'))
+    generation = WaiverGeneration.current(session)
+    rebuild_latest_waivers(session.connection())
+    assert WaiverGeneration.current(session) == generation + 1
+    latest = LatestWaiver.query.order_by(LatestWaiver.waiver_id).all()
+    assert [(row.waiver_id, row.testcase) for row in latest] == \
+        [(first.id, 'placeholder'), (second.id, 'testcase')]
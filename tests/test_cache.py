@@ -0,0 +1,57 @@
+# SPDX-License-Identifier: GPL-2.0+
+
+"""This module contains tests for :mod:`waiverdb.cache`."""
+from __future__ import unicode_literals
+
+import mock
+
+from waiverdb.cache import LRUCache
+
+
+def test_cache_evicts_least_recently_used():
+    cache = LRUCache(2, 60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+    assert cache.hits == 3
+    assert cache.misses == 1
+
+
+@mock.patch('waiverdb.cache.time.time')
+def test_cache_entries_expire(mock_time):
+    mock_time.return_value = 1000
+    cache = LRUCache(10, 60)
+    cache.set('a', 1)
+    cache.set('b', 2, ttl=120)
+    mock_time.return_value = 1061
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+
+
+def test_cache_is_cleared_when_generation_changes():
+    cache = LRUCache(10, 60)
+    cache.validate(1)
+    cache.set('a', 1)
+    cache.validate(1)
+    assert cache.get('a') == 1
+    cache.validate(2)
+    assert cache.get('a') is None
+
+
+def test_cache_ignores_older_generations():
+    cache = LRUCache(10, 60)
+    assert cache.validate(2)
+    cache.set('a', 1, generation=2)
+    # As seen from a read replica which is behind.
+    assert not cache.validate(1)
+    assert cache.get('a') == 1
+    cache.set('b', 2, generation=1)
+    assert cache.get('b') is None
+    assert cache.validate(3)
+    cache.set('c', 3, generation=2)
+    assert cache.get('c') is None
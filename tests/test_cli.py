@@ -1,9 +1,12 @@
 # SPDX-License-Identifier: GPL-2.0+
 import pytest
 import json
+import threading
+import click
+import requests
 from mock import Mock, patch
 from click.testing import CliRunner
-from waiverdb.cli import cli as waiverdb_cli
+from waiverdb.cli import cli as waiverdb_cli, per_thread, submit_batches
 
 
 def test_misconfigured_auth_method(tmpdir):
@@ -46,6 +49,29 @@ api_url=http://localhost:5004/api/v1.0
     assert result.output == 'Error: The config option "resultsdb_api_url" is required\n'
 
 
+def test_oidc_sends_waivers_from_file_one_request_at_a_time(tmpdir):
+    pytest.importorskip('openidc_client')
+    p = tmpdir.join('client.conf')
+    p.write("""
+[waiverdb]
+auth_method=OIDC
+api_url=http://localhost:5004/api/v1.0
+oidc_id_provider=https://id.stg.fedoraproject.org/openidc/
+oidc_client_id=waiverdb
+oidc_scopes=
+    openid
+resultsdb_api_url=http://localhost:5001/api/v2.0
+        """)
+    waivers = tmpdir.join('waivers.jsonl')
+    waivers.write('{"subject": {"type": "koji_build", "item": "foo"}, "testcase": "t1"}\n')
+    with patch('waiverdb.cli.submit_batches', return_value=False) as mock_submit:
+        runner = CliRunner()
+        result = runner.invoke(waiverdb_cli, ['-C', p.strpath, '-p', 'Parrot',
+                                              '-f', waivers.strpath, '--workers', '4'])
+    assert result.exit_code == 0, result.output
+    assert mock_submit.call_args[0][3] == 1
+
+
 def test_misconfigured_oidc_id_provider(tmpdir):
     p = tmpdir.join('client.conf')
     p.write("""
@@ -201,7 +227,7 @@ def test_gssapi_is_enabled(tmpdir):
     # Skip if waiverdb is rebuilt for an environment where OIDC authentication
     # is used and python-requests-gssapi is not available.
     pytest.importorskip('requests_gssapi')
-    with patch('requests.request') as mock_request:
+    with patch('requests.Session.request') as mock_request:
         mock_rv = Mock()
         mock_rv.json.return_value = {
             "comment": "It's dead!",
@@ -230,7 +256,7 @@ resultsdb_api_url=http://localhost:5001/api/v2.0
 
 
 def test_submit_waiver_with_id(tmpdir):
-    with patch('requests.request') as mock_request:
+    with patch('requests.Session.request') as mock_request:
         mock_rv = Mock()
         mock_rv.json.return_value = {
             "comment": "It's dead!",
@@ -259,7 +285,7 @@ resultsdb_api_url=http://localhost:5001/api/v2.0
 
 
 def test_submit_waiver_with_multiple_ids(tmpdir):
-    with patch('requests.request') as mock_request:
+    with patch('requests.Session.request') as mock_request:
         mock_rv = Mock()
         mock_rv.json.return_value = {
             "comment": "It's dead!",
@@ -304,7 +330,7 @@ resultsdb_api_url=http://localhost:5001/api/v2.0
 
 
 def test_submit_waiver_for_original_spec_nvr_result(tmpdir):
-    with patch('requests.request') as mock_request:
+    with patch('requests.Session.request') as mock_request:
         mock_rv = Mock()
         mock_rv.json.return_value = {
             "comment": "It's dead!",
@@ -330,3 +356,92 @@ resultsdb_api_url=http://localhost:5001/api/v2.0
         result = runner.invoke(waiverdb_cli, args)
         mock_request.assert_called()
         assert result.output == 'Created waiver 15 for result with id 123\n'
+
+
+def test_submit_waivers_from_file(tmpdir):
+    with patch('requests.Session.request') as mock_request:
+        mock_rv = Mock(ok=True)
+        mock_rv.json.return_value = [{"id": 15}, {"id": 16}]
+        mock_request.return_value = mock_rv
+        p = tmpdir.join('client.conf')
+        p.write("""
+[waiverdb]
+auth_method=dummy
+api_url=http://localhost:5004/api/v1.0
+resultsdb_api_url=http://localhost:5001/api/v2.0
+        """)
+        waivers = tmpdir.join('waivers.jsonl')
+        waivers.write(
+            '{"subject": {"item": "a", "type": "koji_build"}, "testcase": "dist.rpmlint"}\n'
+            '\n'
+            '{"subject": {"item": "b", "type": "koji_build"}, "testcase": "dist.rpmlint",'
+            ' "comment": "Also dead"}\n')
+        runner = CliRunner()
+        args = ['-C', p.strpath, '-p', 'Parrot', '-f', waivers.strpath, '-c', "It's dead!"]
+        result = runner.invoke(waiverdb_cli, args)
+        assert result.exit_code == 0
+        mock_request.assert_called_once()
+        sent = json.loads(mock_request.call_args[1]['data'])
+        assert [w['comment'] for w in sent] == ["It's dead!", 'Also dead']
+        assert all(w['product_version'] == 'Parrot' for w in sent)
+        assert result.output.splitlines()[-1] == 'Created 2 waivers, 0 failed'
+
+
+def test_submit_waivers_from_file_one_per_request(tmpdir):
+    with patch('requests.Session.request') as mock_request:
+        ok = Mock(ok=True)
+        ok.json.return_value = {"id": 15}
+        failed = Mock(ok=False)
+        failed.json.return_value = {"message": "Bad things"}
+        mock_request.side_effect = [ok, failed]
+        p = tmpdir.join('client.conf')
+        p.write("""
+[waiverdb]
+auth_method=dummy
+api_url=http://localhost:5004/api/v1.0
+resultsdb_api_url=http://localhost:5001/api/v2.0
+        """)
+        waivers = tmpdir.join('waivers.jsonl')
+        waivers.write('{"result_id": 123}\n{"result_id": 456}\n')
+        runner = CliRunner()
+        args = ['-C', p.strpath, '-p', 'Parrot', '-f', waivers.strpath,
+                '--batch-size', '1', '--workers', '1']
+        result = runner.invoke(waiverdb_cli, args)
+        assert result.exit_code == 1
+        assert mock_request.call_count == 2
+        assert 'Created waiver 15 for result with id 123' in result.output
+        assert 'Failed to create waiver for result with id 456:\nBad things' in result.output
+        assert 'Created 1 waivers, 1 failed' in result.output
+
+
+def test_submit_batches_raises_once_the_pool_is_done():
+    sent = []
+
+    def send(data):
+        sent.append(data['result_id'])
+        if data['result_id'] == 1:
+            raise click.ClickException('WaiverDB authentication using GSSAPI failed.')
+        return Mock(ok=True, json=Mock(return_value={'id': data['result_id']}))
+
+    with pytest.raises(click.ClickException) as excinfo:
+        submit_batches(send, [{'result_id': i} for i in range(4)], batch_size=1, workers=1)
+    assert 'authentication using GSSAPI failed' in str(excinfo.value)
+    # The batches after the failure are skipped.
+    assert sent == [0, 1]
+
+
+def test_per_thread_sessions_are_not_shared():
+    sessions = []
+
+    def get_session():
+        sessions.append(per_thread('session', requests.Session))
+
+    threads = [threading.Thread(target=get_session) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    get_session()
+    get_session()
+    assert sessions[0] is not sessions[1]
+    assert sessions[2] is sessions[3]
@@ -2,8 +2,12 @@
 
 """This module contains tests for :mod:`waiverdb.events`."""
 from __future__ import unicode_literals
+import json
 import mock
-from waiverdb.models import Waiver
+import pytest
+from sqlalchemy import event
+from waiverdb.events import enqueue_new_waiver, publish_outbox
+from waiverdb.models import Waiver, OutboxMessage
 
 
 @mock.patch('waiverdb.events.fedmsg')
@@ -63,3 +67,73 @@ def test_publish_new_waiver_with_fedmsg_for_proxy_user(mock_fedmsg, session):
             'timestamp': waiver.timestamp.isoformat(),
         }
     )
+
+
+@mock.patch('waiverdb.events.fedmsg')
+def test_publish_outbox_with_fedmsg(mock_fedmsg, session):
+    waiver = Waiver(
+        subject={'subject.test': 'subject'},
+        testcase='testcase1',
+        username='jcline',
+        product_version='something',
+        waived=True,
+        comment='This is a comment',
+    )
+    event.listen(Waiver, 'after_insert', enqueue_new_waiver)
+    try:
+        sesh = session()
+        sesh.add(waiver)
+        sesh.flush()
+    finally:
+        event.remove(Waiver, 'after_insert', enqueue_new_waiver)
+    assert OutboxMessage.query.count() == 1
+    assert publish_outbox() == 1
+    mock_fedmsg.publish.assert_called_once_with(
+        topic='waiver.new',
+        msg={
+            'id': waiver.id,
+            'subject': {'subject.test': 'subject'},
+            'testcase': 'testcase1',
+            'username': 'jcline',
+            'proxied_by': None,
+            'product_version': 'something',
+            'waived': True,
+            'comment': 'This is a comment',
+            'timestamp': waiver.timestamp.isoformat(),
+        }
+    )
+    assert OutboxMessage.query.count() == 0
+
+
+@mock.patch('waiverdb.events.fedmsg')
+def test_publish_outbox_keeps_failed_messages(mock_fedmsg, session):
+    sesh = session()
+    for i in range(3):
+        sesh.add(OutboxMessage(topic='waiver.new', body='{"id": %d}' % i))
+    sesh.flush()
+    mock_fedmsg.publish.side_effect = [None, RuntimeError('broker is down')]
+    with pytest.raises(RuntimeError):
+        publish_outbox()
+    remaining = OutboxMessage.query.order_by(OutboxMessage.id).all()
+    assert [json.loads(row.body)['id'] for row in remaining] == [1, 2]
+    assert remaining[0].attempts == 1
+    assert remaining[0].last_error == 'broker is down'
+
+
+@mock.patch('waiverdb.events.fedmsg')
+def test_publish_outbox_parks_messages_failing_too_often(mock_fedmsg, session, app, monkeypatch):
+    monkeypatch.setitem(app.config, 'OUTBOX_MAX_ATTEMPTS', 2)
+    sesh = session()
+    for i in range(2):
+        sesh.add(OutboxMessage(topic='waiver.new', body='{"id": %d}' % i))
+    sesh.flush()
+    mock_fedmsg.publish.side_effect = [RuntimeError('bad message'), RuntimeError('bad message'),
+                                       None]
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            publish_outbox()
+    assert publish_outbox() == 1
+    remaining = OutboxMessage.query.all()
+    assert [json.loads(row.body)['id'] for row in remaining] == [0]
+    assert remaining[0].attempts == 2
+    assert publish_outbox() == 0
@@ -0,0 +1,22 @@
+# SPDX-License-Identifier: GPL-2.0+
+
+import datetime
+import json
+from flask_restful import marshal
+from waiverdb.fields import waiver_fields, serialize_waiver
+from waiverdb.models import Waiver
+
+
+def test_serialize_waiver_matches_marshal():
+    waiver = Waiver({'type': 'koji_build', 'item': u'glibc-2.26-27.fc27'}, u'testcase1',
+                    u'jcline', u'fedora-27', waived=True, comment=u'It\u2019s fine',
+                    proxied_by=u'bodhi')
+    waiver.id = 42
+    waiver.timestamp = datetime.datetime(2018, 1, 2, 3, 4, 5, 678901)
+    assert serialize_waiver(waiver) == marshal(waiver, waiver_fields)
+    assert json.dumps(serialize_waiver(waiver)) == json.dumps(marshal(waiver, waiver_fields))
+
+
+def test_serialize_waiver_matches_marshal_for_unset_fields():
+    waiver = Waiver({'item': 'foo'}, 'testcase1', 'foo', 'fool-1')
+    assert json.dumps(serialize_waiver(waiver)) == json.dumps(marshal(waiver, waiver_fields))
@@ -2,7 +2,18 @@
 # SPDX-License-Identifier: GPL-2.0+
 
 from collections import OrderedDict
-from waiverdb.models import Waiver
+import datetime
+import json
+import threading
+import flask
+import mock
+import pytest
+from sqlalchemy.orm import Session
+from waiverdb.models import Waiver, LatestWaiver, WaiverGeneration
+from waiverdb.models.base import hash_subject
+from waiverdb.models.waivers import _server_has_jsonb
+from waiverdb.utils import explain
+from .utils import create_waiver
 
 
 # https://pagure.io/waiverdb/issue/134
@@ -27,3 +38,185 @@ def test_waiver_subject_json_serialization_is_consistent(db):
     query = Waiver.query.filter(Waiver.subject == {'item': nvr, 'type': 'koji_build'})
     # The query should select *both* the waivers above
     assert query.count() == 2
+
+
+def test_latest_waiver_is_updated_on_insert(session):
+    subject = {'item': 'python-requests-1.2.3-1.fc26', 'type': 'koji_build'}
+    old_waiver = create_waiver(session, subject=subject, testcase='dist.rpmlint',
+                               username='foo', product_version='fedora-26')
+    other_waiver = create_waiver(session, subject=subject, testcase='dist.rpmdeplint',
+                                 username='foo', product_version='fedora-26')
+    new_waiver = create_waiver(session, subject=subject, testcase='dist.rpmlint',
+                               username='foo', product_version='fedora-26', waived=False)
+    latest = LatestWaiver.query.order_by(LatestWaiver.waiver_id).all()
+    assert [row.waiver_id for row in latest] == [other_waiver.id, new_waiver.id]
+    assert old_waiver.id not in [row.waiver_id for row in latest]
+    assert [row.waiver_timestamp for row in latest] == \
+        [other_waiver.timestamp, new_waiver.timestamp]
+    query = Waiver.exclude_obsolete(Waiver.query.order_by(Waiver.id))
+    assert query.all() == [other_waiver, new_waiver]
+
+
+def test_waiver_without_timestamp_is_not_hidden_as_obsolete(session):
+    waiver = create_waiver(session, subject={'item': 'foo', 'type': 'koji_build'},
+                           testcase='dist.rpmlint', username='foo', product_version='fedora-26')
+    # As if inserted by hand, and recorded by migration c3f9b1d2e4a7.
+    session.execute(Waiver.__table__.update()
+                    .where(Waiver.id == waiver.id).values(timestamp=None))
+    session.execute(LatestWaiver.__table__.update()
+                    .where(LatestWaiver.waiver_id == waiver.id)
+                    .values(waiver_timestamp=datetime.datetime(1970, 1, 1)))
+    session.expire_all()
+    assert Waiver.exclude_obsolete(Waiver.query).all() == [waiver]
+
+
+def test_generation_advances_with_each_new_waiver(session):
+    generation = WaiverGeneration.current(session)
+    create_waiver(session, subject={'item': 'foo', 'type': 'koji_build'},
+                  testcase='dist.rpmlint', username='foo', product_version='fedora-26')
+    assert WaiverGeneration.current(session) == generation + 1
+
+
+def test_latest_waiver_concurrent_first_inserts(db):
+    subject = {'item': 'python-requests-1.2.3-1.fc26', 'type': 'koji_build'}
+    first = Session(bind=db.engine)
+    second = Session(bind=db.engine)
+    errors = []
+
+    def insert_second():
+        try:
+            second.add(Waiver(username='foo', waived=False, product_version='fedora-26',
+                              testcase='dist.concurrent', subject=subject))
+            second.commit()
+        except Exception as e:  # pylint: disable=W0703
+            errors.append(e)
+
+    try:
+        first.add(Waiver(username='foo', waived=True, product_version='fedora-26',
+                         testcase='dist.concurrent', subject=subject))
+        first.flush()
+        thread = threading.Thread(target=insert_second)
+        thread.start()
+        # The second transaction waits on the unique index of waiver_latest.
+        thread.join(1)
+        assert thread.is_alive()
+        first.commit()
+        thread.join()
+        assert errors == []
+        latest = db.engine.execute(
+            LatestWaiver.__table__.select()
+            .where(LatestWaiver.testcase == 'dist.concurrent')).fetchall()
+        newest = db.engine.execute(
+            'SELECT max(id) FROM waiver WHERE testcase = %s', 'dist.concurrent').scalar()
+        assert [row.waiver_id for row in latest] == [newest]
+    finally:
+        first.close()
+        second.close()
+        db.engine.execute("DELETE FROM waiver_latest WHERE testcase = 'dist.concurrent'")
+        db.engine.execute("DELETE FROM waiver WHERE testcase = 'dist.concurrent'")
+
+
+def test_waiver_subject_hash_is_independent_of_key_order(db):
+    nvr = 'python-requests-1.2.3-1.fc26'
+    subject = OrderedDict([('item', nvr), ('type', 'koji_build')])
+    equivalent_subject = OrderedDict([('type', 'koji_build'), ('item', nvr)])
+    waiver = Waiver(username='dcallagh', waived=True, comment='test', product_version='fedora-26',
+                    testcase='dist.rpmlint', subject=subject)
+    assert waiver.subject_hash == hash_subject(equivalent_subject)
+    assert len(waiver.subject_hash) == 32
+    waiver.subject = {'item': nvr, 'type': 'bodhi_update'}
+    assert waiver.subject_hash == hash_subject({'type': 'bodhi_update', 'item': nvr})
+
+
+def test_waivers_by_results_mixing_subjects_and_testcases(session):
+    matching = []
+    for i in range(100):
+        waiver = create_waiver(session, subject={'item': 'build-%d' % i, 'type': 'koji_build'},
+                               testcase='dist.rpmlint', username='foo',
+                               product_version='fedora-26')
+        if i % 10 == 0:
+            matching.append(waiver)
+    other = create_waiver(session, subject={'item': 'build-7', 'type': 'koji_build'},
+                          testcase='dist.rpmdeplint', username='foo',
+                          product_version='fedora-26')
+    matching.append(other)
+    results = [{'subject': {'type': 'koji_build', 'item': 'build-%d' % i},
+                'testcase': 'dist.rpmlint'} for i in range(0, 100, 10)]
+    results.append({'subject': {'type': 'koji_build', 'item': 'build-7'},
+                    'testcase': 'dist.rpmdeplint'})
+    results.append({'subject': {'type': 'koji_build', 'item': 'no-such-build'}})
+    query = Waiver.by_results(Waiver.query.order_by(Waiver.id), results)
+    assert query.all() == matching
+    query = Waiver.by_results(Waiver.query.order_by(Waiver.id),
+                              [{'subject': {'item': 'build-7', 'type': 'koji_build'}}])
+    assert [w.testcase for w in query.all()] == ['dist.rpmlint', 'dist.rpmdeplint']
+
+
+def test_subject_jsonb_index_is_only_created_on_servers_with_jsonb(db):
+    old = mock.Mock(dialect=mock.Mock(server_version_info=(9, 2, 24)))
+    assert not _server_has_jsonb(None, Waiver.__table__, old)
+    server_version = db.engine.dialect.server_version_info
+    indexes = [row[0] for row in db.engine.execute(
+        "SELECT indexname FROM pg_indexes WHERE tablename = 'waiver'")]
+    assert ('ix_waiver_subject_jsonb' in indexes) == (server_version >= (9, 4))
+
+
+def test_queries_are_routed_to_the_replica_bind(app, db, monkeypatch):
+    monkeypatch.setitem(app.config, 'SQLALCHEMY_BINDS',
+                        {'replica0': app.config['SQLALCHEMY_DATABASE_URI']})
+    primary = db.get_engine(app)
+    replica = db.get_engine(app, bind='replica0')
+    assert replica is not primary
+    with app.test_request_context('/api/v1.0/waivers/'):
+        assert db.engine is primary
+        flask.g.replica_bind = 'replica0'
+        assert db.engine is replica
+
+
+def plan_index_names(plan):
+    names = set()
+    if 'Index Name' in plan:
+        names.add(plan['Index Name'])
+    for subplan in plan.get('Plans', []):
+        names |= plan_index_names(subplan)
+    return names
+
+
+@pytest.mark.parametrize(('criterion', 'index'), [
+    (None, 'ix_waiver_timestamp_id'),
+    (Waiver.timestamp >= datetime.datetime(2018, 1, 1), 'ix_waiver_timestamp_id'),
+    (Waiver.product_version == 'fedora-27', 'ix_waiver_product_version_timestamp'),
+    (Waiver.username == 'user7', 'ix_waiver_username_timestamp'),
+    (Waiver.proxied_by == 'bodhi', 'ix_waiver_proxied_by_timestamp'),
+])
+@pytest.mark.parametrize('include_obsolete', [True, False])
+def test_waiver_filters_use_indexes(session, criterion, index, include_obsolete):
+    start = datetime.datetime(2017, 1, 1)
+    session.execute(Waiver.__table__.insert(), [{
+        'subject': {'type': 'koji_build', 'item': 'glibc-%d' % i},
+        'subject_hash': hash_subject({'type': 'koji_build', 'item': 'glibc-%d' % i}),
+        'testcase': 'dist.rpmdeplint',
+        'username': 'user%d' % (i % 50),
+        'proxied_by': 'bodhi' if i % 20 == 0 else None,
+        'product_version': 'fedora-%d' % (20 + i % 10),
+        'waived': True,
+        'timestamp': start + datetime.timedelta(hours=i),
+    } for i in range(5000)])
+    session.execute('INSERT INTO waiver_latest (subject, testcase, waiver_id, waiver_timestamp) '
+                    'SELECT subject, testcase, id, timestamp FROM waiver')
+    session.execute('ANALYZE waiver')
+    session.execute('ANALYZE waiver_latest')
+    # The table is small, so make sure the planner only falls back to a
+    # sequential scan if no index fits the query.
+    session.execute('SET LOCAL enable_seqscan = off')
+    # The query WaiversResource.get issues for the first page.
+    query = Waiver.query
+    if criterion is not None:
+        query = query.filter(criterion)
+    if not include_obsolete:
+        query = Waiver.exclude_obsolete(query)
+    query = query.order_by(Waiver.timestamp.desc()).limit(10)
+    plan = session.execute(explain(query.statement)).scalar()
+    if not isinstance(plan, list):
+        plan = json.loads(plan)
+    assert index in plan_index_names(plan[0]['Plan'])
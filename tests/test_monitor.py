@@ -0,0 +1,50 @@
+# SPDX-License-Identifier: GPL-2.0+
+
+import re
+import mock
+from waiverdb.monitor import parameter_shape
+
+
+def test_metrics(client, session):
+    r = client.get('/api/v1.0/waivers/')
+    assert r.status_code == 200
+    r = client.get('/metrics')
+    assert r.status_code == 200
+    body = r.get_data(as_text=True)
+    assert ('waiverdb_request_duration_seconds_count{endpoint="api_v1.waiversresource",'
+            'method="GET",status="200"}') in body
+    assert 'waiverdb_response_size_bytes_count{endpoint="api_v1.waiversresource"}' in body
+    assert 'waiverdb_request_db_queries_count{endpoint="api_v1.waiversresource"}' in body
+    assert 'waiverdb_db_pool_checkout_seconds_count' in body
+
+
+def test_query_stats_header(client, session, app, monkeypatch):
+    monkeypatch.setitem(app.config, 'QUERY_STATS_HEADER', True)
+    r = client.get('/api/v1.0/waivers/')
+    assert r.status_code == 200
+    assert re.match(r'^db;dur=[0-9.]+;desc="[1-9][0-9]* queries"$', r.headers['Server-Timing'])
+
+
+def test_no_query_stats_header_by_default(client, session):
+    r = client.get('/api/v1.0/waivers/')
+    assert 'Server-Timing' not in r.headers
+
+
+@mock.patch('waiverdb.monitor._log')
+def test_slow_queries_are_logged(mock_log, client, session, app, monkeypatch):
+    monkeypatch.setitem(app.config, 'SLOW_QUERY_THRESHOLD', 0)
+    r = client.get('/api/v1.0/waivers/?product_version=fool-1',
+                   headers={'X-Request-Id': 'abc123'})
+    assert r.status_code == 200
+    assert mock_log.warning.called
+    args = mock_log.warning.call_args[0]
+    assert args[2] == 'api_v1.waiversresource'
+    assert args[3] == 'abc123'
+    # Parameter values are not logged, only their types.
+    assert 'fool-1' not in args[5]
+
+
+def test_parameter_shape():
+    assert parameter_shape({'b': [1, 2, 3], 'a': 1.5}) == '{a: float, b: list[3]}'
+    assert parameter_shape([{'a': 1}, {'a': 2}], executemany=True) == '2 x {a: int}'
+    assert parameter_shape((1, (2, 3))) == '(int, tuple[2])'
@@ -0,0 +1,62 @@
+# SPDX-License-Identifier: GPL-2.0+
+
+import datetime
+import pytest
+from waiverdb.models import Waiver
+from waiverdb.partitions import (MINIMUM_SERVER_VERSION, month_start, next_month,
+                                 partition_name, is_partitioned, list_partitions,
+                                 create_partitions, partition_waiver_table, detach_partitions)
+from .utils import create_waiver
+
+
+def test_next_month():
+    assert next_month(datetime.datetime(2018, 3, 1)) == datetime.datetime(2018, 4, 1)
+    assert next_month(datetime.datetime(2018, 12, 1)) == datetime.datetime(2019, 1, 1)
+    assert partition_name(datetime.datetime(2018, 3, 1)) == 'waiver_p2018_03'
+
+
+def test_partition_waiver_table(db, session):
+    connection = db.get_engine()
+    if connection.dialect.server_version_info < MINIMUM_SERVER_VERSION:
+        pytest.skip('Partitioning needs PostgreSQL 11 or later')
+    subject = {'item': 'glibc-2.26-27.fc27', 'type': 'koji_build'}
+    old_waiver = create_waiver(session, subject=subject, testcase='dist.rpmlint',
+                               username='foo', product_version='fedora-27')
+    old_waiver.timestamp = datetime.datetime(2017, 11, 15)
+    new_waiver = create_waiver(session, subject=subject, testcase='dist.rpmlint',
+                               username='foo', product_version='fedora-27')
+    session.flush()
+    session.expunge_all()
+
+    partition_waiver_table(connection, months_ahead=1)
+    assert is_partitioned(connection)
+    names = [name for name, _ in list_partitions(connection)]
+    assert names[0] == 'waiver_p2017_11'
+    assert partition_name(datetime.datetime.utcnow()) in names
+    assert Waiver.query.count() == 2
+    assert Waiver.exclude_obsolete(Waiver.query).one().id == new_waiver.id
+
+    assert detach_partitions(connection, datetime.datetime(2017, 12, 1)) == ['waiver_p2017_11']
+    assert [w.id for w in Waiver.query] == [new_waiver.id]
+
+
+def test_create_partitions_moves_waivers_from_the_default_partition(db, session):
+    connection = db.get_engine()
+    if connection.dialect.server_version_info < MINIMUM_SERVER_VERSION:
+        pytest.skip('Partitioning needs PostgreSQL 11 or later')
+    partition_waiver_table(connection, months_ahead=0)
+    # A month without a partition yet.
+    month = next_month(next_month(month_start(datetime.datetime.utcnow())))
+    waiver = Waiver(subject={'item': 'glibc-2.27-1.fc28', 'type': 'koji_build'},
+                    testcase='dist.rpmlint', username='foo', product_version='fedora-28')
+    waiver.timestamp = month + datetime.timedelta(days=3)
+    session.add(waiver)
+    session.flush()
+    session.expunge_all()
+    assert connection.execute('SELECT count(*) FROM waiver_default').scalar() == 1
+
+    assert create_partitions(connection, month, next_month(month)) == [partition_name(month)]
+    assert connection.execute('SELECT count(*) FROM waiver_default').scalar() == 0
+    assert connection.execute(
+        'SELECT count(*) FROM {0}'.format(partition_name(month))).scalar() == 1
+    assert Waiver.exclude_obsolete(Waiver.query).one().id == waiver.id
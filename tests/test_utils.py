@@ -0,0 +1,90 @@
+# SPDX-License-Identifier: GPL-2.0+
+
+"""This module contains tests for :mod:`waiverdb.utils`."""
+from __future__ import unicode_literals
+
+import time
+
+import flask
+import mock
+
+from waiverdb.utils import StompConnectionManager, read_replica, LAST_WRITE_COOKIE
+
+STOMP_CONFIGS = {
+    'destination': '/topic/VirtualTopic.eng.waiverdb.waiver.new',
+    'connection': {'host_and_ports': [('broker01', 61612), ('broker02', 61612)]},
+    'credentials': {'username': 'waiverdb', 'password': 'secret'},
+}
+
+
+@mock.patch('waiverdb.utils.stomp.Connection')
+def test_stomp_connection_is_reused(mock_connection, app):
+    conn = mock_connection.return_value
+    conn.is_connected.return_value = True
+    manager = StompConnectionManager()
+    manager.send(STOMP_CONFIGS, body='one', destination='dest')
+    manager.send(STOMP_CONFIGS, body='two', destination='dest')
+    mock_connection.assert_called_once_with(
+        host_and_ports=[('broker01', 61612), ('broker02', 61612)])
+    conn.connect.assert_called_once_with(wait=True, username='waiverdb', password='secret')
+    assert conn.send.call_count == 2
+    assert conn.disconnect.call_count == 0
+
+
+@mock.patch('waiverdb.utils.stomp.Connection')
+def test_stomp_connection_waits_even_if_credentials_say_otherwise(mock_connection, app):
+    configs = dict(STOMP_CONFIGS, credentials={'username': 'waiverdb', 'wait': False})
+    manager = StompConnectionManager()
+    manager.send(configs, body='one', destination='dest')
+    mock_connection.return_value.connect.assert_called_once_with(wait=True, username='waiverdb')
+
+
+@mock.patch('waiverdb.utils.stomp.Connection')
+def test_stomp_connection_is_reestablished_when_dropped(mock_connection, app):
+    first, second = mock.Mock(), mock.Mock()
+    mock_connection.side_effect = [first, second]
+    first.is_connected.return_value = True
+    second.is_connected.return_value = True
+    manager = StompConnectionManager()
+    manager.send(STOMP_CONFIGS, body='one', destination='dest')
+    first.is_connected.return_value = False
+    manager.send(STOMP_CONFIGS, body='two', destination='dest')
+    second.send.assert_called_once_with(body='two', destination='dest')
+
+
+@mock.patch('waiverdb.utils.stomp.Connection')
+def test_stomp_send_is_retried_on_a_new_connection(mock_connection, app):
+    first, second = mock.Mock(), mock.Mock()
+    mock_connection.side_effect = [first, second]
+    first.is_connected.return_value = True
+    first.send.side_effect = IOError('Connection reset by peer')
+    manager = StompConnectionManager()
+    manager.send(STOMP_CONFIGS, body='one', destination='dest')
+    first.disconnect.assert_called_once_with()
+    second.send.assert_called_once_with(body='one', destination='dest')
+
+
+def test_read_replica_routes_reads_to_a_replica(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'REPLICA_DATABASE_URIS', ['postgresql:///a',
+                                                              'postgresql:///b'])
+    handler = read_replica(lambda: flask.g.get('replica_bind'))
+    with app.test_request_context('/api/v1.0/waivers/'):
+        assert handler() in ['replica0', 'replica1']
+
+
+def test_read_replica_without_replicas_uses_the_primary(app):
+    handler = read_replica(lambda: flask.g.get('replica_bind'))
+    with app.test_request_context('/api/v1.0/waivers/'):
+        assert handler() is None
+
+
+def test_read_replica_reads_your_writes(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'REPLICA_DATABASE_URIS', ['postgresql:///a'])
+    monkeypatch.setitem(app.config, 'REPLICA_READ_YOUR_WRITES', 10)
+    handler = read_replica(lambda: flask.g.get('replica_bind'))
+    headers = {'Cookie': '%s=%.3f' % (LAST_WRITE_COOKIE, time.time() - 5)}
+    with app.test_request_context('/api/v1.0/waivers/', headers=headers):
+        assert handler() is None
+    headers = {'Cookie': '%s=%.3f' % (LAST_WRITE_COOKIE, time.time() - 20)}
+    with app.test_request_context('/api/v1.0/waivers/', headers=headers):
+        assert handler() == 'replica0'
@@ -0,0 +1,25 @@
+# SPDX-License-Identifier: GPL-2.0+
+
+"""This module contains tests for :mod:`waiverdb.wsgi_gevent`."""
+
+import sys
+import mock
+import pytest
+
+
+def test_gevent_entry_point_makes_psycopg2_cooperative(monkeypatch):
+    pytest.importorskip('gevent')
+    psycogreen_gevent = pytest.importorskip('psycogreen.gevent')
+    import psycopg2.extensions
+    monkeypatch.delitem(sys.modules, 'waiverdb.wsgi_gevent', raising=False)
+    # Do not create another application, which would register its event
+    # handlers next to those of the one used by the other tests.
+    monkeypatch.setattr('waiverdb.app.create_app', mock.Mock())
+    previous_callback = psycopg2.extensions.get_wait_callback()
+    try:
+        import waiverdb.wsgi_gevent
+        assert psycopg2.extensions.get_wait_callback() is \
+            psycogreen_gevent.gevent_wait_callback
+        assert waiverdb.wsgi_gevent.app is waiverdb.app.create_app.return_value
+    finally:
+        psycopg2.extensions.set_wait_callback(previous_callback)
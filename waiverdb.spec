@@ -32,6 +32,8 @@ BuildRequires:  python2-flask-oidc
 BuildRequires:  python2-configparser
 BuildRequires:  python2-click
 BuildRequires:  python2-flask-migrate
+BuildRequires:  python2-prometheus_client
+BuildRequires:  python2-six
 BuildRequires:  stomppy
 %else # EPEL7 uses python- naming
 BuildRequires:  python-setuptools
@@ -48,6 +50,8 @@ BuildRequires:  python-flask-oidc
 BuildRequires:  python-click
 BuildRequires:  python-configparser
 BuildRequires:  python-flask-migrate
+BuildRequires:  python-prometheus_client
+BuildRequires:  python-six
 BuildRequires:  stomppy
 %endif
 BuildRequires:  fedmsg
@@ -71,6 +75,8 @@ Requires:       python2-flask-oidc
 Requires:       python2-click
 Requires:       python2-configparser
 Requires:       python2-flask-migrate
+Requires:       python2-prometheus_client
+Requires:       python2-six
 Requires:       stomppy
 %else
 Requires:       python-flask
@@ -85,6 +91,8 @@ Requires:       python-flask-oidc
 Requires:       python-click
 Requires:       python-configparser
 Requires:       python-flask-migrate
+Requires:       python-prometheus_client
+Requires:       python-six
 Requires:       stomppy
 %endif
 Requires:       fedmsg
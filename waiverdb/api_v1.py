@@ -1,21 +1,28 @@
 # SPDX-License-Identifier: GPL-2.0+
 
+import hashlib
 import json
+import time
+from multiprocessing.pool import ThreadPool
 
 import requests
 from flask import Blueprint, request, current_app
-from flask_restful import Resource, Api, reqparse, marshal_with, marshal
+from flask_restful import Resource, Api, reqparse
 from werkzeug.exceptions import BadRequest, UnsupportedMediaType, Forbidden, ServiceUnavailable
-from sqlalchemy.sql.expression import func, cast
 
 from waiverdb import __version__
-from waiverdb.models import db, Waiver
-from waiverdb.utils import reqparse_since, json_collection, jsonp
-from waiverdb.fields import waiver_fields
+from waiverdb.models import db, Waiver, WaiverGeneration
+from waiverdb.models.base import json_serializer
+from waiverdb.utils import (reqparse_since, json_collection, json_cursor_collection,
+                            json_stream_collection, jsonp, conditional, output_json,
+                            read_replica, remember_write, CircuitOpenError)
+from waiverdb.fields import serialize_waiver
+from waiverdb.monitor import resultsdb_request_duration
 import waiverdb.auth
 
 api_v1 = (Blueprint('api_v1', __name__))
 api = Api(api_v1)
+api.representations['application/json'] = output_json
 requests_session = requests.Session()
 
 
@@ -25,13 +32,128 @@ def valid_dict(value):
     return value
 
 
+def positive_int(value):
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        number = 0
+    if number < 1:
+        raise ValueError("Must be a positive integer, not %r" % value)
+    return number
+
+
+def _request_resultsdb_result(result_id):
+    """
+    Fetches a result from ResultsDB, retrying with exponential backoff on
+    connection errors, timeouts and server errors. Any other response is
+    returned as is.
+    """
+    retries = current_app.config['RESULTSDB_RETRIES']
+    for attempt in range(retries + 1):
+        start = time.time()
+        try:
+            response = requests_session.request('GET', '{0}/results/{1}'.format(
+                current_app.config['RESULTSDB_API_URL'], result_id),
+                headers={'Content-Type': 'application/json'},
+                timeout=current_app.config['RESULTSDB_TIMEOUT'])
+            resultsdb_request_duration.labels(str(response.status_code))\
+                .observe(time.time() - start)
+            if response.status_code < 500:
+                return response
+            response.raise_for_status()
+        except (requests.ConnectionError, requests.Timeout) as e:
+            resultsdb_request_duration.labels(type(e).__name__).observe(time.time() - start)
+            if attempt == retries:
+                raise
+        except requests.HTTPError:
+            if attempt == retries:
+                raise
+        time.sleep(current_app.config['RESULTSDB_RETRY_BACKOFF'] * 2 ** attempt)
+
+
 def get_resultsdb_result(result_id):
-    response = requests_session.request('GET', '{0}/results/{1}'.format(
-        current_app.config['RESULTSDB_API_URL'], result_id),
-        headers={'Content-Type': 'application/json'},
-        timeout=60)
+    # Results in ResultsDB never change, so they can be cached for as long
+    # as we like.
+    result = current_app.resultsdb_cache.get(result_id)
+    if result is not None:
+        return result
+    response = current_app.resultsdb_breaker.call(_request_resultsdb_result, result_id)
     response.raise_for_status()
-    return response.json()
+    result = response.json()
+    current_app.resultsdb_cache.set(result_id, result)
+    return result
+
+
+def get_resultsdb_results(result_ids):
+    """
+    Looks up several results in ResultsDB, with up to
+    RESULTSDB_CONCURRENT_LOOKUPS requests in flight and each distinct id
+    looked up once. Returns a dict mapping each id to its result, or to the
+    exception raised looking it up, for the caller to raise when it uses it.
+    """
+    app = current_app._get_current_object()  # pylint: disable=W0212
+
+    def lookup(result_id):
+        with app.app_context():
+            try:
+                return result_id, get_resultsdb_result(result_id)
+            except Exception as e:  # pylint: disable=W0703
+                return result_id, e
+
+    result_ids = set(result_ids)
+    if len(result_ids) < 2:
+        return dict(lookup(result_id) for result_id in result_ids)
+    pool = ThreadPool(min(len(result_ids), app.config['RESULTSDB_CONCURRENT_LOOKUPS']))
+    try:
+        return dict(pool.map(lookup, result_ids))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def subject_and_testcase_from_result(result):
+    """
+    Derives the waiver subject and testcase from a ResultsDB result.
+    Raises ValueError if the subject cannot be determined for the result.
+    """
+    if 'original_spec_nvr' in result['data']:
+        subject = {'original_spec_nvr': result['data']['original_spec_nvr'][0]}
+    else:
+        if result['data']['type'][0] == 'koji_build' or \
+           result['data']['type'][0] == 'bodhi_update':
+            SUBJECT_KEYS = ['item', 'type']
+            subject = dict([(k, v[0]) for k, v in result['data'].items()
+                            if k in SUBJECT_KEYS])
+        else:
+            raise ValueError('Unable to determine subject for result id %s' % result.get('id'))
+    return subject, result['testcase']['name']
+
+
+def collection_etag():
+    """
+    Entity tag for a waiver collection response. The response to a given
+    request can only change when waivers are created or rewritten, each of
+    which advances the :class:`WaiverGeneration` when it commits, so the
+    generation together with the request URL and body identifies it.
+
+    This is called before the response is built, so a change committed in
+    between can at worst make the next request miss its cached copy.
+    """
+    generation = WaiverGeneration.current(db.session)
+    digest = hashlib.md5()
+    digest.update(str(generation).encode('utf-8'))
+    digest.update(request.full_path.encode('utf-8'))
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+class JSONPayload(object):
+    """
+    Stands in for the request when running a request parser over one element
+    of a JSON array payload.
+    """
+    def __init__(self, json):
+        self.json = json
 
 
 # RP contains request parsers (reqparse.RequestParser).
@@ -48,6 +170,7 @@ RP['create_waiver'].add_argument('username', type=str, default=None, location='j
 
 RP['get_waivers'] = reqparse.RequestParser()
 RP['get_waivers'].add_argument('results', location='args')
+RP['get_waivers'].add_argument('subject_contains', location='args')
 RP['get_waivers'].add_argument('product_version', location='args')
 RP['get_waivers'].add_argument('username', location='args')
 RP['get_waivers'].add_argument('include_obsolete', type=bool, default=False, location='args')
@@ -55,11 +178,14 @@ RP['get_waivers'].add_argument('include_obsolete', type=bool, default=False, loc
 # be good to use two parameters(since and until).
 RP['get_waivers'].add_argument('since', location='args')
 RP['get_waivers'].add_argument('page', default=1, type=int, location='args')
-RP['get_waivers'].add_argument('limit', default=10, type=int, location='args')
+RP['get_waivers'].add_argument('limit', default=10, type=positive_int, location='args')
+RP['get_waivers'].add_argument('cursor', location='args')
 RP['get_waivers'].add_argument('proxied_by', location='args')
 
 
 class WaiversResource(Resource):
+    @read_replica
+    @conditional(collection_etag)
     @jsonp
     def get(self):
         """
@@ -93,10 +219,22 @@ class WaiversResource(Resource):
            }
 
 
-        :query int page: The page to get.
+        :query int page: The page to get. Depending on the server's
+            configuration, the ``last`` link may be null, or be estimated, in
+            which case ``last_is_estimate`` is true.
         :query int limit: Limit the number of items returned.
+        :query string cursor: Page through the waivers by cursor instead of by
+            page number. Pass an empty value to get the first page, then
+            follow the ``next`` link, which carries the cursor for the
+            following page. This is much faster than page numbers for walking
+            deep into the collection. In this mode ``prev`` and ``last`` are
+            always null.
         :query string results: Filter the waivers by result. Accepts a list of
             dictionaries, with one key 'subject' and one key 'testcase'.
+        :query string subject_contains: Filter the waivers by a JSON object
+            their subject must contain, e.g. ``{"item": "gzip-1.9-1.fc28"}``
+            matches waivers on that item whatever other keys the subject has.
+            Requires PostgreSQL 9.4 or later.
         :query string product_version: Filter the waivers by product version.
         :query string username: Filter the waivers by username.
         :query string proxied_by: Filter the waivers by the users who are
@@ -106,8 +244,12 @@ class WaiversResource(Resource):
             by a comma to retrieve a range (e.g. 2017-03-16T13:40:05+00:00,
             2017-03-16T13:40:15+00:00)
         :query boolean include_obsolete: If true, obsolete waivers will be included.
+        :reqheader If-None-Match: An ETag from a previous response to the same
+            request. If no waivers have been created since, 304 is returned.
+        :resheader ETag: Identifies this response for use in If-None-Match.
         :statuscode 200: If the query was valid and no problems were encountered.
             Note that the response may still contain 0 waivers.
+        :statuscode 304: The response has not changed since the given ETag.
         :statuscode 400: The request was malformed and could not be processed.
         """
         args = RP['get_waivers'].parse_args()
@@ -125,6 +267,14 @@ class WaiversResource(Resource):
                         raise BadRequest("'results' parameter should be a list \
                                       of dictionaries with subject and testcase")
             query = Waiver.by_results(query, results)
+        if args['subject_contains']:
+            try:
+                subject = json.loads(args['subject_contains'])
+            except ValueError:
+                subject = None
+            if not isinstance(subject, dict):
+                raise BadRequest("'subject_contains' parameter should be a JSON object")
+            query = Waiver.subject_contains(query, subject)
         if args['product_version']:
             query = query.filter(Waiver.product_version == args['product_version'])
         if args['username']:
@@ -143,18 +293,23 @@ class WaiversResource(Resource):
             if since_end:
                 query = query.filter(Waiver.timestamp <= since_end)
         if not args['include_obsolete']:
-            subquery = db.session.query(func.max(Waiver.id)).group_by(cast(Waiver.subject, db.Text),
-                                                                      Waiver.testcase)
-            query = query.filter(Waiver.id.in_(subquery))
+            query = Waiver.exclude_obsolete(query)
+        if args['cursor'] is not None:
+            return json_cursor_collection(query, args['cursor'], args['limit'],
+                                          Waiver.timestamp, Waiver.id)
         query = query.order_by(Waiver.timestamp.desc())
         return json_collection(query, args['page'], args['limit'])
 
     @jsonp
-    @marshal_with(waiver_fields)
     def post(self):
         """
         Create a new waiver.
 
+        The request body may also be a JSON array of waivers, in which case
+        they are all created in a single transaction (either all of them or
+        none) and the response is an array of the created waivers, in the
+        same order.
+
         **Sample request**:
 
         .. sourcecode:: http
@@ -207,10 +362,43 @@ class WaiversResource(Resource):
         :json string comment: A comment explaining the waiver.
         :json string username: Username on whose behalf the caller is proxying.
         :statuscode 201: The waiver was successfully created.
+        :statuscode 400: The request was malformed and no waivers were created.
         """
 
         user, headers = waiverdb.auth.get_user(request)
+        if isinstance(request.get_json(silent=True), list):
+            payload = request.get_json()
+            if not payload:
+                raise BadRequest('No waivers given.')
+            # Every waiver is validated before any is added, so a bad entry
+            # rejects the whole request and nothing is created.
+            parsed = []
+            for item in payload:
+                if not isinstance(item, dict):
+                    raise BadRequest('Each waiver must be a JSON object, not %r' % item)
+                parsed.append(RP['create_waiver'].parse_args(req=JSONPayload(item)))
+            results = get_resultsdb_results(
+                [args['result_id'] for args in parsed
+                 if args['result_id'] and not (args['subject'] or args['testcase'])])
+            waivers = [self._create_waiver(args, user, results) for args in parsed]
+            db.session.add_all(waivers)
+            db.session.commit()
+            remember_write()
+            return [serialize_waiver(waiver) for waiver in waivers], 201, headers
+
         args = RP['create_waiver'].parse_args()
+        waiver = self._create_waiver(args, user)
+        db.session.add(waiver)
+        db.session.commit()
+        remember_write()
+        return serialize_waiver(waiver), 201, headers
+
+    def _create_waiver(self, args, user, results=None):
+        """
+        Builds a waiver from the parsed request arguments. ``results`` may map
+        result ids to their ResultsDB results, or to the exception raised
+        looking them up, as returned by :func:`get_resultsdb_results`.
+        """
         proxied_by = None
         if args.get('username'):
             if user not in current_app.config['SUPERUSERS']:
@@ -224,43 +412,39 @@ class WaiversResource(Resource):
                 raise BadRequest('Only result_id or subject and '
                                  'testcase are allowed.  Not both.')
             try:
-                result = get_resultsdb_result(args['result_id'])
+                result = (results or {}).get(args['result_id'])
+                if result is None:
+                    result = get_resultsdb_result(args['result_id'])
+                elif isinstance(result, Exception):
+                    raise result
             except requests.HTTPError as e:
                 if e.response.status_code == 404:
                     raise BadRequest('Result id not found in Resultsdb')
                 else:
                     raise ServiceUnavailable('Failed looking up result in Resultsdb: %s' % e)
+            except CircuitOpenError as e:
+                raise ServiceUnavailable('Not looking up result in Resultsdb, '
+                                         'which keeps failing: %s' % e)
             except Exception as e:
                 raise ServiceUnavailable('Failed looking up result in Resultsdb: %s' % e)
-            if 'original_spec_nvr' in result['data']:
-                subject = {'original_spec_nvr': result['data']['original_spec_nvr'][0]}
-            else:
-                if result['data']['type'][0] == 'koji_build' or \
-                   result['data']['type'][0] == 'bodhi_update':
-                    SUBJECT_KEYS = ['item', 'type']
-                    subject = dict([(k, v[0]) for k, v in result['data'].items()
-                                    if k in SUBJECT_KEYS])
-                else:
-                    raise BadRequest('It is not possible to submit a waiver by '
-                                     'id for this result. Please try again specifying '
-                                     'a subject and a testcase.')
-            args['subject'] = subject
-            args['testcase'] = result['testcase']['name']
+            try:
+                args['subject'], args['testcase'] = subject_and_testcase_from_result(result)
+            except ValueError:
+                raise BadRequest('It is not possible to submit a waiver by '
+                                 'id for this result. Please try again specifying '
+                                 'a subject and a testcase.')
 
         if not args['subject'] or not args['testcase']:
             raise BadRequest('Either result_id or subject/testcase '
                              'are required arguments.')
 
-        waiver = Waiver(args['subject'], args['testcase'], user,
-                        args['product_version'], args['waived'], args['comment'], proxied_by)
-        db.session.add(waiver)
-        db.session.commit()
-        return waiver, 201, headers
+        return Waiver(args['subject'], args['testcase'], user,
+                      args['product_version'], args['waived'], args['comment'], proxied_by)
 
 
 class WaiverResource(Resource):
+    @read_replica
     @jsonp
-    @marshal_with(waiver_fields)
     def get(self, waiver_id):
         """
         Get a single waiver by waiver ID.
@@ -271,12 +455,14 @@ class WaiverResource(Resource):
         :statuscode 404: No waiver exists with that ID.
         """
         try:
-            return Waiver.query.get_or_404(waiver_id)
+            return serialize_waiver(Waiver.query.get_or_404(waiver_id))
         except Exception as NotFound:
             raise type(NotFound)('Waiver not found')
 
 
 class GetWaiversBySubjectsAndTestcases(Resource):
+    @read_replica
+    @conditional(collection_etag)
     @jsonp
     def post(self):
         """
@@ -351,6 +537,8 @@ class GetWaiversBySubjectsAndTestcases(Resource):
 
         :jsonparam array results: Filter the waivers by a list of dictionaries
             with result subjects and testcase.
+        :jsonparam object subject_contains: Filter the waivers by an object
+            their subject must contain. Requires PostgreSQL 9.4 or later.
         :jsonparam string product_version: Filter the waivers by product version.
         :jsonparam string username: Filter the waivers by username.
         :jsonparam string proxied_by: Filter the waivers by the users who are
@@ -360,8 +548,12 @@ class GetWaiversBySubjectsAndTestcases(Resource):
             by a comma to retrieve a range (e.g. 2017-03-16T13:40:05+00:00,
             2017-03-16T13:40:15+00:00)
         :jsonparam boolean include_obsolete: If true, obsolete waivers will be included.
+        :reqheader If-None-Match: An ETag from a previous response to the same
+            request. If no waivers have been created since, 304 is returned.
+        :resheader ETag: Identifies this response for use in If-None-Match.
         :statuscode 200: If the query was valid and no problems were encountered.
             Note that the response may still contain 0 waivers.
+        :statuscode 304: The response has not changed since the given ETag.
         """
         if not request.get_json():
             raise UnsupportedMediaType('No JSON payload in request')
@@ -377,7 +569,10 @@ class GetWaiversBySubjectsAndTestcases(Resource):
                     if not isinstance(d.get('testcase', None), basestring):
                         raise BadRequest("'results' parameter should be a list \
                                           of dictionaries with subject and testcase")
-            query = Waiver.by_results(query, data['results'])
+        if 'subject_contains' in data:
+            if not isinstance(data['subject_contains'], dict):
+                raise BadRequest("'subject_contains' parameter should be a JSON object")
+            query = Waiver.subject_contains(query, data['subject_contains'])
         if 'product_version' in data:
             query = query.filter(Waiver.product_version == data['product_version'])
         if 'username' in data:
@@ -396,12 +591,58 @@ class GetWaiversBySubjectsAndTestcases(Resource):
             if since_end:
                 query = query.filter(Waiver.timestamp <= since_end)
         if not data.get('include_obsolete', False):
-            subquery = db.session.query(func.max(Waiver.id)).group_by(cast(Waiver.subject, db.Text),
-                                                                      Waiver.testcase)
-            query = query.filter(Waiver.id.in_(subquery))
+            query = Waiver.exclude_obsolete(query)
 
         query = query.order_by(Waiver.timestamp.desc())
-        return {'data': marshal(query.all(), waiver_fields)}
+        if data.get('results') and current_app.results_cache is not None and \
+                all(d.get('subject', None) for d in data['results']):
+            filters = dict((key, data.get(key)) for key in
+                           ['subject_contains', 'product_version', 'username',
+                            'proxied_by', 'since', 'include_obsolete'])
+            return {'data': self._get_cached(query, data['results'], json_serializer(filters))}
+        if data.get('results'):
+            query = Waiver.by_results(query, data['results'])
+        # JSONP responses are built by wrapping a dict, so they cannot stream.
+        if current_app.config['STREAM_LOOKUP_RESPONSES'] and not request.args.get('callback'):
+            return json_stream_collection(query)
+        return {'data': [serialize_waiver(waiver) for waiver in query]}
+
+    def _get_cached(self, query, results, filters):
+        """
+        Looks up the marshalled waivers for each result in the results cache,
+        and queries the database only for the results which are not cached.
+
+        The cache is tied to the :class:`WaiverGeneration`, which advances
+        whenever waivers are created or rewritten, in any process, so cached
+        entries are never staler than the database as this request sees it.
+        If this request reads from a read replica which lags behind the
+        generation of the cache, the cache is bypassed rather than cleared.
+        """
+        cache = current_app.results_cache
+        generation = WaiverGeneration.current(db.session)
+        if not cache.validate(generation):
+            return [serialize_waiver(waiver) for waiver in Waiver.by_results(query, results)]
+        waivers = {}
+        missing = []
+        for d in results:
+            key = (json_serializer(d['subject']), d.get('testcase', None) or None, filters)
+            cached = cache.get(key)
+            if cached is None:
+                missing.append((key, d))
+            else:
+                waivers.update((w['id'], w) for w in cached)
+        if missing:
+            found = dict((key, []) for key, _ in missing)
+            for waiver in Waiver.by_results(query, [d for _, d in missing]):
+                marshalled = serialize_waiver(waiver)
+                subject = json_serializer(waiver.subject)
+                for key in [(subject, waiver.testcase, filters), (subject, None, filters)]:
+                    if key in found:
+                        found[key].append(marshalled)
+            for key, value in found.items():
+                cache.set(key, value, generation=generation)
+                waivers.update((w['id'], w) for w in value)
+        return sorted(waivers.values(), key=lambda w: (w['timestamp'], w['id']), reverse=True)
 
 
 class AboutResource(Resource):
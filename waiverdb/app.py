@@ -7,11 +7,13 @@ from flask import Flask
 from flask_migrate import Migrate
 from sqlalchemy import event
 
-from waiverdb.events import publish_new_waiver
+from waiverdb.cache import LRUCache
+from waiverdb.events import publish_new_waiver, enqueue_new_waiver, invalidate_results_cache
 from waiverdb.logger import init_logging
 from waiverdb.api_v1 import api_v1
-from waiverdb.models import db
-from waiverdb.utils import json_error
+from waiverdb.models import db, Waiver
+from waiverdb.monitor import init_metrics, register_query_instrumentation
+from waiverdb.utils import json_error, CircuitBreaker, read_replica
 from flask_oidc import OpenIDConnect
 from werkzeug.exceptions import default_exceptions
 from requests import ConnectionError, Timeout
@@ -35,11 +37,8 @@ def load_config(app):
         app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
 
 
-def populate_db_config(app):
-    # Take the application-level DATABASE_URI setting, plus (optionally)
-    # a DATABASE_PASSWORD from the environment, and munge them together into
-    # the SQLALCHEMY_DATABASE_URI setting which is obeyed by Flask-SQLAlchemy.
-    dburi = app.config['DATABASE_URI']
+def add_db_password(dburi):
+    # Add the DATABASE_PASSWORD from the environment, if any, to the URI.
     if os.environ.get('DATABASE_PASSWORD'):
         parsed = urlparse.urlparse(dburi)
         netloc = '{}:{}@{}'.format(parsed.username,
@@ -49,9 +48,22 @@ def populate_db_config(app):
             netloc += ':{}'.format(parsed.port)
         dburi = urlparse.urlunsplit(
             (parsed.scheme, netloc, parsed.path, parsed.query, parsed.fragment))
+    return dburi
+
+
+def populate_db_config(app):
+    # Take the application-level DATABASE_URI setting, plus (optionally)
+    # a DATABASE_PASSWORD from the environment, and munge them together into
+    # the SQLALCHEMY_DATABASE_URI setting which is obeyed by Flask-SQLAlchemy.
+    # Read replicas become the binds replica0, replica1 and so on.
+    dburi = add_db_password(app.config['DATABASE_URI'])
     if app.config['SHOW_DB_URI']:
         app.logger.debug('using DBURI: %s', dburi)
     app.config['SQLALCHEMY_DATABASE_URI'] = dburi
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    for i, replica_uri in enumerate(app.config['REPLICA_DATABASE_URIS']):
+        binds['replica%d' % i] = add_db_password(replica_uri)
+    app.config['SQLALCHEMY_BINDS'] = binds
 
 
 # applicaiton factory http://flask.pocoo.org/docs/0.12/patterns/appfactories/
@@ -73,6 +85,17 @@ def create_app(config_obj=None):
     populate_db_config(app)
     if app.config['AUTH_METHOD'] == 'OIDC':
         app.oidc = OpenIDConnect(app)
+        app.oidc_token_cache = LRUCache(app.config['OIDC_TOKEN_CACHE_SIZE'],
+                                        app.config['OIDC_TOKEN_CACHE_TTL'])
+    if app.config['RESULTS_CACHE_SIZE']:
+        app.results_cache = LRUCache(app.config['RESULTS_CACHE_SIZE'],
+                                     app.config['RESULTS_CACHE_TTL'])
+    else:
+        app.results_cache = None
+    app.resultsdb_cache = LRUCache(app.config['RESULTSDB_CACHE_SIZE'],
+                                   app.config['RESULTSDB_CACHE_TTL'])
+    app.resultsdb_breaker = CircuitBreaker(app.config['RESULTSDB_BREAKER_THRESHOLD'],
+                                           app.config['RESULTSDB_BREAKER_RESET'])
     # initialize db
     db.init_app(app)
     # initialize db migrations
@@ -84,10 +107,20 @@ def create_app(config_obj=None):
     # register blueprints
     app.register_blueprint(api_v1, url_prefix="/api/v1.0")
     app.add_url_rule('/healthcheck', view_func=healthcheck)
+    if app.config['METRICS']:
+        # Connections to the read replicas come from pools of their own.
+        engines = dict((bind, db.get_engine(app, bind=bind))
+                       for bind in app.config['SQLALCHEMY_BINDS'])
+        engines['primary'] = db.get_engine(app)
+        init_metrics(app, engines)
     register_event_handlers(app)
+    if app.config['METRICS'] or app.config['QUERY_STATS_HEADER'] or \
+            app.config['SLOW_QUERY_THRESHOLD'] is not None:
+        register_query_instrumentation(app)
     return app
 
 
+@read_replica
 def healthcheck():
     """
     Request handler for performing an application-level health check. This is
@@ -110,8 +143,13 @@ def register_event_handlers(app):
         app (flask.Flask): The Flask object with the configured scoped session
             attached as the ``session`` attribute.
     """
-    if app.config['MESSAGE_BUS_PUBLISH']:
+    if app.config['MESSAGE_BUS_PUBLISH'] and app.config['MESSAGE_OUTBOX']:
+        event.listen(Waiver, 'after_insert', enqueue_new_waiver)
+    elif app.config['MESSAGE_BUS_PUBLISH']:
         # A workaround for https://github.com/mitsuhiko/flask-sqlalchemy/pull/364
         # can be removed after python-flask-sqlalchemy is upgraded to 2.2
         from flask_sqlalchemy import SignallingSession
         event.listen(SignallingSession, 'after_commit', publish_new_waiver)
+    if app.results_cache is not None:
+        from flask_sqlalchemy import SignallingSession
+        event.listen(SignallingSession, 'after_commit', invalidate_results_cache)
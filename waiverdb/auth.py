@@ -2,7 +2,9 @@
 
 
 import base64
+import hashlib
 import os
+import time
 import gssapi
 from flask import current_app, Response, g
 # Starting with Flask 0.9, the _app_ctx_stack is the correct one,
@@ -11,23 +13,77 @@ try:
     from flask import _app_ctx_stack as stack
 except ImportError:
     from flask import _request_ctx_stack as stack
-from socket import gethostname
+from itsdangerous import URLSafeTimedSerializer, BadSignature
 from werkzeug.exceptions import Unauthorized, Forbidden
+from werkzeug.http import dump_cookie
+
+SESSION_COOKIE_SALT = 'waiverdb-kerberos-session'
+
+# Acceptor credentials, keyed by the KERBEROS_HTTP_HOST setting they were
+# acquired for, together with the time they were acquired. They are acquired
+# again after ACCEPTOR_CREDENTIALS_TTL seconds, or after a failed
+# negotiation, so that a rotated keytab is picked up without a restart.
+_acceptor_credentials = {}
+ACCEPTOR_CREDENTIALS_TTL = 600
+
+
+def get_acceptor_credentials():
+    configured_host = current_app.config['KERBEROS_HTTP_HOST']
+    acquired, creds = _acceptor_credentials.get(configured_host, (None, None))
+    if acquired is None or acquired + ACCEPTOR_CREDENTIALS_TTL < time.time():
+        if configured_host:
+            service_name = gssapi.Name("HTTP@%s" % configured_host,
+                                       gssapi.NameType.hostbased_service)
+            creds = gssapi.Credentials(name=service_name, usage='accept')
+        else:
+            # Accept any service principal in the keytab, as when no
+            # credentials are given, so that clients which reached this host
+            # through a load balancer or a CNAME can still authenticate.
+            creds = gssapi.Credentials(usage='accept')
+        _acceptor_credentials[configured_host] = (time.time(), creds)
+    return creds
+
+
+def session_serializer():
+    return URLSafeTimedSerializer(current_app.config['SECRET_KEY'], salt=SESSION_COOKIE_SALT)
+
+
+def get_session_user(request):
+    """
+    Returns the user from a valid session cookie issued after an earlier
+    Kerberos authentication, or None.
+    """
+    cookie = request.cookies.get(current_app.config['KERBEROS_SESSION_COOKIE_NAME'])
+    if not cookie:
+        return None
+    try:
+        return session_serializer().loads(
+            cookie, max_age=current_app.config['KERBEROS_SESSION_LIFETIME'])['user']
+    except (BadSignature, KeyError, TypeError):
+        return None
+
+
+def session_cookie_header(user):
+    cookie = dump_cookie(current_app.config['KERBEROS_SESSION_COOKIE_NAME'],
+                         session_serializer().dumps({'user': user}),
+                         max_age=current_app.config['KERBEROS_SESSION_LIFETIME'],
+                         path=current_app.config['APPLICATION_ROOT'] or '/',
+                         secure=current_app.config['PRODUCTION'], httponly=True)
+    # The cookie authenticates requests which create waivers, so browsers
+    # must not send it with requests made from other sites. (Older releases
+    # of werkzeug have no samesite argument.)
+    return cookie + '; SameSite=Strict'
+
 
 # Inspired by https://github.com/mkomitee/flask-kerberos/blob/master/flask_kerberos.py
 # Later cleaned and ported to python-gssapi
 def process_gssapi_request(token):
-    if current_app.config['KERBEROS_HTTP_HOST']:
-        hostname = current_app.config['KERBEROS_HTTP_HOST']
-    else:
-        hostname = gethostname()
-
-    service_name = gssapi.Name("HTTP@%s" % hostname,
-                               gssapi.NameType.hostbased_service)
-
     try:
+        stage = "acquire acceptor credentials"
+        creds = get_acceptor_credentials()
+
         stage = "initialize server context"
-        sc = gssapi.SecurityContext(usage="accept")
+        sc = gssapi.SecurityContext(creds=creds, usage="accept")
 
         stage = "step context"
         token = sc.step(token if token != "" else None)
@@ -46,6 +102,7 @@ def process_gssapi_request(token):
         user = str(sc.initiator_name)
         return user, token
     except gssapi.exceptions.GSSError as e:
+        _acceptor_credentials.pop(current_app.config['KERBEROS_HTTP_HOST'], None)
         current_app.logger.error(
             'Unable to authenticate: failed to %s: %s' %
             (stage, e.gen_msg()))
@@ -67,11 +124,29 @@ def get_user(request):
             'openid',
             current_app.config['OIDC_REQUIRED_SCOPE'],
         ]
-        validity = current_app.oidc.validate_token(token, required_scopes)
-        if validity is not True:
-            raise Unauthorized(validity)
-        user = g.oidc_token_info['username']
+        # Validating a token costs a round trip to the identity provider, so
+        # the outcome is cached, keyed by a hash so tokens are not kept in
+        # memory, for no longer than the token itself is valid.
+        cache_key = hashlib.sha256(' '.join([token] + required_scopes).encode('utf-8')).hexdigest()
+        token_info = current_app.oidc_token_cache.get(cache_key)
+        if token_info is None:
+            validity = current_app.oidc.validate_token(token, required_scopes)
+            if validity is not True:
+                raise Unauthorized(validity)
+            token_info = g.oidc_token_info
+            ttl = current_app.config['OIDC_TOKEN_CACHE_TTL']
+            if 'exp' in token_info:
+                ttl = min(ttl, token_info['exp'] - time.time())
+            if ttl > 0:
+                current_app.oidc_token_cache.set(cache_key, token_info, ttl=ttl)
+        else:
+            g.oidc_token_info = token_info
+        user = token_info['username']
     elif current_app.config['AUTH_METHOD'] == 'Kerberos':
+        if current_app.config['KERBEROS_SESSION_LIFETIME']:
+            user = get_session_user(request)
+            if user is not None:
+                return user, headers
         if 'Authorization' not in request.headers:
             response = Response('Unauthorized', 401, {'WWW-Authenticate': 'Negotiate'})
             raise Unauthorized(response=response)
@@ -82,6 +157,8 @@ def get_user(request):
         user = user.split("@")[0]
         headers = {'WWW-Authenticate': ' '.join(
             ['negotiate', base64.b64encode(token).decode()])}
+        if current_app.config['KERBEROS_SESSION_LIFETIME']:
+            headers['Set-Cookie'] = session_cookie_header(user)
     elif current_app.config['AUTH_METHOD'] == 'SSL':
         # Nginx sets SSL_CLIENT_VERIFY and SSL_CLIENT_S_DN in request.environ
         # when doing SSL authentication.
@@ -0,0 +1,175 @@
+# SPDX-License-Identifier: GPL-2.0+
+"""
+Derives waiver subjects and testcases from the ResultsDB results referenced
+by their ``result_id``.
+
+Only the columns of the ``waiver`` table which existed when subjects were
+introduced are used, so this works both before migration ``71b84ccc31bb``
+(which calls it to convert the old records) and on current databases.
+"""
+
+import logging
+from multiprocessing.pool import ThreadPool
+
+import requests
+import sqlalchemy as sa
+from flask import current_app
+
+from waiverdb.api_v1 import get_resultsdb_result, subject_and_testcase_from_result
+from waiverdb.models.base import json_serializer, hash_subject
+from waiverdb.models.waivers import advance_generation
+
+_log = logging.getLogger(__name__)
+
+waiver_table = sa.table(
+    'waiver',
+    sa.column('id', sa.Integer),
+    sa.column('result_id', sa.Integer),
+    sa.column('subject', sa.Text),
+    sa.column('testcase', sa.Text),
+    sa.column('subject_hash', sa.String),
+)
+
+
+def convert_id_to_subject_and_testcase(result_id):
+    try:
+        result = get_resultsdb_result(result_id)
+    except requests.HTTPError as e:
+        if e.response.status_code == 404:
+            raise RuntimeError('Result id %s not found in Resultsdb' % (result_id))
+        else:
+            raise RuntimeError('Failed looking up result in Resultsdb: %s' % e)
+    except Exception as e:
+        raise RuntimeError('Failed looking up result in Resultsdb: %s' % e)
+    try:
+        return subject_and_testcase_from_result(result)
+    except ValueError:
+        raise RuntimeError('Unable to determine subject for result id %s' % (result_id))
+
+
+def backfill_subjects(connection, chunk_size=1000, workers=8, start_id=0, only_missing=False,
+                      progress=None):
+    """
+    Sets the subject and testcase of every waiver with a result_id, by
+    looking up its result in ResultsDB.
+
+    Waivers are processed in chunks of ``chunk_size`` in id order. The
+    results of a chunk are looked up concurrently by ``workers`` threads,
+    and each chunk is written in its own transaction, so an interrupted run
+    keeps the chunks it completed and can be resumed by passing the last
+    completed id as ``start_id``.
+
+    Args:
+        connection (sqlalchemy.engine.Connection): The database connection.
+            It must not be in a transaction already, or the chunks are only
+            committed together with it.
+        only_missing (bool): Skip waivers which already have a subject.
+        progress (callable): Called with the last waiver id of each chunk
+            and the number of waivers in it, after the chunk is committed.
+
+    Returns:
+        int: The id of the last waiver processed.
+    """
+    app = current_app._get_current_object()  # pylint: disable=W0212
+    columns = [c['name'] for c in sa.inspect(connection).get_columns('waiver')]
+    has_subject_hash = 'subject_hash' in columns
+    has_generation = connection.dialect.has_table(connection, 'waiver_generation')
+
+    def resolve(row):
+        with app.app_context():
+            return row.id, convert_id_to_subject_and_testcase(row.result_id)
+
+    pool = ThreadPool(workers)
+    last_id = start_id
+    try:
+        while True:
+            query = sa.select([waiver_table.c.id, waiver_table.c.result_id])\
+                .where(waiver_table.c.result_id.isnot(None))\
+                .where(waiver_table.c.id > last_id)\
+                .order_by(waiver_table.c.id)\
+                .limit(chunk_size)
+            if only_missing:
+                query = query.where(waiver_table.c.subject.is_(None))
+            rows = connection.execute(query).fetchall()
+            if not rows:
+                break
+            resolved = pool.map(resolve, rows)
+            with connection.begin():
+                if has_generation:
+                    advance_generation(connection)
+                for waiver_id, (subject, testcase) in resolved:
+                    values = dict(subject=json_serializer(subject), testcase=testcase)
+                    if has_subject_hash:
+                        values['subject_hash'] = hash_subject(subject)
+                    connection.execute(waiver_table.update()
+                                       .where(waiver_table.c.id == waiver_id)
+                                       .values(**values))
+            last_id = rows[-1].id
+            _log.debug('Backfilled subjects up to waiver %s', last_id)
+            if progress is not None:
+                progress(last_id, len(rows))
+    finally:
+        pool.close()
+        pool.join()
+    return last_id
+
+
+def rebuild_latest_waivers(connection):
+    """
+    Brings the waiver_latest table up to date after subjects or testcases of
+    existing waivers have been changed: rows recording a waiver under the
+    subject and testcase it used to have are removed, and the rows for their
+    new ones are added or updated as by :func:`refresh_latest_waivers`.
+
+    The waiver generation is advanced first, which makes waivers being
+    created concurrently wait for this to commit, and every row which is not
+    stale is kept, so readers never see pairs missing from the table.
+    """
+    with connection.begin():
+        advance_generation(connection)
+        connection.execute(
+            'DELETE FROM waiver_latest USING waiver '
+            'WHERE waiver.id = waiver_latest.waiver_id '
+            'AND (CAST(waiver.subject AS TEXT) <> CAST(waiver_latest.subject AS TEXT) '
+            'OR waiver.testcase <> waiver_latest.testcase)')
+        _refresh_latest_waivers(connection)
+
+
+def refresh_latest_waivers(connection):
+    """
+    Adds the missing rows of the waiver_latest table and updates the stale
+    ones, without removing any, so that it is safe to run while the
+    application is creating waivers, and as often as needed.
+
+    Run this after deploying a release which introduces waiver_latest:
+    waivers created by application instances still running the previous
+    release, while the migration ran and until they were all upgraded, are
+    not recorded there.
+    """
+    with connection.begin():
+        advance_generation(connection)
+        return _refresh_latest_waivers(connection)
+
+
+def _refresh_latest_waivers(connection):
+    # Waivers inserted by hand may have no timestamp, which waiver_latest
+    # requires, so they get the epoch as in migration c3f9b1d2e4a7.
+    latest = ('SELECT waiver.subject, waiver.testcase, waiver.id, '
+              "COALESCE(waiver.timestamp, '1970-01-01') AS timestamp FROM waiver "
+              'JOIN (SELECT max(id) AS id FROM waiver '
+              '      GROUP BY CAST(subject AS TEXT), testcase) AS latest '
+              'ON latest.id = waiver.id')
+    updated = connection.execute(
+        'UPDATE waiver_latest SET waiver_id = newest.id, waiver_timestamp = newest.timestamp '
+        'FROM (%s) AS newest '
+        'WHERE CAST(waiver_latest.subject AS TEXT) = CAST(newest.subject AS TEXT) '
+        'AND waiver_latest.testcase = newest.testcase '
+        'AND waiver_latest.waiver_id < newest.id' % latest).rowcount
+    # The application inserts rows only after advancing the generation,
+    # which waits for this transaction, so none can appear in between.
+    inserted = connection.execute(
+        'INSERT INTO waiver_latest (subject, testcase, waiver_id, waiver_timestamp) '
+        '%s WHERE NOT EXISTS (SELECT 1 FROM waiver_latest '
+        'WHERE CAST(waiver_latest.subject AS TEXT) = CAST(waiver.subject AS TEXT) '
+        'AND waiver_latest.testcase = waiver.testcase)' % latest).rowcount
+    return updated + inserted
@@ -0,0 +1,75 @@
+# SPDX-License-Identifier: GPL-2.0+
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A thread-safe, size-bounded cache which evicts the least recently used
+    entry when full and expires entries ``ttl`` seconds after they were set.
+
+    The ``hits`` and ``misses`` attributes count lookups since the cache was
+    created.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return default
+            # Re-insert to mark the entry as most recently used.
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None, generation=None):
+        """
+        Stores ``value`` under ``key``. If ``generation`` is given, the value
+        is only stored if it is still the one the cache is tied to (see
+        :meth:`validate`), so a value derived from an older state cannot
+        outlive the clearing of the cache.
+        """
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def validate(self, generation):
+        """
+        Ties the cached entries to ``generation``, a counter of the state
+        they were derived from which never goes backwards, and clears the
+        cache when it has advanced since the previous call.
+
+        Returns False if ``generation`` is older than the one the cache is
+        tied to, as seen from a lagging read replica: the caller's view is
+        then behind the cached entries, and it should neither use them nor
+        add to them.
+        """
+        with self._lock:
+            if self.generation is None or generation > self.generation:
+                self._entries.clear()
+                self.generation = generation
+            return generation == self.generation
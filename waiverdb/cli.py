@@ -6,8 +6,24 @@ import click
 import requests
 import json
 import configparser
+import threading
+from multiprocessing.pool import ThreadPool
 
-requests_session = requests.Session()
+_thread_state = threading.local()
+
+
+def per_thread(name, factory):
+    """
+    Returns the calling thread's own instance of ``name``, made by calling
+    ``factory`` the first time. Requests sessions and authentication handlers
+    are not safe to share between the threads submitting batches.
+    """
+    try:
+        return getattr(_thread_state, name)
+    except AttributeError:
+        value = factory()
+        setattr(_thread_state, name, value)
+        return value
 
 
 def validate_config(config):
@@ -53,6 +69,99 @@ def check_response(resp, data, result_id=None):
         resp.json()['id'], msg))
 
 
+def describe(data):
+    if data.get('result_id'):
+        return 'for result with id {0}'.format(data['result_id'])
+    return 'for result with subject {0} and testcase {1}'.format(
+        json.dumps(data.get('subject')), data.get('testcase'))
+
+
+def read_waivers(waivers_file, waived, product_version, comment):
+    """
+    Reads waivers from a file with one JSON object per line. The command line
+    values are used for any of waived, product_version and comment which a
+    line does not specify.
+    """
+    data_list = []
+    for lineno, line in enumerate(waivers_file, 1):
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+        except ValueError as e:
+            raise click.ClickException('Line {0} is not valid JSON: {1}'.format(lineno, e))
+        if not isinstance(data, dict):
+            raise click.ClickException('Line {0} is not a JSON object'.format(lineno))
+        if not data.get('result_id') and not (data.get('subject') and data.get('testcase')):
+            raise click.ClickException(
+                'Line {0} must specify result_id or subject and testcase'.format(lineno))
+        data.setdefault('waived', waived)
+        data.setdefault('product_version', product_version)
+        data.setdefault('comment', comment)
+        if not data['product_version']:
+            raise click.ClickException('Please specify product version')
+        data_list.append(data)
+    return data_list
+
+
+def submit_batches(send, data_list, batch_size, workers):
+    """
+    Submits the waivers in batches of ``batch_size``, with up to ``workers``
+    requests in flight at once. Each batch of more than one waiver is sent
+    as a JSON array, which the server creates in a single transaction.
+
+    If ``send`` raises an exception other than a failed request, such as
+    failed authentication, the batches not sent yet are skipped, and the
+    exception is raised once all the threads are done.
+
+    Returns the number of waivers which failed to be created.
+    """
+    batches = [data_list[i:i + batch_size] for i in range(0, len(data_list), batch_size)]
+    aborted = threading.Event()
+
+    def submit(batch):
+        if aborted.is_set():
+            return batch, None, 'Not sent because of an earlier error', None
+        try:
+            resp = send(batch if len(batch) > 1 else batch[0])
+        except requests.RequestException as e:
+            return batch, None, str(e), None
+        except Exception as e:  # pylint: disable=W0703
+            aborted.set()
+            return batch, None, str(e), e
+        if not resp.ok:
+            try:
+                error_msg = resp.json()['message']
+            except (ValueError, KeyError):
+                error_msg = resp.text
+            return batch, None, error_msg, None
+        created = resp.json()
+        return batch, created if isinstance(created, list) else [created], None, None
+
+    pool = ThreadPool(workers)
+    failed = 0
+    error = None
+    try:
+        for batch, created, error_msg, exception in pool.imap(submit, batches):
+            if exception is not None and error is None:
+                error = exception
+            if error_msg is not None:
+                failed += len(batch)
+                for data in batch:
+                    click.echo('Failed to create waiver {0}:\n{1}'.format(
+                        describe(data), error_msg), err=True)
+                continue
+            for data, waiver in zip(batch, created):
+                click.echo('Created waiver {0} {1}'.format(waiver['id'], describe(data)))
+    finally:
+        pool.close()
+        pool.join()
+    click.echo('Created {0} waivers, {1} failed'.format(len(data_list) - failed, failed))
+    if error is not None:
+        raise error
+    return failed
+
+
 @click.command(context_settings={'help_option_names': ['-h', '--help']})
 @click.option('--config-file', '-C', default='/etc/waiverdb/client.conf',
               type=click.Path(exists=True),
@@ -69,7 +178,17 @@ def check_response(resp, data, result_id=None):
               help='Whether or not the result is waived')
 @click.option('--comment', '-c',
               help='A comment explaining why the result is waived')
-def cli(comment, waived, product_version, testcase, subject, result_id, config_file):
+@click.option('--file', '-f', 'waivers_file', type=click.File('r'),
+              help='Read waivers to create from a file (or - for stdin), one JSON '
+                   'object per line')
+@click.option('--batch-size', default=100, show_default=True,
+              help='Number of waivers from --file to send per request. Use 1 for '
+                   'servers which do not accept several waivers per request.')
+@click.option('--workers', default=4, show_default=True,
+              help='Number of requests to send concurrently with --file '
+                   '(always 1 with OIDC authentication)')
+def cli(comment, waived, product_version, testcase, subject, result_id, config_file,
+        waivers_file, batch_size, workers):
     """
     Creates new waiver against test results.
 
@@ -83,6 +202,10 @@ def cli(comment, waived, product_version, testcase, subject, result_id, config_f
                                           "type": "koji_build"}'
                      -p "fedora-26" -c "It's dead!"
 
+        or, with one {"subject": ..., "testcase": ...} object per line,
+
+        waiverdb-cli -f waivers.jsonl -p "fedora-26" -c "It's dead!"
+
     """
     config = configparser.SafeConfigParser()
 
@@ -90,36 +213,44 @@ def cli(comment, waived, product_version, testcase, subject, result_id, config_f
     validate_config(config)
 
     result_ids = result_id
-    if not product_version:
-        raise click.ClickException('Please specify product version')
-    if result_ids and (subject or testcase):
-        raise click.ClickException('Please specify result_id or subject/testcase. Not both')
-    if not result_ids and not subject:
-        raise click.ClickException('Please specify one subject')
-    if not result_ids and not testcase:
-        raise click.ClickException('Please specify testcase')
+    if waivers_file:
+        if result_ids or subject or testcase:
+            raise click.ClickException('Please specify a file or result_id or '
+                                       'subject/testcase. Not several')
+        if batch_size < 1 or workers < 1:
+            raise click.ClickException('Batch size and workers must be at least 1')
+        data_list = read_waivers(waivers_file, waived, product_version, comment)
+    else:
+        if not product_version:
+            raise click.ClickException('Please specify product version')
+        if result_ids and (subject or testcase):
+            raise click.ClickException('Please specify result_id or subject/testcase. Not both')
+        if not result_ids and not subject:
+            raise click.ClickException('Please specify one subject')
+        if not result_ids and not testcase:
+            raise click.ClickException('Please specify testcase')
+        data_list = []
+        if not result_ids:
+            data_list.append({
+                'subject': json.loads(subject),
+                'testcase': testcase,
+                'waived': waived,
+                'product_version': product_version,
+                'comment': comment
+            })
 
-    auth_method = config.get('waiverdb', 'auth_method')
-    data_list = []
-    if not result_ids:
-        data_list.append({
-            'subject': json.loads(subject),
-            'testcase': testcase,
-            'waived': waived,
-            'product_version': product_version,
-            'comment': comment
-        })
-
-    # XXX - TODO - remove this in a future release.  (for backwards compat)
-    for result_id in result_ids:
-        data_list.append({
-            'result_id': result_id,
-            'waived': waived,
-            'product_version': product_version,
-            'comment': comment
-        })
+        # XXX - TODO - remove this in a future release.  (for backwards compat)
+        for result_id in result_ids:
+            data_list.append({
+                'result_id': result_id,
+                'waived': waived,
+                'product_version': product_version,
+                'comment': comment
+            })
 
+    auth_method = config.get('waiverdb', 'auth_method')
     api_url = config.get('waiverdb', 'api_url')
+    url = '{0}/waivers/'.format(api_url.rstrip('/'))
     if auth_method == 'OIDC':
         # Try to import this now so the user gets immediate feedback if
         # it isn't installed
@@ -138,15 +269,19 @@ def cli(comment, waived, product_version, testcase, subject, result_id, config_f
             config.get('waiverdb', 'oidc_client_id'),
             oidc_client_secret)
         scopes = config.get('waiverdb', 'oidc_scopes').strip().splitlines()
+        # The client keeps its tokens in a store shared by all threads, which
+        # is not thread-safe, and each thread finding no valid token would
+        # start its own login in the browser. So requests are sent one at a
+        # time.
+        workers = 1
 
-        for data in data_list:
-            resp = oidc.send_request(
+        def send(data):
+            return oidc.send_request(
                 scopes=scopes,
-                url='{0}/waivers/'.format(api_url.rstrip('/')),
+                url=url,
                 data=json.dumps(data),
                 headers={'Content-Type': 'application/json'},
                 timeout=60)
-            check_response(resp, data, data.get('result_id', None))
     elif auth_method == 'Kerberos':
         # Try to import this now so the user gets immediate feedback if
         # it isn't installed
@@ -155,24 +290,36 @@ def cli(comment, waived, product_version, testcase, subject, result_id, config_f
         except ImportError:
             raise click.ClickException(
                 'python-requests-gssapi needs to be installed')
-        auth = requests_gssapi.HTTPKerberosAuth(
-            mutual_authentication=requests_gssapi.OPTIONAL)
-        for data in data_list:
-            resp = requests.request('POST', '{0}/waivers/'.format(api_url.rstrip('/')),
-                                    data=json.dumps(data), auth=auth,
-                                    headers={'Content-Type': 'application/json'},
-                                    timeout=60)
+
+        def make_auth():
+            return requests_gssapi.HTTPKerberosAuth(
+                mutual_authentication=requests_gssapi.OPTIONAL)
+
+        def send(data):
+            session = per_thread('session', requests.Session)
+            resp = session.request('POST', url,
+                                   data=json.dumps(data), auth=per_thread('auth', make_auth),
+                                   headers={'Content-Type': 'application/json'},
+                                   timeout=60)
             if resp.status_code == 401:
                 raise click.ClickException('WaiverDB authentication using GSSAPI failed. '
                                            'Make sure you have a valid Kerberos ticket.')
-            check_response(resp, data, data.get('result_id', None))
+            return resp
     elif auth_method == 'dummy':
-        for data in data_list:
-            resp = requests.request('POST', '{0}/waivers/'.format(api_url.rstrip('/')),
-                                    data=json.dumps(data), auth=('user', 'pass'),
-                                    headers={'Content-Type': 'application/json'},
-                                    timeout=60)
-            check_response(resp, data, data.get('result_id', None))
+        def send(data):
+            session = per_thread('session', requests.Session)
+            return session.request('POST', url,
+                                   data=json.dumps(data), auth=('user', 'pass'),
+                                   headers={'Content-Type': 'application/json'},
+                                   timeout=60)
+
+    if waivers_file:
+        if submit_batches(send, data_list, batch_size, workers):
+            raise click.ClickException('Some waivers could not be created')
+        return
+    for data in data_list:
+        resp = send(data)
+        check_response(resp, data, data.get('result_id', None))
 
 
 if __name__ == '__main__':
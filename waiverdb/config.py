@@ -13,6 +13,13 @@ class Config(object):
     """
     DEBUG = True
     DATABASE_URI = 'postgresql+psycopg2:///waiverdb'
+    # URIs of read replicas of the database. Requests which only read
+    # waivers are spread over them; writes always go to DATABASE_URI.
+    REPLICA_DATABASE_URIS = []
+    # For this many seconds after a client creates waivers, its reads go to
+    # the primary database, so it sees its own waivers even if the replicas
+    # lag behind (0 disables this). Clients must keep cookies for this.
+    REPLICA_READ_YOUR_WRITES = 10
     JOURNAL_LOGGING = False
     HOST = '0.0.0.0'
     PORT = 5004
@@ -23,15 +30,72 @@ class Config(object):
     # https://github.com/flask-restful/flask-restful/issues/449
     ERROR_404_HELP = False
     AUTH_METHOD = 'OIDC'  # Specify OIDC, Kerberos or SSL for authentication
+    # Number of validated OIDC tokens to remember in each process, and the
+    # maximum number of seconds to trust a token without validating it again
+    # (0 disables the cache). Tokens are never trusted past their expiry.
+    OIDC_TOKEN_CACHE_SIZE = 1000
+    OIDC_TOKEN_CACHE_TTL = 60
     # Change it if the Kerberos service is not running on which the waiverdb is run.
     KERBEROS_HTTP_HOST = None
+    # Set this to a number of seconds to issue a signed session cookie after
+    # a successful Kerberos authentication, so clients sending it back within
+    # that time skip the GSSAPI negotiation. Signed with SECRET_KEY.
+    KERBEROS_SESSION_LIFETIME = 0
+    KERBEROS_SESSION_COOKIE_NAME = 'waiverdb_session'
     # Set this to True or False to enable publishing to a message bus
     MESSAGE_BUS_PUBLISH = True
     # Specify fedmsg or stomp for publishing messages
     MESSAGE_PUBLISHER = 'fedmsg'
+    # Set this to True to queue messages in the database in the same
+    # transaction as the new waivers, instead of sending them before the
+    # response is returned. The queue is sent by `waiverdb publish-messages`,
+    # which must then be kept running.
+    MESSAGE_OUTBOX = False
+    # Messages from the outbox which failed to be sent this many times are
+    # left in the outbox_message table, and no longer retried, so that they
+    # do not hold up the others. Reset their attempts to send them again.
+    OUTBOX_MAX_ATTEMPTS = 10
     SQLALCHEMY_TRACK_MODIFICATIONS = True
+    # Set this to False to stop collecting metrics and serving them at
+    # /metrics. Collecting them needs prometheus_client to be installed.
+    METRICS = True
+    # SQL statements taking at least this many seconds are logged, with the
+    # endpoint, the request id and the types of their parameters. Set this
+    # to None to disable the log.
+    SLOW_QUERY_THRESHOLD = 1.0
+    # Set this to True to report the number of SQL statements run for each
+    # request, and the time they took, in a Server-Timing response header.
+    QUERY_STATS_HEADER = False
     # A list of users are allowed to create waivers on behalf of other users.
     SUPERUSERS = []
+    # Set this to True to stream +by-subjects-and-testcases responses through
+    # a server-side cursor instead of building them in memory.
+    STREAM_LOOKUP_RESPONSES = False
+    # How GET /waivers/ finds the page number of its 'last' link: 'exact'
+    # counts the matching waivers, 'estimate' takes the query planner's
+    # estimate, and 'none' leaves the link null. Counting can cost as much as
+    # fetching the page.
+    PAGINATION_COUNT = 'exact'
+    # Maximum number of subject/testcase lookups from +by-subjects-and-testcases
+    # to cache in each process (0 disables the cache), and for how many seconds.
+    RESULTS_CACHE_SIZE = 0
+    RESULTS_CACHE_TTL = 60
+    # Timeout in seconds for each ResultsDB request, how many times to retry
+    # a failed request, and the delay before the first retry (doubled for
+    # each further retry).
+    RESULTSDB_TIMEOUT = 10
+    RESULTSDB_RETRIES = 2
+    RESULTSDB_RETRY_BACKOFF = 0.5
+    # Maximum number of concurrent ResultsDB requests made to look up the
+    # results of a request creating several waivers by result_id.
+    RESULTSDB_CONCURRENT_LOOKUPS = 8
+    # Number of ResultsDB results to cache in each process, and for how long.
+    RESULTSDB_CACHE_SIZE = 1000
+    RESULTSDB_CACHE_TTL = 3600
+    # Stop calling ResultsDB for RESULTSDB_BREAKER_RESET seconds after this
+    # many consecutive failed lookups.
+    RESULTSDB_BREAKER_THRESHOLD = 5
+    RESULTSDB_BREAKER_RESET = 30
 
 
 class ProductionConfig(Config):
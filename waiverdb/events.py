@@ -11,19 +11,49 @@ using the :func:`sqlalchemy.event.listen` function.
 from __future__ import unicode_literals
 
 import logging
+import time
+from contextlib import contextmanager
 
-from flask_restful import marshal
 import fedmsg
 import stomp
 import json
-from waiverdb.fields import waiver_fields
-from waiverdb.models import Waiver
+from waiverdb.fields import serialize_waiver
+from waiverdb.models import db, Waiver, OutboxMessage
+from waiverdb.monitor import message_publish_duration
 from waiverdb.utils import stomp_connection
 from flask import current_app
 
 _log = logging.getLogger(__name__)
 
 
+@contextmanager
+def message_publisher():
+    """
+    Context manager yielding a ``publish(topic, msg)`` function which sends
+    a message to the configured message bus, either with fedmsg or over the
+    process's persistent stomp connection.
+    """
+    if current_app.config['MESSAGE_PUBLISHER'] == 'stomp':
+        with stomp_connection() as conn:
+            stomp_configs = current_app.config.get('STOMP_CONFIGS')
+
+            def publish(topic, msg):  # pylint: disable=W0613
+                kwargs = dict(body=json.dumps(msg), headers={},
+                              destination=stomp_configs['destination'])
+                if stomp.__version__[0] < 4:
+                    kwargs['message'] = kwargs.pop('body')  # On EL7, different sig.
+                start = time.time()
+                conn.send(**kwargs)
+                message_publish_duration.labels('stomp').observe(time.time() - start)
+            yield publish
+    else:
+        def publish(topic, msg):
+            start = time.time()
+            fedmsg.publish(topic=topic, msg=msg)
+            message_publish_duration.labels('fedmsg').observe(time.time() - start)
+        yield publish
+
+
 def publish_new_waiver(session):
     """
     A post-commit event hook that emits messages to a message bus. The messages
@@ -61,19 +91,88 @@ def publish_new_waiver(session):
 
     """
     _log.debug('The publish_new_waiver SQLAlchemy event has been activated.')
-    if current_app.config['MESSAGE_PUBLISHER'] == 'stomp':
-        with stomp_connection() as conn:
-            stomp_configs = current_app.config.get('STOMP_CONFIGS')
-            for row in session.identity_map.values():
-                if isinstance(row, Waiver):
-                    _log.debug('Publishing a message for %r', row)
-                    msg = json.dumps(marshal(row, waiver_fields))
-                    kwargs = dict(body=msg, headers={}, destination=stomp_configs['destination'])
-                    if stomp.__version__[0] < 4:
-                        kwargs['message'] = kwargs.pop('body')  # On EL7, different sig.
-                    conn.send(**kwargs)
-    else:
-        for row in session.identity_map.values():
-            if isinstance(row, Waiver):
-                _log.debug('Publishing a message for %r', row)
-                fedmsg.publish(topic='waiver.new', msg=marshal(row, waiver_fields))
+    waivers = [row for row in session.identity_map.values() if isinstance(row, Waiver)]
+    if not waivers:
+        return
+    with message_publisher() as publish:
+        for row in waivers:
+            _log.debug('Publishing a message for %r', row)
+            publish('waiver.new', serialize_waiver(row))
+
+
+def enqueue_new_waiver(mapper, connection, target):  # pylint: disable=W0613
+    """
+    A mapper ``after_insert`` event hook that writes the message announcing
+    a new waiver into the outbox, in the same transaction as the waiver
+    itself. The message is sent later by :func:`publish_outbox`, so the
+    request never waits on the message bus and no message is lost if the
+    process dies right after committing.
+
+    This event is designed to be registered with the Waiver mapper::
+
+        >>> from sqlalchemy.event import listen
+        >>> listen(Waiver, 'after_insert', enqueue_new_waiver)
+
+    The message is the same as the one sent by :func:`publish_new_waiver`.
+    """
+    _log.debug('Queueing a message for %r', target)
+    connection.execute(OutboxMessage.__table__.insert().values(
+        topic='waiver.new', body=json.dumps(serialize_waiver(target))))
+
+
+def publish_outbox(batch_size=100):
+    """
+    Sends up to ``batch_size`` of the oldest messages in the outbox to the
+    message bus, and deletes them once sent.
+
+    If sending a message fails, the messages sent before it are still
+    deleted, the failure is recorded on the message, and the exception is
+    re-raised. The failed message stays at the head of the outbox to be
+    retried, so messages are sent in order, until it has failed
+    OUTBOX_MAX_ATTEMPTS times. It is then parked: it stays in the outbox but
+    is skipped, so that one message which can never be sent does not block
+    the others.
+
+    Returns:
+        int: The number of messages sent.
+    """
+    max_attempts = current_app.config['OUTBOX_MAX_ATTEMPTS']
+    # Locking the rows keeps concurrent publishers from sending them twice.
+    rows = OutboxMessage.query.filter(OutboxMessage.attempts < max_attempts)\
+        .order_by(OutboxMessage.id).limit(batch_size).with_for_update().all()
+    if not rows:
+        db.session.commit()
+        return 0
+    sent = 0
+    try:
+        with message_publisher() as publish:
+            for row in rows:
+                _log.debug('Publishing %r', row)
+                publish(row.topic, json.loads(row.body))
+                db.session.delete(row)
+                sent += 1
+    except Exception as e:
+        failed = rows[sent]
+        failed.attempts += 1
+        failed.last_error = str(e)
+        if failed.attempts >= max_attempts:
+            _log.error('Giving up on %r after %d attempts: %s', failed, failed.attempts, e)
+        db.session.commit()
+        raise
+    db.session.commit()
+    return sent
+
+
+def invalidate_results_cache(session):
+    """
+    A post-commit event hook that clears the application's results cache
+    when waivers were created, so this process never serves lookups that
+    are missing its own new waivers.
+
+    Args:
+        session (sqlalchemy.orm.Session): The session that was committed to the
+            database. This session is not active and cannot emit SQL.
+    """
+    if any(isinstance(row, Waiver) for row in session.identity_map.values()):
+        _log.debug('Clearing the results cache.')
+        current_app.results_cache.clear()
@@ -1,5 +1,8 @@
 # SPDX-License-Identifier: GPL-2.0+
 
+from collections import OrderedDict
+
+import six
 from flask_restful import fields
 
 
@@ -14,3 +17,32 @@ waiver_fields = {
     'comment': fields.String,
     'timestamp': fields.DateTime(dt_format='iso8601'),
 }
+
+# The order marshal() gives the keys in, which is the order the serialized
+# JSON object has to list them in.
+_waiver_keys = list(waiver_fields)
+
+
+def _text(value):
+    return None if value is None else six.text_type(value)
+
+
+def serialize_waiver(waiver):
+    """
+    Returns the same as ``marshal(waiver, waiver_fields)``, which encodes to
+    the same JSON, without marshal's per-row and per-field overhead. It must
+    be kept in step with :data:`waiver_fields`.
+    """
+    timestamp = waiver.timestamp
+    values = {
+        'id': 0 if waiver.id is None else int(waiver.id),
+        'subject': waiver.subject,
+        'testcase': _text(waiver.testcase),
+        'username': _text(waiver.username),
+        'proxied_by': _text(waiver.proxied_by),
+        'product_version': _text(waiver.product_version),
+        'waived': None if waiver.waived is None else bool(waiver.waived),
+        'comment': _text(waiver.comment),
+        'timestamp': None if timestamp is None else timestamp.isoformat(),
+    }
+    return OrderedDict((key, values[key]) for key in _waiver_keys)
@@ -1,10 +1,18 @@
 # SPDX-License-Identifier: GPL-2.0+
 
+import datetime
+import os
 import time
 import click
 from flask.cli import FlaskGroup
 from sqlalchemy.exc import OperationalError
 from waiverdb.models import db
+from waiverdb.events import publish_outbox
+from waiverdb.backfill import (backfill_subjects, rebuild_latest_waivers,
+                               refresh_latest_waivers)
+from waiverdb.partitions import (MINIMUM_SERVER_VERSION, create_partitions, detach_partitions,
+                                 is_partitioned, month_start, next_month,
+                                 partition_waiver_table)
 
 
 def create_waiver_app(_):
@@ -35,5 +43,126 @@ def wait_for_db():
             break
 
 
+@cli.command(name='publish-messages')
+@click.option('--batch-size', default=100, show_default=True,
+              help='Maximum number of messages to send per transaction.')
+@click.option('--poll-interval', default=1.0, show_default=True,
+              help='Seconds to wait when there are no messages to send.')
+@click.option('--once', is_flag=True,
+              help='Exit once the outbox is empty instead of polling.')
+def publish_messages(batch_size, poll_interval, once):
+    """
+    Send queued messages from the outbox to the message bus.
+    """
+    max_retry_interval = 60  # seconds
+    retry_interval = poll_interval
+    while True:
+        try:
+            sent = publish_outbox(batch_size)
+        except Exception as e:  # pylint: disable=W0703
+            db.session.rollback()
+            if once:
+                raise
+            click.echo('Failed to publish messages: {}'.format(e))
+            click.echo('Retrying in {} seconds...'.format(retry_interval))
+            time.sleep(retry_interval)
+            retry_interval = min(retry_interval * 2, max_retry_interval)
+            continue
+        retry_interval = poll_interval
+        if sent < batch_size:
+            if once:
+                break
+            time.sleep(poll_interval)
+
+
+@cli.command(name='backfill-subjects')
+@click.option('--chunk-size', default=1000, show_default=True,
+              help='Number of waivers to convert and commit at a time.')
+@click.option('--workers', default=8, show_default=True,
+              help='Number of concurrent ResultsDB lookups.')
+@click.option('--only-missing', is_flag=True,
+              help='Only convert waivers which do not have a subject yet.')
+@click.option('--checkpoint-file', type=click.Path(dir_okay=False),
+              help='File recording the last converted waiver id. If it exists, '
+                   'the backfill resumes after that id.')
+def backfill_subjects_command(chunk_size, workers, only_missing, checkpoint_file):
+    """
+    Set waiver subjects and testcases from the ResultsDB results they refer to.
+    """
+    start_id = 0
+    if checkpoint_file and os.path.exists(checkpoint_file):
+        with open(checkpoint_file) as f:
+            start_id = int(f.read().strip() or 0)
+        click.echo('Resuming after waiver {}'.format(start_id))
+
+    def progress(last_id, count):
+        if checkpoint_file:
+            with open(checkpoint_file, 'w') as f:
+                f.write('{}\n'.format(last_id))
+        click.echo('Converted {} waivers, up to waiver {}'.format(count, last_id))
+
+    with db.engine.connect() as connection:
+        backfill_subjects(connection, chunk_size=chunk_size, workers=workers,
+                          start_id=start_id, only_missing=only_missing, progress=progress)
+        if db.engine.dialect.has_table(connection, 'waiver_latest'):
+            click.echo('Rebuilding waiver_latest')
+            rebuild_latest_waivers(connection)
+
+
+@cli.command(name='refresh-latest-waivers')
+def refresh_latest_waivers_command():
+    """
+    Record the newest waiver of each subject/testcase pair missing from the
+    waiver_latest table. Run this once every instance of the application
+    runs a release which maintains that table.
+    """
+    with db.engine.connect() as connection:
+        count = refresh_latest_waivers(connection)
+    click.echo('Updated {} subject/testcase pairs'.format(count))
+
+
+@cli.command(name='partition-waivers')
+@click.option('--months-ahead', default=3, show_default=True,
+              help='Number of months ahead to create partitions for.')
+def partition_waivers(months_ahead):
+    """
+    Partition the waiver table by month, or if it already is, create the
+    partitions for the coming months. Run this periodically.
+    """
+    with db.engine.connect() as connection:
+        if connection.dialect.server_version_info < MINIMUM_SERVER_VERSION:
+            raise click.ClickException('Partitioning needs PostgreSQL 11 or later')
+        if not is_partitioned(connection):
+            click.echo('Partitioning the waiver table')
+            partition_waiver_table(connection, months_ahead=months_ahead)
+            return
+        start = month_start(datetime.datetime.utcnow())
+        end = start
+        for _ in range(months_ahead + 1):
+            end = next_month(end)
+        for name in create_partitions(connection, start, end):
+            click.echo('Created partition {}'.format(name))
+
+
+@cli.command(name='detach-waiver-partitions')
+@click.option('--before', required=True,
+              help='Detach the partitions of waivers older than this date (YYYY-MM-DD).')
+def detach_waiver_partitions(before):
+    """
+    Detach old partitions of the waiver table, so they can be archived or
+    dropped. Their waivers are no longer served.
+    """
+    try:
+        before = datetime.datetime.strptime(before, '%Y-%m-%d')
+    except ValueError:
+        raise click.BadParameter('must be a date in the YYYY-MM-DD format',
+                                 param_hint='--before')
+    with db.engine.connect() as connection:
+        if not is_partitioned(connection):
+            raise click.ClickException('The waiver table is not partitioned')
+        for name in detach_partitions(connection, before):
+            click.echo('Detached partition {}'.format(name))
+
+
 if __name__ == '__main__':
     cli()  # pylint: disable=E1120
@@ -0,0 +1,45 @@
+"""Add waiver_latest table tracking the newest waiver per subject/testcase
+
+Revision ID: 3a9c1f5e7b20
+Revises: ce8a1351ecdc
+Create Date: 2018-03-12 10:21:47.118023
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3a9c1f5e7b20'
+down_revision = 'ce8a1351ecdc'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import JSON
+
+
+def upgrade():
+    op.create_table(
+        'waiver_latest',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('subject', JSON(), nullable=False),
+        sa.Column('testcase', sa.Text(), nullable=False),
+        sa.Column('waiver_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['waiver_id'], ['waiver.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_waiver_latest_waiver_id', 'waiver_latest', ['waiver_id'])
+    # Populate the table from the existing waivers, using the same grouping
+    # the obsolete filter used to compute on every request.
+    op.execute(
+        'INSERT INTO waiver_latest (subject, testcase, waiver_id) '
+        'SELECT waiver.subject, waiver.testcase, waiver.id FROM waiver '
+        'JOIN (SELECT max(id) AS id FROM waiver '
+        '      GROUP BY CAST(subject AS TEXT), testcase) AS latest '
+        'ON latest.id = waiver.id')
+    op.create_index('ix_waiver_latest_subject_testcase', 'waiver_latest',
+                    [text('CAST(subject AS TEXT)'), 'testcase'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_waiver_latest_subject_testcase')
+    op.drop_index('ix_waiver_latest_waiver_id')
+    op.drop_table('waiver_latest')
@@ -0,0 +1,48 @@
+"""Add waiver.subject_hash with a composite lookup index
+
+Revision ID: 5e8b2d0c4f91
+Revises: 3a9c1f5e7b20
+Create Date: 2018-03-14 15:02:11.403517
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5e8b2d0c4f91'
+down_revision = '3a9c1f5e7b20'
+
+from alembic import op
+import sqlalchemy as sa
+
+BATCH_SIZE = 10000
+
+
+def upgrade():
+    op.add_column('waiver', sa.Column('subject_hash', sa.String(length=32), nullable=True))
+
+    # End the migration transaction, so that each backfill batch below is
+    # committed on its own (keeping row locks short while the application
+    # keeps serving requests) and so that the index can be built
+    # CONCURRENTLY, which Postgres refuses to do inside a transaction block.
+    op.execute('COMMIT')
+
+    # The subject column holds the canonical serialization produced by
+    # json_serializer, so md5() in SQL gives the same digest as hash_subject().
+    connection = op.get_bind()
+    max_id = connection.execute('SELECT max(id) FROM waiver').scalar() or 0
+    for start in range(0, max_id + 1, BATCH_SIZE):
+        connection.execute(
+            sa.text('UPDATE waiver SET subject_hash = md5(CAST(subject AS TEXT)) '
+                    'WHERE id >= :start AND id < :end AND subject_hash IS NULL'),
+            start=start, end=start + BATCH_SIZE)
+    # Catch rows inserted by the previous application version while the
+    # backfill was running.
+    connection.execute('UPDATE waiver SET subject_hash = md5(CAST(subject AS TEXT)) '
+                       'WHERE subject_hash IS NULL')
+
+    op.execute('CREATE INDEX CONCURRENTLY ix_waiver_subject_hash_testcase_id '
+               'ON waiver (subject_hash, testcase, id DESC)')
+
+
+def downgrade():
+    op.drop_index('ix_waiver_subject_hash_testcase_id')
+    op.drop_column('waiver', 'subject_hash')
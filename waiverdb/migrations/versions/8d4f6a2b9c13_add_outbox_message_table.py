@@ -0,0 +1,31 @@
+"""Add outbox_message table for messages waiting to be published
+
+Revision ID: 8d4f6a2b9c13
+Revises: 5e8b2d0c4f91
+Create Date: 2018-03-20 11:45:08.926114
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8d4f6a2b9c13'
+down_revision = '5e8b2d0c4f91'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'outbox_message',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('topic', sa.Text(), nullable=False),
+        sa.Column('body', sa.Text(), nullable=False),
+        sa.Column('created', sa.DateTime(), nullable=True),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('last_error', sa.Text(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('outbox_message')
@@ -0,0 +1,33 @@
+"""Make waiver.subject_hash NOT NULL
+
+Revision ID: a1e3c5b7d9f2
+Revises: d2a4f6b8c0e1
+Create Date: 2018-04-12 09:47:03.225841
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a1e3c5b7d9f2'
+down_revision = 'd2a4f6b8c0e1'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Instances of releases before subject_hash was added insert waivers
+    # without one, and would fail once it is NOT NULL. This revision must
+    # only be applied once they have all been upgraded (see the release
+    # notes for 0.10). It hashes the waivers they created in the meantime,
+    # which by_results could not find until now, so cached responses which
+    # left them out are invalidated too.
+    op.execute('UPDATE waiver_generation SET generation = generation + 1')
+    op.execute('UPDATE waiver SET subject_hash = md5(CAST(subject AS TEXT)) '
+               'WHERE subject_hash IS NULL')
+    op.alter_column('waiver', 'subject_hash',
+                    existing_type=sa.String(length=32), nullable=False)
+
+
+def downgrade():
+    op.alter_column('waiver', 'subject_hash',
+                    existing_type=sa.String(length=32), nullable=True)
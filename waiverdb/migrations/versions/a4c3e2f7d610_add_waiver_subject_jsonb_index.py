@@ -0,0 +1,31 @@
+"""Add a GIN index on waiver.subject cast to jsonb
+
+Revision ID: a4c3e2f7d610
+Revises: 8d4f6a2b9c13
+Create Date: 2018-03-26 10:12:40.518304
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a4c3e2f7d610'
+down_revision = '8d4f6a2b9c13'
+
+from alembic import op
+
+
+def upgrade():
+    # The subject column stays JSON so that Waiverdb keeps working on
+    # Postgres 9.2, which has no jsonb. On such servers there is nothing to
+    # index, and the subject_contains filter is not available.
+    connection = op.get_bind()
+    if connection.dialect.server_version_info < (9, 4):
+        return
+    # Build the index CONCURRENTLY, which Postgres refuses to do inside a
+    # transaction block, so that writes are not blocked meanwhile.
+    op.execute('COMMIT')
+    op.execute('CREATE INDEX CONCURRENTLY ix_waiver_subject_jsonb '
+               'ON waiver USING gin (CAST(subject AS JSONB))')
+
+
+def downgrade():
+    op.execute('DROP INDEX IF EXISTS ix_waiver_subject_jsonb')
@@ -0,0 +1,30 @@
+"""Make waiver_latest.waiver_timestamp NOT NULL
+
+Revision ID: b7d1e3f5a9c2
+Revises: f4b2d6e8a1c9
+Create Date: 2018-04-05 15:20:31.902114
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b7d1e3f5a9c2'
+down_revision = 'f4b2d6e8a1c9'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Fill in any rows written before the column existed, with the epoch for
+    # waivers without a timestamp as in c3f9b1d2e4a7, then make sure there
+    # are no more.
+    op.execute("UPDATE waiver_latest SET waiver_timestamp = COALESCE(waiver.timestamp, "
+               "'1970-01-01') FROM waiver WHERE waiver.id = waiver_latest.waiver_id "
+               "AND waiver_latest.waiver_timestamp IS NULL")
+    op.alter_column('waiver_latest', 'waiver_timestamp',
+                    existing_type=sa.DateTime(), nullable=False)
+
+
+def downgrade():
+    op.alter_column('waiver_latest', 'waiver_timestamp',
+                    existing_type=sa.DateTime(), nullable=True)
@@ -0,0 +1,26 @@
+"""Add waiver_latest.waiver_timestamp
+
+Revision ID: c3f9b1d2e4a7
+Revises: a4c3e2f7d610
+Create Date: 2018-03-29 09:31:12.604811
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c3f9b1d2e4a7'
+down_revision = 'a4c3e2f7d610'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('waiver_latest', sa.Column('waiver_timestamp', sa.DateTime(), nullable=True))
+    # The application has always set the timestamp of new waivers, so only
+    # rows inserted by hand can lack one. waiver_latest rows for those get
+    # the epoch instead, and the obsolete filter matches them by waiver id.
+    op.execute("UPDATE waiver_latest SET waiver_timestamp = COALESCE(waiver.timestamp, "
+               "'1970-01-01') FROM waiver WHERE waiver.id = waiver_latest.waiver_id")
+
+def downgrade():
+    op.drop_column('waiver_latest', 'waiver_timestamp')
@@ -0,0 +1,28 @@
+"""Add waiver_generation table
+
+Revision ID: d2a4f6b8c0e1
+Revises: b7d1e3f5a9c2
+Create Date: 2018-04-11 10:12:46.518230
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd2a4f6b8c0e1'
+down_revision = 'b7d1e3f5a9c2'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'waiver_generation',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('generation', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.execute('INSERT INTO waiver_generation (id, generation) VALUES (1, 0)')
+
+
+def downgrade():
+    op.drop_table('waiver_generation')
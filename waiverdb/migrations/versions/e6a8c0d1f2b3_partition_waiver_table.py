@@ -0,0 +1,35 @@
+"""Optionally partition the waiver table by month
+
+Revision ID: e6a8c0d1f2b3
+Revises: c3f9b1d2e4a7
+Create Date: 2018-03-29 14:02:57.311460
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e6a8c0d1f2b3'
+down_revision = 'c3f9b1d2e4a7'
+
+from alembic import context, op
+from waiverdb.partitions import (MINIMUM_SERVER_VERSION, is_partitioned,
+                                 partition_waiver_table)
+
+
+def upgrade():
+    # Converting the table locks it for as long as it takes to copy every
+    # waiver, so it is only done when asked for, with:
+    #   waiverdb db upgrade -x partition_waivers=true
+    # It can also be done later with `waiverdb partition-waivers`.
+    if context.get_x_argument(as_dictionary=True).get('partition_waivers') != 'true':
+        return
+    connection = op.get_bind()
+    if connection.dialect.server_version_info < MINIMUM_SERVER_VERSION:
+        raise RuntimeError('Partitioning the waiver table needs PostgreSQL 11 or later')
+    if not is_partitioned(connection):
+        partition_waiver_table(connection)
+
+
+def downgrade():
+    # The partitioned table has the same columns as before, so the previous
+    # revisions work with it unchanged.
+    pass
@@ -0,0 +1,36 @@
+"""Add indexes for the filters of GET /waivers/
+
+Revision ID: f4b2d6e8a1c9
+Revises: e6a8c0d1f2b3
+Create Date: 2018-04-03 10:48:19.027356
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'f4b2d6e8a1c9'
+down_revision = 'e6a8c0d1f2b3'
+
+from alembic import op
+from waiverdb.partitions import FILTER_INDEXES, is_partitioned
+
+
+def upgrade():
+    connection = op.get_bind()
+    if is_partitioned(connection):
+        # Postgres cannot build an index on a partitioned table CONCURRENTLY.
+        # Building it on the parent builds one on each partition instead.
+        # Tables partitioned by an earlier revision have them already.
+        for name, definition in FILTER_INDEXES:
+            op.execute('CREATE INDEX IF NOT EXISTS {0} ON waiver {1}'.format(name, definition))
+        return
+    # End the migration transaction, since Postgres refuses to build an
+    # index CONCURRENTLY inside a transaction block. Building them this way
+    # keeps the table writable meanwhile.
+    op.execute('COMMIT')
+    for name, definition in FILTER_INDEXES:
+        op.execute('CREATE INDEX CONCURRENTLY {0} ON waiver {1}'.format(name, definition))
+
+
+def downgrade():
+    for name, _ in reversed(FILTER_INDEXES):
+        op.execute('DROP INDEX {0}'.format(name))
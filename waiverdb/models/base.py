@@ -1,17 +1,29 @@
 # SPDX-License-Identifier: GPL-2.0+
 
+import hashlib
 import json
 from sqlalchemy.dialects.postgresql import JSON
 from sqlalchemy.dialects.postgresql.psycopg2 import _PGJSON
 from sqlalchemy.sql.elements import ColumnElement, Null
 from sqlalchemy.sql.expression import cast
 from sqlalchemy.sql.sqltypes import Text
+from flask import g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
 
 
 json_serializer = json.encoder.JSONEncoder(sort_keys=True, separators=(',', ':')).encode
 
 
+def hash_subject(subject):
+    """
+    Returns a fixed-width digest of the canonical JSON serialization of the
+    given subject. MD5 is used (for indexing, not security) because Postgres
+    can compute the same digest natively, which lets migrations backfill it
+    in SQL.
+    """
+    return hashlib.md5(json_serializer(subject).encode('utf-8')).hexdigest()
+
+
 # Note that we have to inherit from the psycopg2-specific _PGJSON type,
 # instead of the more general Postgres-specific JSON type. That's because
 # SQLAlchemy helpfully "adapts" the general JSON type to _PGJSON when it sees
@@ -61,4 +73,18 @@ class EqualityComparableJSONType(_PGJSON):
         return process
 
 
-db = SQLAlchemy()
+class RoutingSQLAlchemy(SQLAlchemy):
+    """
+    Routes the queries of a request to the bind named in ``g.replica_bind``
+    (set by :func:`waiverdb.utils.read_replica`) instead of the primary
+    database. Sessions take their engine from here when they are created,
+    which happens on first use in each request.
+    """
+
+    def get_engine(self, app=None, bind=None):
+        if bind is None and has_request_context():
+            bind = getattr(g, 'replica_bind', None)
+        return super(RoutingSQLAlchemy, self).get_engine(app, bind)
+
+
+db = RoutingSQLAlchemy()
@@ -0,0 +1,23 @@
+# SPDX-License-Identifier: GPL-2.0+
+
+import datetime
+from .base import db
+
+
+class OutboxMessage(db.Model):
+    """
+    A message waiting to be published to the message bus. Messages are
+    written in the same transaction as the change they announce, and
+    deleted once a publisher has sent them.
+    """
+    __tablename__ = 'outbox_message'
+    id = db.Column(db.Integer, primary_key=True)
+    topic = db.Column(db.Text, nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    created = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text)
+
+    def __repr__(self):
+        return '%s(id=%r, topic=%r, attempts=%r)' % (
+            self.__class__.__name__, self.id, self.topic, self.attempts)
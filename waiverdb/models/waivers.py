@@ -1,14 +1,27 @@
 # SPDX-License-Identifier: GPL-2.0+
 
 import datetime
-from .base import db, EqualityComparableJSONType
-from sqlalchemy import or_, and_, cast
+from .base import db, EqualityComparableJSONType, hash_subject, json_serializer
+from sqlalchemy import DDL, or_, and_, cast, event, func, literal, select, tuple_
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import validates
+
+
+def _unnest(values):
+    """
+    Returns unnest() of the given strings bound as a single text[] parameter.
+    Several of these in one SELECT list are unnested side by side, which
+    (unlike the multi-argument form of unnest) works on Postgres 9.2.
+    """
+    return func.unnest(literal(values, ARRAY(db.Text)))
 
 
 class Waiver(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     result_id = db.Column(db.Integer, nullable=True)
     subject = db.Column(EqualityComparableJSONType, nullable=False)
+    subject_hash = db.Column(db.String(32), nullable=False)
     testcase = db.Column(db.Text, nullable=False, index=True)
     username = db.Column(db.String(255), nullable=False)
     proxied_by = db.Column(db.String(255))
@@ -18,6 +31,14 @@ class Waiver(db.Model):
     timestamp = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     __table_args__ = (
         db.Index('ix_waiver_subject', cast(subject, db.Text)),
+        db.Index('ix_waiver_subject_hash_testcase_id', subject_hash, testcase, id.desc()),
+        # Indexes for the filters of GET /waivers/, which orders by timestamp.
+        db.Index('ix_waiver_timestamp_id', timestamp.desc(), id.desc()),
+        db.Index('ix_waiver_product_version_timestamp', product_version, timestamp.desc()),
+        db.Index('ix_waiver_username_timestamp', username, timestamp.desc()),
+        # Most waivers are not proxied, and those need no index entry.
+        db.Index('ix_waiver_proxied_by_timestamp', proxied_by, timestamp.desc(),
+                 postgresql_where=proxied_by.isnot(None)),
     )
 
     def __init__(self, subject, testcase, username, product_version, waived=False,
@@ -30,6 +51,11 @@ class Waiver(db.Model):
         self.comment = comment
         self.proxied_by = proxied_by
 
+    @validates('subject')
+    def validate_subject(self, key, subject):  # pylint: disable=W0613
+        self.subject_hash = hash_subject(subject)
+        return subject
+
     def __repr__(self):
         return '%s(result_id=%r, subject=%r, testcase=%r, username=%r, product_version=%r,\
                 waived=%r)' % (self.__class__.__name__, self.result_id, self.subject, self.testcase,
@@ -37,13 +63,177 @@ class Waiver(db.Model):
 
     @classmethod
     def by_results(cls, query, results):
-        return query.filter(or_(*[
-            and_(
-                cls.subject == d['subject'],
-                cls.testcase == d['testcase']
-            ) if d.get('testcase', None) else
-            and_(
-                cls.subject == d['subject']
-            ) if d.get('subject', None) else
-            and_() for d in results
-        ]))
+        """
+        Restrict the query to waivers matching any of the given results.
+        Each result is a dict with a 'subject' and optionally a 'testcase'.
+
+        The results are passed to Postgres as one array parameter per column
+        and unnested into a relation the waivers are semi-joined against,
+        so the statement is the same size however many results there are.
+        Matching on subject_hash lets Postgres answer each result with a
+        probe of ix_waiver_subject_hash_testcase_id. The serialized subject
+        itself is still compared so a digest collision can never return a
+        wrong row.
+        """
+        pairs = []
+        subjects = []
+        for d in results:
+            if d.get('subject', None):
+                if d.get('testcase', None):
+                    pairs.append((d['subject'], d['testcase']))
+                else:
+                    subjects.append(d['subject'])
+            else:
+                # A result without a subject matches every waiver.
+                return query
+        clauses = []
+        if pairs:
+            clauses.append(tuple_(cls.subject_hash, cast(cls.subject, db.Text), cls.testcase)
+                           .in_(select([
+                               _unnest([hash_subject(subject) for subject, _ in pairs]),
+                               _unnest([json_serializer(subject) for subject, _ in pairs]),
+                               _unnest([testcase for _, testcase in pairs]),
+                           ])))
+        if subjects:
+            clauses.append(tuple_(cls.subject_hash, cast(cls.subject, db.Text))
+                           .in_(select([
+                               _unnest([hash_subject(subject) for subject in subjects]),
+                               _unnest([json_serializer(subject) for subject in subjects]),
+                           ])))
+        return query.filter(or_(*clauses))
+
+    @classmethod
+    def subject_contains(cls, query, subject):
+        """
+        Restrict the query to waivers whose subject contains all the keys and
+        values of the given dict, so that ``{'item': 'foo'}`` matches every
+        waiver on the item foo whatever else its subject holds.
+
+        This uses the jsonb ``@>`` operator, answered by ix_waiver_subject_jsonb,
+        and so needs Postgres 9.4 or later.
+        """
+        return query.filter(cast(cls.subject, JSONB).contains(subject))
+
+    @classmethod
+    def exclude_obsolete(cls, query):
+        """
+        Restrict the query to the newest waiver for each subject/testcase
+        pair, as recorded in the :class:`LatestWaiver` table.
+
+        The join also matches on the timestamp, which is redundant but lets
+        Postgres skip the partitions of a partitioned waiver table which
+        cannot hold the waiver (see :mod:`waiverdb.partitions`). Waivers
+        inserted by hand without a timestamp are recorded with the epoch,
+        and only matched by id.
+        """
+        return query.join(LatestWaiver, and_(
+            LatestWaiver.waiver_id == cls.id,
+            or_(LatestWaiver.waiver_timestamp == cls.timestamp, cls.timestamp.is_(None))))
+
+
+def _server_has_jsonb(ddl, target, bind, **kw):  # pylint: disable=W0613
+    return bind.dialect.server_version_info >= (9, 4)
+
+
+# Postgres before 9.4 has no jsonb, so like migration a4c3e2f7d610, only
+# create this index on later releases.
+event.listen(Waiver.__table__, 'after_create', DDL(
+    'CREATE INDEX ix_waiver_subject_jsonb ON waiver USING gin (CAST(subject AS JSONB))'
+).execute_if(callable_=_server_has_jsonb))
+
+
+class WaiverGeneration(db.Model):
+    """
+    A counter advanced by every transaction which creates or changes
+    waivers, in that same transaction. A reader therefore sees a new
+    generation exactly when it can see the changes, which makes it a safe
+    validator for cached responses: unlike the highest waiver id, it is not
+    fooled by transactions committing out of id order, nor by waivers being
+    rewritten in place by :mod:`waiverdb.backfill`.
+
+    The table holds a single row. Writers wait on its row lock, so
+    transactions creating waivers are serialized from their first insert
+    until they commit.
+    """
+    __tablename__ = 'waiver_generation'
+    id = db.Column(db.Integer, primary_key=True)
+    generation = db.Column(db.BigInteger, nullable=False)
+
+    @classmethod
+    def current(cls, session):
+        return session.query(cls.generation).filter(cls.id == 1).scalar()
+
+
+event.listen(WaiverGeneration.__table__, 'after_create', DDL(
+    'INSERT INTO waiver_generation (id, generation) VALUES (1, 0)'))
+
+
+def advance_generation(connection):
+    """
+    Advances the :class:`WaiverGeneration` in the current transaction of
+    ``connection``. Call it before touching any other rows, so that
+    transactions always take the generation row lock first and cannot
+    deadlock on each other's waiver_latest rows.
+    """
+    table = WaiverGeneration.__table__
+    connection.execute(table.update()
+                       .where(table.c.id == 1)
+                       .values(generation=table.c.generation + 1))
+
+
+class LatestWaiver(db.Model):
+    """
+    The id of the newest waiver for each subject/testcase pair. Any other
+    waiver with the same subject and testcase is obsolete.
+
+    Rows are maintained by an ``after_insert`` hook on :class:`Waiver`, so
+    they are written in the same transaction as the waiver itself.
+    """
+    __tablename__ = 'waiver_latest'
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(EqualityComparableJSONType, nullable=False)
+    testcase = db.Column(db.Text, nullable=False)
+    waiver_id = db.Column(db.Integer, db.ForeignKey('waiver.id'), nullable=False, index=True)
+    waiver_timestamp = db.Column(db.DateTime, nullable=False)
+    __table_args__ = (
+        db.Index('ix_waiver_latest_subject_testcase', cast(subject, db.Text), testcase,
+                 unique=True),
+    )
+
+    def __repr__(self):
+        return '%s(subject=%r, testcase=%r, waiver_id=%r)' % (
+            self.__class__.__name__, self.subject, self.testcase, self.waiver_id)
+
+
+@event.listens_for(Waiver, 'before_insert')
+def advance_generation_on_insert(mapper, connection, target):  # pylint: disable=W0613
+    advance_generation(connection)
+
+
+@event.listens_for(Waiver, 'after_insert')
+def update_latest_waiver(mapper, connection, target):  # pylint: disable=W0613
+    table = LatestWaiver.__table__
+    key = and_(table.c.subject == target.subject, table.c.testcase == target.testcase)
+    update = table.update()\
+        .where(key)\
+        .where(table.c.waiver_id < target.id)\
+        .values(waiver_id=target.id, waiver_timestamp=target.timestamp)
+    if connection.execute(update).rowcount:
+        return
+    if connection.execute(select([table.c.id]).where(key)).first() is not None:
+        return
+    # A concurrent transaction may insert the first row for the same pair
+    # between the SELECT and the INSERT. The unique index then makes the
+    # INSERT fail once that transaction commits, and the row it inserted is
+    # updated instead. (INSERT ... ON CONFLICT would need Postgres 9.5.)
+    savepoint = connection.begin_nested()
+    try:
+        connection.execute(table.insert().values(subject=target.subject,
+                                                 testcase=target.testcase,
+                                                 waiver_id=target.id,
+                                                 waiver_timestamp=target.timestamp))
+    except IntegrityError:
+        savepoint.rollback()
+        connection.execute(update)
+    else:
+        savepoint.commit()
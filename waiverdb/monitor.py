@@ -0,0 +1,219 @@
+# SPDX-License-Identifier: GPL-2.0+
+"""
+Runtime metrics, exposed in the Prometheus text format at ``/metrics``, and
+per-request SQL statistics.
+
+Metrics are collected with prometheus_client when it is installed, and
+silently discarded otherwise. When several worker processes serve the
+application (as with gunicorn), set the ``PROMETHEUS_MULTIPROC_DIR`` (or
+for older prometheus_client releases ``prometheus_multiproc_dir``)
+environment variable to an empty directory writable by all of them, before
+they start: each process then records its metrics there, and ``/metrics``
+reports the sum over all processes, whichever process serves it.
+"""
+
+import logging
+import os
+import time
+import uuid
+
+from flask import Response, current_app, g, has_app_context, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:  # pragma: no cover
+    prometheus_client = None
+
+_log = logging.getLogger(__name__)
+
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000, float('inf'))
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, float('inf'))
+
+
+class _DiscardedMetric(object):
+    """
+    Stands in for a metric when prometheus_client is not installed.
+    """
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+
+def _histogram(name, documentation, labelnames=(), **kwargs):
+    if prometheus_client is None:
+        return _DiscardedMetric()
+    return prometheus_client.Histogram(name, documentation, labelnames, **kwargs)
+
+
+request_duration = _histogram(
+    'waiverdb_request_duration_seconds', 'Time taken to serve a request.',
+    ['endpoint', 'method', 'status'])
+response_size = _histogram(
+    'waiverdb_response_size_bytes', 'Size of response bodies.',
+    ['endpoint'], buckets=SIZE_BUCKETS)
+request_db_queries = _histogram(
+    'waiverdb_request_db_queries', 'Number of SQL statements executed per request.',
+    ['endpoint'], buckets=COUNT_BUCKETS)
+request_db_duration = _histogram(
+    'waiverdb_request_db_duration_seconds', 'Time spent executing SQL statements per request.',
+    ['endpoint'])
+db_pool_checkout_duration = _histogram(
+    'waiverdb_db_pool_checkout_seconds', 'Time waited for a database connection from the pool.',
+    ['bind'])
+message_publish_duration = _histogram(
+    'waiverdb_message_publish_seconds', 'Time taken to publish a message.', ['publisher'])
+resultsdb_request_duration = _histogram(
+    'waiverdb_resultsdb_request_seconds', 'Time taken by each request to ResultsDB.',
+    ['outcome'])
+
+
+def _endpoint():
+    return request.endpoint or 'unknown'
+
+
+def before_request():
+    g.request_start = time.time()
+
+
+def after_request(response):
+    start = getattr(g, 'request_start', None)
+    if start is None:
+        return response
+    endpoint = _endpoint()
+    request_duration.labels(endpoint, request.method, str(response.status_code))\
+        .observe(time.time() - start)
+    # Streamed responses have no length, since it is not known beforehand.
+    if response.content_length is not None:
+        response_size.labels(endpoint).observe(response.content_length)
+    request_db_queries.labels(endpoint).observe(getattr(g, 'db_queries', 0))
+    request_db_duration.labels(endpoint).observe(getattr(g, 'db_duration', 0.0))
+    return response
+
+
+def _value_shape(value):
+    if isinstance(value, (list, tuple)):
+        return '%s[%d]' % (type(value).__name__, len(value))
+    return type(value).__name__
+
+
+def parameter_shape(parameters, executemany=False):
+    """
+    Describes the bound parameters of a statement by their types and sizes
+    only, so they can be logged without leaking their values.
+    """
+    if executemany:
+        return '%d x %s' % (len(parameters),
+                            parameter_shape(parameters[0]) if parameters else '()')
+    if isinstance(parameters, dict):
+        return '{%s}' % ', '.join('%s: %s' % (key, _value_shape(parameters[key]))
+                                  for key in sorted(parameters))
+    return '(%s)' % ', '.join(_value_shape(value) for value in parameters or ())
+
+
+def start_query_stats():
+    g.request_id = request.headers.get('X-Request-Id') or uuid.uuid4().hex
+    g.db_queries = 0
+    g.db_duration = 0.0
+
+
+def add_query_stats_header(response):
+    if current_app.config['QUERY_STATS_HEADER'] and getattr(g, 'db_queries', None) is not None:
+        response.headers['Server-Timing'] = 'db;dur=%.1f;desc="%d queries"' % (
+            g.db_duration * 1000, g.db_queries)
+    return response
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # pylint: disable=W0613
+    conn.info.setdefault('query_start', []).append(time.time())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # pylint: disable=W0613
+    duration = time.time() - conn.info['query_start'].pop()
+    in_request = has_request_context() and getattr(g, 'db_queries', None) is not None
+    if in_request:
+        g.db_queries += 1
+        g.db_duration += duration
+    if not has_app_context():
+        return
+    threshold = current_app.config['SLOW_QUERY_THRESHOLD']
+    if threshold is not None and duration >= threshold:
+        _log.warning('Slow query (%.3f s) in %s, request %s: %s; parameters: %s',
+                     duration, _endpoint() if has_request_context() else '-',
+                     g.request_id if in_request else '-', statement,
+                     parameter_shape(parameters, executemany))
+
+
+def instrument_pool(pool, bind):
+    """
+    Records how long each connection checkout from the given pool takes,
+    including any wait for another request to return a connection, labelled
+    with the name of the bind it belongs to.
+    SQLAlchemy has no event for the start of a checkout, so this wraps the
+    pool's public ``connect`` method, which the engine calls to check out
+    each connection.
+    """
+    connect = pool.connect
+    histogram = db_pool_checkout_duration.labels(bind)
+
+    def timed_connect(*args, **kwargs):
+        start = time.time()
+        try:
+            return connect(*args, **kwargs)
+        finally:
+            histogram.observe(time.time() - start)
+    pool.connect = timed_connect
+
+
+def metrics():
+    """
+    Request handler returning all metrics in the Prometheus text format.
+    This is not part of the published API, it is intended for use by
+    monitoring tools.
+    """
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ or 'prometheus_multiproc_dir' in os.environ:
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return Response(prometheus_client.generate_latest(registry),
+                    content_type=prometheus_client.CONTENT_TYPE_LATEST)
+
+
+def init_metrics(app, engines):
+    """
+    Starts collecting request metrics for the application, and serves them
+    at ``/metrics``. ``engines`` maps bind names to the engines whose
+    connection pools are to be instrumented.
+    """
+    if prometheus_client is None:
+        app.logger.warning('prometheus_client is not installed, metrics are disabled')
+        return
+    app.before_request(before_request)
+    app.after_request(after_request)
+    for bind, engine in engines.items():
+        instrument_pool(engine.pool, bind)
+    app.add_url_rule('/metrics', view_func=metrics)
+
+
+def register_query_instrumentation(app):
+    """
+    Counts and times the SQL statements executed for each request, logs
+    those slower than SLOW_QUERY_THRESHOLD, and reports the totals in a
+    Server-Timing response header if QUERY_STATS_HEADER is set.
+
+    This is only needed when one of these or METRICS is enabled.
+    """
+    app.before_request(start_query_stats)
+    app.after_request(add_query_stats_header)
+    # The hooks apply to every engine, so they are only registered once even
+    # if several applications are created.
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
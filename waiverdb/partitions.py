@@ -0,0 +1,174 @@
+# SPDX-License-Identifier: GPL-2.0+
+"""
+Partitioning of the ``waiver`` table by month of ``timestamp``, using the
+declarative partitioning of PostgreSQL 11 or later.
+
+Queries filtering on the timestamp (the ``since`` filter, cursor pages and,
+through ``waiver_latest.waiver_timestamp``, the obsolete filter) then only
+touch the partitions which can hold matching waivers, and old partitions can
+be detached to be archived or dropped without touching the others.
+
+New waivers go to the partition for their month, so partitions must be
+created ahead of time, by running ``waiverdb partition-waivers``
+periodically. Waivers for which there is no partition end up in the
+``waiver_default`` partition, and are moved out of it when the partition
+for their month is created.
+"""
+
+import datetime
+import re
+
+PARTITION_NAME = re.compile(r'^waiver_p(\d{4})_(\d{2})$')
+MINIMUM_SERVER_VERSION = (11,)
+
+# The indexes supporting the filters of GET /waivers/.
+FILTER_INDEXES = [
+    ('ix_waiver_timestamp_id', '(timestamp DESC, id DESC)'),
+    ('ix_waiver_product_version_timestamp', '(product_version, timestamp DESC)'),
+    ('ix_waiver_username_timestamp', '(username, timestamp DESC)'),
+    ('ix_waiver_proxied_by_timestamp', '(proxied_by, timestamp DESC) '
+                                       'WHERE proxied_by IS NOT NULL'),
+]
+
+
+def month_start(value):
+    return datetime.datetime(value.year, value.month, 1)
+
+
+def next_month(month):
+    return datetime.datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def partition_name(month):
+    return 'waiver_p%04d_%02d' % (month.year, month.month)
+
+
+def is_partitioned(connection):
+    if connection.dialect.server_version_info < MINIMUM_SERVER_VERSION:
+        return False
+    return connection.execute(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table "
+        "WHERE partrelid = 'waiver'::regclass)").scalar()
+
+
+def list_partitions(connection):
+    """
+    Returns the (name, month) of the monthly partitions of the waiver table,
+    oldest first.
+    """
+    rows = connection.execute(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'waiver'::regclass")
+    partitions = []
+    for row in rows:
+        match = PARTITION_NAME.match(row[0])
+        if match:
+            partitions.append((row[0], datetime.datetime(int(match.group(1)),
+                                                         int(match.group(2)), 1)))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def create_partitions(connection, start, end):
+    """
+    Creates the missing monthly partitions of the waiver table covering
+    ``start`` up to (but excluding) ``end``. Returns the names of the
+    partitions created.
+
+    Postgres refuses to create a partition for a month while the default
+    partition holds waivers of that month. In that case the default
+    partition is detached, the partition is created, the waivers of the
+    month are moved to it and the default partition is attached again, all
+    in one transaction which locks the waiver table. To avoid this, keep
+    partitions created several months ahead.
+    """
+    existing = set(name for name, _ in list_partitions(connection))
+    has_default = connection.execute(
+        "SELECT to_regclass('waiver_default') IS NOT NULL").scalar()
+    created = []
+    month = month_start(start)
+    while month < end:
+        name = partition_name(month)
+        if name not in existing:
+            bounds = "timestamp >= '{0}' AND timestamp < '{1}'".format(
+                month.isoformat(), next_month(month).isoformat())
+            with connection.begin():
+                move = has_default and connection.execute(
+                    'SELECT EXISTS (SELECT 1 FROM waiver_default WHERE {0})'
+                    .format(bounds)).scalar()
+                if move:
+                    connection.execute('ALTER TABLE waiver DETACH PARTITION waiver_default')
+                connection.execute(
+                    "CREATE TABLE {0} PARTITION OF waiver FOR VALUES FROM ('{1}') TO ('{2}')"
+                    .format(name, month.isoformat(), next_month(month).isoformat()))
+                if move:
+                    connection.execute('INSERT INTO {0} SELECT * FROM waiver_default WHERE {1}'
+                                       .format(name, bounds))
+                    connection.execute('DELETE FROM waiver_default WHERE {0}'.format(bounds))
+                    connection.execute('ALTER TABLE waiver ATTACH PARTITION waiver_default '
+                                       'DEFAULT')
+            created.append(name)
+        month = next_month(month)
+    return created
+
+
+def partition_waiver_table(connection, months_ahead=3):
+    """
+    Converts the waiver table into a partitioned table, with a partition for
+    each month from the oldest waiver up to ``months_ahead`` months from
+    now, and a default partition.
+
+    Everything happens in one transaction, during which the waiver table is
+    locked: plan for downtime proportional to the size of the table.
+
+    Postgres cannot enforce a foreign key referencing a partitioned table,
+    so the one from ``waiver_latest.waiver_id`` is dropped; the primary key
+    has to include the partition key, so it becomes (id, timestamp). Indexes
+    are defined on the partitioned table, which creates them on each
+    partition.
+    """
+    if connection.execute('SELECT 1 FROM waiver WHERE timestamp IS NULL LIMIT 1').first():
+        raise RuntimeError('Waivers without a timestamp cannot be partitioned, '
+                           'set their timestamp first')
+    with connection.begin():
+        oldest = connection.execute('SELECT min(timestamp) FROM waiver').scalar()
+        now = datetime.datetime.utcnow()
+        end = month_start(now)
+        for _ in range(months_ahead + 1):
+            end = next_month(end)
+        connection.execute('ALTER TABLE waiver_latest '
+                           'DROP CONSTRAINT IF EXISTS waiver_latest_waiver_id_fkey')
+        connection.execute('ALTER TABLE waiver RENAME TO waiver_unpartitioned')
+        connection.execute('CREATE TABLE waiver (LIKE waiver_unpartitioned INCLUDING DEFAULTS) '
+                           'PARTITION BY RANGE (timestamp)')
+        connection.execute('CREATE TABLE waiver_default PARTITION OF waiver DEFAULT')
+        create_partitions(connection, oldest or now, end)
+        connection.execute('INSERT INTO waiver SELECT * FROM waiver_unpartitioned')
+        # The id sequence would be dropped along with the table owning it.
+        connection.execute('ALTER SEQUENCE waiver_id_seq OWNED BY waiver.id')
+        connection.execute('DROP TABLE waiver_unpartitioned')
+        connection.execute('ALTER TABLE waiver ADD CONSTRAINT waiver_pkey '
+                           'PRIMARY KEY (id, timestamp)')
+        connection.execute('CREATE INDEX ix_waiver_testcase ON waiver (testcase)')
+        connection.execute('CREATE INDEX ix_waiver_subject ON waiver (CAST(subject AS TEXT))')
+        connection.execute('CREATE INDEX ix_waiver_subject_hash_testcase_id '
+                           'ON waiver (subject_hash, testcase, id DESC)')
+        connection.execute('CREATE INDEX ix_waiver_subject_jsonb '
+                           'ON waiver USING gin (CAST(subject AS JSONB))')
+        for name, definition in FILTER_INDEXES:
+            connection.execute('CREATE INDEX {0} ON waiver {1}'.format(name, definition))
+        connection.execute('ANALYZE waiver')
+
+
+def detach_partitions(connection, before):
+    """
+    Detaches the monthly partitions holding only waivers older than
+    ``before``. They are left as ordinary tables, which can be archived and
+    dropped; their waivers are no longer served. Returns their names.
+    """
+    detached = []
+    with connection.begin():
+        for name, month in list_partitions(connection):
+            if next_month(month) <= before:
+                connection.execute('ALTER TABLE waiver DETACH PARTITION {0}'.format(name))
+                detached.append(name)
+    return detached
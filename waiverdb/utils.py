@@ -1,13 +1,33 @@
 # SPDX-License-Identifier: GPL-2.0+
 
+import atexit
+import base64
+import binascii
 import datetime
 import functools
+import json
+import math
+import os
+import random
+import six
 import stomp
-from flask import request, url_for, jsonify, current_app
-from flask_restful import marshal
-from waiverdb.fields import waiver_fields
-from werkzeug.exceptions import NotFound, HTTPException
+import threading
+import time
+from flask import (request, url_for, jsonify, current_app, stream_with_context,
+                   make_response, g, after_this_request)
+from sqlalchemy import tuple_
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+from waiverdb.fields import serialize_waiver
+from werkzeug.exceptions import BadRequest, NotFound, HTTPException
+from werkzeug.http import quote_etag
 from contextlib import contextmanager
+try:
+    # simplejson's C encoder gives exactly the same output as the json
+    # module's with the same options, only faster, so use it when installed.
+    import simplejson as json_encoder
+except ImportError:
+    json_encoder = json
 
 
 def reqparse_since(since):
@@ -32,31 +52,186 @@ def json_collection(query, page=1, limit=10):
     """
     Helper function for Flask request handlers which want to return
     a collection of resources as JSON.
+
+    The ``last`` link needs the number of rows in the whole query, which
+    costs about as much as fetching the page itself. The PAGINATION_COUNT
+    setting chooses how it is found: 'exact' counts the rows, 'estimate'
+    uses the row count estimated by the query planner (and sets
+    ``last_is_estimate``), and 'none' leaves ``last`` null. Without an exact
+    count, whether there is a next page is found by fetching one row more
+    than the page holds.
     """
-    try:
-        p = query.paginate(page, limit)
-    except NotFound:
-        return {'data': [], 'prev': None, 'next': None, 'first': None, 'last': None}
-    pages = {'data': marshal(p.items, waiver_fields)}
+    empty = {'data': [], 'prev': None, 'next': None, 'first': None, 'last': None}
+    mode = current_app.config['PAGINATION_COUNT']
+    if mode == 'exact':
+        try:
+            p = query.paginate(page, limit)
+        except NotFound:
+            return empty
+        items, has_next, last_page = p.items, p.has_next, p.pages
+    else:
+        if page < 1 or limit < 1:
+            return empty
+        items = query.limit(limit + 1).offset((page - 1) * limit).all()
+        if not items and page != 1:
+            return empty
+        has_next = len(items) > limit
+        items = items[:limit]
+        last_page = None
+        if mode == 'estimate':
+            last_page = page
+            if has_next:
+                estimated_pages = int(math.ceil(estimate_count(query) / float(limit)))
+                last_page = max(estimated_pages, page + 1)
+    pages = {'data': [serialize_waiver(item) for item in items]}
     query_pairs = request.args.copy()
     if query_pairs:
         # remove the page number
         query_pairs.pop('page', default=None)
-    if p.has_prev:
-        pages['prev'] = url_for(request.endpoint, page=p.prev_num, _external=True,
+    if page > 1:
+        pages['prev'] = url_for(request.endpoint, page=page - 1, _external=True,
                                 **query_pairs)
     else:
         pages['prev'] = None
-    if p.has_next:
-        pages['next'] = url_for(request.endpoint, page=p.next_num, _external=True,
+    if has_next:
+        pages['next'] = url_for(request.endpoint, page=page + 1, _external=True,
                                 **query_pairs)
     else:
         pages['next'] = None
     pages['first'] = url_for(request.endpoint, page=1, _external=True, **query_pairs)
-    pages['last'] = url_for(request.endpoint, page=p.pages, _external=True, **query_pairs)
+    if last_page is None:
+        pages['last'] = None
+    else:
+        pages['last'] = url_for(request.endpoint, page=last_page, _external=True,
+                                **query_pairs)
+    if mode == 'estimate':
+        pages['last_is_estimate'] = has_next
     return pages
 
 
+class explain(Executable, ClauseElement):
+    """
+    An ``EXPLAIN (FORMAT JSON)`` of the given statement, which returns the
+    query plan without running the statement.
+    """
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(explain, 'postgresql')
+def _compile_explain(element, compiler, **kw):
+    return 'EXPLAIN (FORMAT JSON) ' + compiler.process(element.statement, **kw)
+
+
+def estimate_count(query):
+    """
+    Returns the query planner's estimate of the number of rows the query
+    returns, which is much cheaper than counting them.
+    """
+    plan = query.session.execute(explain(query.order_by(None).statement)).scalar()
+    if isinstance(plan, six.string_types):
+        plan = json.loads(plan)
+    return plan[0]['Plan']['Plan Rows']
+
+
+def encode_cursor(timestamp, row_id):
+    """
+    Encodes the (timestamp, id) position of a row as an opaque cursor string.
+    """
+    value = '{0},{1}'.format(timestamp.strftime('%Y-%m-%dT%H:%M:%S.%f'), row_id)
+    return base64.urlsafe_b64encode(value.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor produced by :func:`encode_cursor` back into a
+    (timestamp, id) tuple. Raises ValueError if the cursor is malformed.
+    """
+    try:
+        value = base64.urlsafe_b64decode(str(cursor)).decode('utf-8')
+    except (TypeError, binascii.Error, UnicodeError):
+        raise ValueError('Malformed cursor %r' % cursor)
+    timestamp, _, row_id = value.partition(',')
+    return datetime.datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%f'), int(row_id)
+
+
+def json_cursor_collection(query, cursor, limit, timestamp_column, id_column):
+    """
+    Like :func:`json_collection`, but pages through the query by keyset
+    instead of by offset: each page continues after the (timestamp, id) of
+    the last row of the previous page, given as an opaque cursor in the
+    ``next`` link. The cost of a page does not depend on how deep it is, and
+    no count of the whole query is needed, so ``last`` is always null.
+
+    An empty cursor requests the first page.
+    """
+    query = query.order_by(None).order_by(timestamp_column.desc(), id_column.desc())
+    if cursor:
+        try:
+            position = decode_cursor(cursor)
+        except ValueError:
+            raise BadRequest("'cursor' parameter is not valid")
+        # The first condition is implied by the second, but Postgres only
+        # prunes partitions by simple comparisons like it.
+        query = query.filter(timestamp_column <= position[0],
+                             tuple_(timestamp_column, id_column) < tuple_(*position))
+    # Fetch one extra row to find out whether there is a next page.
+    items = query.limit(limit + 1).all()
+    has_next = len(items) > limit
+    items = items[:limit]
+    pages = {'data': [serialize_waiver(item) for item in items]}
+    query_pairs = request.args.copy()
+    if query_pairs:
+        query_pairs.pop('page', default=None)
+        query_pairs.pop('cursor', default=None)
+    if has_next:
+        last = items[-1]
+        pages['next'] = url_for(request.endpoint, _external=True,
+                                cursor=encode_cursor(last.timestamp, last.id), **query_pairs)
+    else:
+        pages['next'] = None
+    pages['prev'] = None
+    pages['first'] = url_for(request.endpoint, cursor='', _external=True, **query_pairs)
+    pages['last'] = None
+    return pages
+
+
+def json_stream_collection(query, batch_size=500):
+    """
+    Returns a streaming JSON response of the form ``{"data": [...]}`` for all
+    rows of the query. Rows are fetched through a server-side cursor
+    ``batch_size`` at a time and serialized as they arrive, so neither the
+    full result set nor its serialized form is ever held in memory at once.
+    """
+    def generate():
+        yield '{"data": ['
+        chunk = []
+        separator = ''
+        for item in query.yield_per(batch_size):
+            chunk.append(separator + json_encoder.dumps(serialize_waiver(item)))
+            separator = ', '
+            if len(chunk) == batch_size:
+                yield ''.join(chunk)
+                chunk = []
+        yield ''.join(chunk) + ']}'
+    return current_app.response_class(stream_with_context(generate()),
+                                      mimetype='application/json')
+
+
+def output_json(data, code, headers=None):
+    """
+    The same as Flask-RESTful's default JSON representation, except that it
+    encodes with :data:`json_encoder`.
+    """
+    settings = dict(current_app.config.get('RESTFUL_JSON', {}))
+    if current_app.debug:
+        settings.setdefault('indent', 4)
+        settings.setdefault('sort_keys', not six.PY3)
+    resp = make_response(json_encoder.dumps(data, **settings) + "\n", code)
+    resp.headers.extend(headers or {})
+    return resp
+
+
 def json_error(error):
     """
     Return error responses in JSON.
@@ -96,10 +271,162 @@ def jsonp(func):
     return wrapped
 
 
+LAST_WRITE_COOKIE = 'waiverdb_last_write'
+
+
+def read_replica(func):
+    """
+    Decorator for request handlers which only read from the database. Their
+    queries go to one of the read replicas in REPLICA_DATABASE_URIS, if any,
+    unless the client created waivers within the last
+    REPLICA_READ_YOUR_WRITES seconds (see :func:`remember_write`), in which
+    case the replica may not have caught up yet and the primary is used.
+
+    It must be applied outside any other decorator which uses the database.
+    """
+    @functools.wraps(func)
+    def wrapped(*args, **kwargs):
+        replicas = current_app.config['REPLICA_DATABASE_URIS']
+        if replicas and not _recently_wrote():
+            g.replica_bind = 'replica%d' % random.randrange(len(replicas))
+        return func(*args, **kwargs)
+    return wrapped
+
+
+def _recently_wrote():
+    window = current_app.config['REPLICA_READ_YOUR_WRITES']
+    if not window:
+        return False
+    try:
+        last_write = float(request.cookies.get(LAST_WRITE_COOKIE, ''))
+    except ValueError:
+        return False
+    return time.time() - last_write < window
+
+
+def remember_write():
+    """
+    Tells the client, with a cookie, that it has just written to the primary
+    database, so that :func:`read_replica` keeps its reads on the primary
+    for the next REPLICA_READ_YOUR_WRITES seconds.
+    """
+    window = current_app.config['REPLICA_READ_YOUR_WRITES']
+    if not current_app.config['REPLICA_DATABASE_URIS'] or not window:
+        return
+
+    @after_this_request
+    def set_cookie(response):
+        response.set_cookie(LAST_WRITE_COOKIE, '%.3f' % time.time(), max_age=window,
+                            httponly=True)
+        return response
+
+
+def conditional(etag_func):
+    """
+    Decorator for request handlers which want to support conditional
+    requests. ``etag_func`` is called first to compute an entity tag for the
+    response; if it matches the request's If-None-Match header, a 304 is
+    returned without calling the handler at all. Otherwise the handler runs
+    as usual and the ETag header is added to its response.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            etag = etag_func()
+            if request.if_none_match.contains(etag):
+                response = current_app.response_class(status=304)
+                response.set_etag(etag)
+                return response
+            resp = func(*args, **kwargs)
+            if isinstance(resp, current_app.response_class):
+                resp.set_etag(etag)
+                return resp
+            if isinstance(resp, tuple):
+                data, code, headers = (resp + (None, None))[:3]
+                headers = dict(headers or {})
+                headers['ETag'] = quote_etag(etag)
+                return data, code or 200, headers
+            return resp, 200, {'ETag': quote_etag(etag)}
+        return wrapped
+    return decorator
+
+
+class StompConnectionManager(object):
+    """
+    Holds one long-lived stomp connection per process, so that messages are
+    not each paying for a new TCP, TLS and STOMP handshake.
+
+    The connection is checked before every use and re-established if the
+    broker has dropped it. Failover across the brokers in ``host_and_ports``,
+    and backoff between connection attempts, are done by stomp.py itself and
+    can be tuned with its ``reconnect_*`` options in STOMP_CONFIGS.
+    """
+
+    def __init__(self):
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+        atexit.register(self.reset)
+
+    def _connection(self, configs):
+        # A connection inherited from the parent of a forked worker shares
+        # its socket with the parent, so it must never be used.
+        if self._conn is not None and self._pid != os.getpid():
+            self._conn = None
+        if self._conn is None or not self._conn.is_connected():
+            self._reset()
+            conn = stomp.Connection(**configs['connection'])
+            conn.start()
+            # The connection must be established before anything is sent,
+            # whatever the credentials say.
+            conn.connect(**dict(configs.get('credentials', {}), wait=True))
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def _reset(self):
+        if self._conn is not None and self._pid == os.getpid():
+            try:
+                self._conn.disconnect()
+            except Exception:  # pylint: disable=W0703
+                pass
+        self._conn = None
+
+    def reset(self):
+        with self._lock:
+            self._reset()
+
+    def send(self, configs, **kwargs):
+        """
+        Sends a message, reconnecting and trying once more if the connection
+        turns out to be broken.
+        """
+        with self._lock:
+            try:
+                self._connection(configs).send(**kwargs)
+            except Exception:  # pylint: disable=W0703
+                current_app.logger.warning('Sending stomp message failed, reconnecting',
+                                           exc_info=True)
+                self._reset()
+                self._connection(configs).send(**kwargs)
+
+
+stomp_manager = StompConnectionManager()
+
+
+class _StompSender(object):
+    def __init__(self, configs):
+        self.configs = configs
+
+    def send(self, **kwargs):
+        stomp_manager.send(self.configs, **kwargs)
+
+
 @contextmanager
 def stomp_connection():
     """
-    Helper function for stomp connection.
+    Helper function for stomp connection. Yields an object whose ``send``
+    method sends messages over this process's persistent stomp connection.
     """
     if current_app.config.get('STOMP_CONFIGS'):
         configs = current_app.config.get('STOMP_CONFIGS')
@@ -109,16 +436,57 @@ def stomp_connection():
         if 'connection' not in configs or not configs['connection']:
             raise RuntimeError('stomp was configured to publish messages,, '
                                'but connection is not configured in STOMP_CONFIGS')
-        conn = stomp.Connection(**configs['connection'])
-        conn.start()
-        conn.connect(**configs.get('credentials', {}))
-        yield conn
-        conn.disconnect()
+        yield _StompSender(configs)
     else:
         raise RuntimeError('stomp was configured to publish messages, '
                            'but STOMP_CONFIGS is not configured')
 
 
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Stops calling a failing dependency for a while, so that callers fail
+    fast instead of each waiting for it to time out.
+
+    After ``threshold`` consecutive failures the circuit opens and calls
+    raise :class:`CircuitOpenError` immediately. Once ``reset_timeout``
+    seconds have passed, one call is let through again: if it succeeds the
+    circuit closes, otherwise it stays open for another ``reset_timeout``.
+    """
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def call(self, func, *args, **kwargs):
+        with self._lock:
+            if self.opened_at is not None:
+                if time.time() < self.opened_at + self.reset_timeout:
+                    raise CircuitOpenError('Circuit is open after %d consecutive failures'
+                                           % self.failures)
+                # Let this call through as a trial, and keep any concurrent
+                # callers failing fast until it has finished.
+                self.opened_at = time.time()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            with self._lock:
+                self.failures += 1
+                if self.failures >= self.threshold:
+                    self.opened_at = time.time()
+            raise
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+        return result
+
+
 def insert_headers(response):
     """ Insert the CORS headers for the give reponse if there are any
     configured for the application.
@@ -0,0 +1,27 @@
+# SPDX-License-Identifier: GPL-2.0+
+"""
+WSGI entry point for serving WaiverDB with gunicorn's gevent workers, so
+that each worker process serves many requests concurrently, instead of
+being held by one request while it waits on Postgres or ResultsDB::
+
+    gunicorn --worker-class gevent --worker-connections 1000 waiverdb.wsgi_gevent:app
+
+Gunicorn makes the standard library cooperative, and this makes psycopg2
+cooperative as well, using psycogreen. The responses are those of the usual
+application. Raise SQLALCHEMY_POOL_SIZE (and SQLALCHEMY_MAX_OVERFLOW) in
+line with the number of concurrent requests, otherwise they queue for a
+database connection, which shows in the waiverdb_db_pool_checkout_seconds
+metric. Read replicas (REPLICA_DATABASE_URIS) take the lookups off the
+primary database.
+"""
+
+try:
+    from psycogreen.gevent import patch_psycopg
+except ImportError:
+    raise ImportError('python-psycogreen needs to be installed to serve WaiverDB with gevent')
+
+# psycopg2 must be patched before any database connection is made.
+patch_psycopg()
+
+from waiverdb.app import create_app  # noqa: E402
+app = create_app()